@@ -0,0 +1,199 @@
+#
+# Streaming time averaging (decimation) of visibilities.
+#
+# Snapshots are accumulated into fixed time bins (aligned to the unix epoch)
+# with a running mean and variance per baseline (Welford's algorithm, merged
+# block-wise with Chan's parallel update). Completed bins are emitted, and
+# optionally appended to a VisibilityTimeSeries, so memory use does not
+# depend on the length of the input.
+#
+import datetime
+
+import h5py
+import numpy as np
+
+from tart.imaging import visibility
+from tart.imaging.visibility_series import VisibilityTimeSeries
+from tart.operation import settings
+from tart.util import angle, utc
+
+
+class VisibilityAverager:
+    '''
+        Average visibilities into time bins of a fixed interval.
+
+        - interval the averaging interval (seconds, or a datetime.timedelta)
+        - output an optional VisibilityTimeSeries (open for appending) to which
+          the averages are written as each bin completes. If it was created
+          with_variance, the variances and counts are written too.
+        - sky_location an optional Skyloc. If given, each snapshot is fringe
+          stopped to it (as Visibility.rotate) before averaging.
+
+        The snapshots must be added in time order. add() and add_block() return
+        the averages completed by the call as a list of (Visibility, variance,
+        n_avg) tuples, where variance is the per-baseline unbiased sample
+        variance sum|v - mean|^2 / (n_avg - 1) of the snapshots (zero for a
+        single snapshot), and n_avg their number. The timestamp
+        of an average is the mean timestamp of its snapshots.
+    '''
+
+    def __init__(self, interval, output=None, sky_location=None):
+        if isinstance(interval, datetime.timedelta):
+            interval = interval.total_seconds()
+        self.interval_ns = int(round(interval * 1e9))
+        if self.interval_ns <= 0:
+            raise ValueError("The averaging interval must be positive")
+        self.output = output
+        self.sky_location = sky_location
+        self.config = None
+        self.baselines = None
+        self.bl_arr = None
+        self._bin = None
+        self._reset()
+
+    def _reset(self):
+        self._n = 0
+        self._mean = None
+        self._m2 = None
+        self._t_sum = 0
+
+    def add(self, vis_list):
+        ''' Add a Visibility object, or a list of them '''
+        if isinstance(vis_list, visibility.Visibility):
+            vis_list = [vis_list]
+        ret = []
+        for vis in vis_list:
+            ret += self.add_block(np.asarray(vis.v)[np.newaxis, :],
+                                  [utc.to_epoch_ns(vis.timestamp)],
+                                  config=vis.config, baselines=vis.baselines)
+        return ret
+
+    def add_block(self, v, timestamp_ns, config=None, baselines=None):
+        '''
+            Add an (n_t, n_bl) block of visibilities with int64 epoch nanosecond
+            timestamps (e.g. a chunk read from a VisibilityTimeSeries). The config
+            and baselines are required with the first block.
+        '''
+        if self.config is None:
+            if config is None or baselines is None:
+                raise ValueError("The config and baselines are required with the first block")
+            self.config = config
+            self.baselines = [list(b) for b in baselines]
+            self.bl_arr = np.array(self.baselines, dtype=np.int64).reshape(-1, 2)
+        elif baselines is not None and not np.array_equal(np.asarray(baselines), self.bl_arr):
+            raise ValueError("The baselines differ from those already averaged")
+
+        v = np.atleast_2d(np.asarray(v, dtype=np.complex128))
+        ts_ns = np.atleast_1d(np.asarray(timestamp_ns, dtype=np.int64))
+        if len(ts_ns) != v.shape[0]:
+            raise ValueError(f"{v.shape[0]} snapshots, but {len(ts_ns)} timestamps")
+        if len(ts_ns) == 0:
+            return []
+
+        if self.sky_location is not None:
+            v = v * np.stack([visibility.get_fringe_stop(self.config, ts, self.sky_location, self.bl_arr)
+                              for ts in utc.from_epoch_ns(ts_ns)])
+
+        bins = ts_ns // self.interval_ns
+        if np.any(np.diff(bins) < 0) or (self._bin is not None and bins[0] < self._bin):
+            raise ValueError("Snapshots must be added in time order")
+
+        ret = []
+        starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+        stops = np.append(starts[1:], len(bins))
+        for a, b in zip(starts, stops):
+            if self._bin is not None and bins[a] != self._bin:
+                ret.append(self._emit())
+            self._bin = bins[a]
+            self._merge(v[a:b], ts_ns[a:b])
+        return ret
+
+    def _merge(self, seg, ts_ns):
+        ''' Merge a block of snapshots from the current bin into the running statistics '''
+        n_b = seg.shape[0]
+        mean_b = seg.mean(axis=0)
+        m2_b = (np.abs(seg - mean_b)**2).sum(axis=0)
+        if self._n == 0:
+            self._mean = mean_b
+            self._m2 = m2_b
+        else:
+            n_tot = self._n + n_b
+            delta = mean_b - self._mean
+            self._mean = self._mean + delta * (n_b / n_tot)
+            self._m2 = self._m2 + m2_b + np.abs(delta)**2 * (self._n * n_b / n_tot)
+        self._n += n_b
+        self._t_sum += int((ts_ns - self._bin * self.interval_ns).sum())
+
+    def _emit(self):
+        n = self._n
+        variance = self._m2 / (n - 1) if n > 1 else np.zeros_like(self._m2)
+        ts_ns = self._bin * self.interval_ns + self._t_sum // n
+        timestamp = utc.from_epoch_ns(ts_ns)
+
+        vis = visibility.Visibility.from_config(self.config, timestamp)
+        if self.sky_location is not None:
+            vis.phase_el, vis.phase_az, _ = visibility.get_delays(self.config, timestamp,
+                                                                  self.sky_location)
+        vis.set_visibilities(self._mean, self.baselines)
+
+        if self.output is not None:
+            if self.output.has_variance:
+                self.output.append(self._mean, ts_ns, variance=variance, n_avg=n)
+            else:
+                self.output.append(self._mean, ts_ns)
+        self._reset()
+        return vis, variance, n
+
+    def flush(self):
+        ''' Emit the (possibly partial) current bin '''
+        if self._n == 0:
+            return []
+        ret = [self._emit()]
+        self._bin = None
+        return ret
+
+
+def average_hdf5(infile, outfile, interval, sky_location=None, block_rows=1024):
+    '''
+        Average a visibility HDF5 file (written by visibility.to_hdf5 or a
+        VisibilityTimeSeries) into a new VisibilityTimeSeries file with the
+        variances and counts of each average. The input is read block_rows
+        snapshots at a time.
+
+        If sky_location is given the snapshots are fringe stopped to it, and
+        the phase centre of the output is the (el, az) of sky_location at the
+        first average. Otherwise the phase centre of the input is kept.
+
+        Returns the number of averaged snapshots written.
+    '''
+    with h5py.File(infile, "r") as h5f:
+        config = settings.from_json(np.bytes_(h5f["config"][0]))
+        ant_pos = h5f["antenna_positions"][:]
+        config.set_antenna_positions(ant_pos)
+        baselines = h5f["baselines"][:].tolist()
+        phase_elaz = h5f["phase_elaz"][:]
+        dset = h5f["vis"]
+        n_t = dset.shape[0]
+
+        out = VisibilityTimeSeries.create(outfile, config, baselines, ant_pos,
+                                          cal_gain=h5f["gains"][:], cal_ph=h5f["phases"][:],
+                                          phase_el=angle.from_dms(phase_elaz[0]),
+                                          phase_az=angle.from_dms(phase_elaz[1]),
+                                          with_variance=True)
+        with out:
+            averager = VisibilityAverager(interval, output=out, sky_location=sky_location)
+            first = None
+            for i in range(0, n_t, block_rows):
+                rows = slice(i, min(i + block_rows, n_t))
+                if "timestamp_ns" in h5f:
+                    ts_ns = h5f["timestamp_ns"][rows]
+                else:
+                    ts_ns = utc.to_epoch_ns(utc.from_strings(h5f["timestamp"][rows]))
+                ret = averager.add_block(dset[rows], ts_ns, config=config, baselines=baselines)
+                first = first or ret
+            ret = averager.flush()
+            first = first or ret
+            if sky_location is not None and first:
+                vis = first[0][0]
+                out.set_phase_centre(vis.phase_el, vis.phase_az)
+            return len(out)
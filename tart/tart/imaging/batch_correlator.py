@@ -0,0 +1,196 @@
+#
+# Correlate many raw observation files across a pool of processes.
+#
+# The raw files are read (and decompressed) by a pool of threads in the
+# calling process, overlapping the I/O with the correlation. The packed data
+# are handed to the worker processes through shared memory, so the sample
+# arrays are never pickled, and each worker unpacks them only if its
+# correlator mode needs the unpacked samples.
+#
+import collections
+import glob
+import itertools
+import os
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from tart.imaging import correlator, visibility
+from tart.operation import observation, settings
+
+
+def expand_file_list(files):
+    '''Return the sorted list of files from a glob pattern or a list of files and/or patterns'''
+    if isinstance(files, str):
+        files = [files]
+    ret = set()
+    for f in files:
+        matches = glob.glob(f)
+        if len(matches) == 0:
+            raise FileNotFoundError(f"No raw observation files match {f}")
+        ret.update(matches)
+    return sorted(ret)
+
+
+def _read_raw(fname):
+    ''' Read a raw file (in a loader thread), returning it and the time taken '''
+    start = time.time()
+    raw = observation.read_raw(fname)
+    raw.packed_data = np.ascontiguousarray(raw.packed_data, dtype=np.uint8)
+    return raw, time.time() - start
+
+
+def _read_ahead(file_list, threads, ahead):
+    ''' Generate the (RawObservation, load time) of each file, reading up to ahead files in advance '''
+    with ThreadPoolExecutor(max_workers=threads) as loader:
+        names = iter(file_list)
+        queue = collections.deque(loader.submit(_read_raw, f)
+                                  for f in itertools.islice(names, ahead))
+        while len(queue) > 0:
+            ret = queue.popleft().result()
+            for f in itertools.islice(names, 1):
+                queue.append(loader.submit(_read_raw, f))
+            yield ret
+
+
+def _correlate_shared(shm_name, shape, n_samples, config_dict, timestamp, mode, van_vleck_corr):
+    ''' Worker process: correlate packed data held in a shared memory block '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        packed = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        raw = observation.RawObservation(None, timestamp, settings.from_dict(config_dict),
+                                         packed, n_samples)
+        # The packed mode correlates the shared words directly, the others unpack them here.
+        obs = raw.to_observation(packed=(mode == "packed"))
+        cor = correlator.Correlator(van_vleck_corr=van_vleck_corr)
+        start = time.time()
+        v, baselines = cor.compute_complex_vis(obs, mode=mode)
+        elapsed = time.time() - start
+        # Release the views on the shared buffer before it is closed.
+        del obs, raw, packed
+    finally:
+        shm.close()
+    return np.asarray(v, dtype=np.complex128), baselines, elapsed
+
+
+def correlate_files(files, mode="roll", van_vleck_corr=True, processes=None, max_pending=None,
+                    load_threads=4):
+    '''
+        Correlate a list (or glob) of raw observation files across a process pool.
+
+        - files a glob pattern, or a list of file names and/or patterns
+        - mode the Correlator mode
+        - processes the number of worker processes (default: the number of CPUs)
+        - max_pending the maximum number of packed observations held in shared
+          memory at once (default: twice the number of processes)
+        - load_threads the number of threads reading the files
+
+        Returns the list of Visibility objects sorted by timestamp, and a
+        list of per-file statistics (also sorted by timestamp). Each statistics
+        entry is a dict with the file name, timestamp, number of samples, the
+        load and correlation times (seconds) and the correlator throughput
+        (samples per second, per antenna).
+    '''
+    file_list = expand_file_list(files)
+
+    results = []
+    pending = {}
+
+    def release(shm):
+        shm.close()
+        shm.unlink()
+
+    def collect(done):
+        for fut in done:
+            fname, obs_timestamp, config, n_samples, load_time, shm = pending.pop(fut)
+            try:
+                v, baselines, elapsed = fut.result()
+            finally:
+                release(shm)
+            vis = visibility.Visibility.from_config(config, obs_timestamp)
+            vis.set_visibilities(v, baselines)
+            stats = {
+                "filename": fname,
+                "timestamp": obs_timestamp,
+                "n_samples": n_samples,
+                "load_time": load_time,
+                "correlate_time": elapsed,
+                "samples_per_second": n_samples / elapsed if elapsed > 0 else float("inf"),
+            }
+            results.append((vis, stats))
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * processes
+
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for raw, load_time in _read_ahead(file_list, load_threads, max_pending):
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                packed = raw.packed_data
+                shm = shared_memory.SharedMemory(create=True, size=max(packed.nbytes, 1))
+                try:
+                    shared = np.ndarray(packed.shape, dtype=np.uint8, buffer=shm.buf)
+                    shared[:] = packed
+                    del shared
+                    fut = pool.submit(_correlate_shared, shm.name, packed.shape, raw.n_samples,
+                                      raw.config.Dict, raw.timestamp, mode, van_vleck_corr)
+                except BaseException:
+                    release(shm)
+                    raise
+                pending[fut] = (raw.filename, raw.timestamp, raw.config, raw.n_samples,
+                                load_time, shm)
+
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+    finally:
+        # If a worker (or a load) failed, release the blocks still in flight.
+        for entry in pending.values():
+            release(entry[-1])
+        pending.clear()
+
+    # Deterministic output ordering (ties broken by file name)
+    results.sort(key=lambda r: (r[1]["timestamp"], r[1]["filename"]))
+    vis_list = [r[0] for r in results]
+    stats_list = [r[1] for r in results]
+    return vis_list, stats_list
+
+
+def correlate_to_hdf5(files, filename, ant_pos=None, cal_gain=None, cal_ph=None,
+                      mode="roll", van_vleck_corr=True, processes=None, load_threads=4):
+    '''
+        Correlate a list (or glob) of raw observation files, and save the visibilities
+        (sorted by timestamp) in one visibility HDF5 file using visibility.to_hdf5()
+
+        - ant_pos the antenna positions. Raw observation files do not store
+          them, so they must be supplied unless the configuration has them.
+        - cal_gain, cal_ph the calibration to store (default unity gain and zero phase)
+
+        Returns the per-file statistics from correlate_files()
+    '''
+    if len(files) == 0:
+        raise ValueError("no input files")
+    vis_list, stats_list = correlate_files(files, mode=mode, van_vleck_corr=van_vleck_corr,
+                                           processes=processes, load_threads=load_threads)
+    config = vis_list[0].config
+    num_ant = config.get_num_antenna()
+
+    if ant_pos is None:
+        ant_pos = config.get_antenna_positions()
+    if ant_pos is None:
+        raise ValueError("Antenna positions are required to save visibilities")
+    if cal_gain is None:
+        cal_gain = np.ones(num_ant)
+    if cal_ph is None:
+        cal_ph = np.zeros(num_ant)
+
+    visibility.to_hdf5(vis_list, ant_pos, cal_gain, cal_ph, filename)
+    return stats_list
@@ -4,134 +4,326 @@
 # Copyright (c) Tim Molteno 2013-2020. tim@elec.ac.nz
 #
 
+import collections
+import hashlib
 import json
 
 import numpy as np
 
 
+ANTENNAS_PER_TILE = 6
+
+UVW_CACHE_SIZE = 64
+_uvw_cache = collections.OrderedDict()
+
+
+def rotate_baselines(bl_vectors, rot_degrees):
+    """
+    Rotate (n, 3) ENU baseline vectors counter-clockwise by rot_degrees about
+    the vertical. As the rotation is linear this is equivalent to rotating the
+    antenna positions with settings.rotate_location() and differencing them.
+    """
+    theta = np.radians(rot_degrees)
+    c, s = np.cos(theta), np.sin(theta)
+    ret = np.empty_like(bl_vectors)
+    ret[:, 0] = bl_vectors[:, 0] * c - bl_vectors[:, 1] * s
+    ret[:, 1] = bl_vectors[:, 0] * s + bl_vectors[:, 1] * c
+    ret[:, 2] = bl_vectors[:, 2]
+    return ret
+
+
+def get_baseline_uvw(ant_pos, baselines, rot_degrees=0.0):
+    """
+    Return the (n_bl, 3) baseline vectors pos[i] - pos[j] (meters) of an
+    (n_bl, 2) array of baselines, rotated by rot_degrees.
+
+    The results are held in a small LRU cache keyed by a hash of the antenna
+    positions and the baselines (which encode the flag mask), and by the
+    rotation, so repeated calls inside calibration loops are free. The
+    returned array must not be modified.
+    """
+    ant_pos = np.ascontiguousarray(ant_pos, dtype=np.float64)
+    baselines = np.ascontiguousarray(baselines, dtype=np.int64)
+    h = hashlib.sha1(ant_pos.tobytes())
+    h.update(baselines.tobytes())
+    geometry = h.hexdigest()
+    key = (geometry, float(rot_degrees))
+
+    if key in _uvw_cache:
+        _uvw_cache.move_to_end(key)
+        return _uvw_cache[key]
+
+    base_key = (geometry, 0.0)
+    if base_key in _uvw_cache:
+        _uvw_cache.move_to_end(base_key)
+        bl_vectors = _uvw_cache[base_key]
+    else:
+        bl_vectors = ant_pos[baselines[:, 0]] - ant_pos[baselines[:, 1]]
+        _uvw_cache[base_key] = bl_vectors
+    ret = bl_vectors if rot_degrees == 0.0 else rotate_baselines(bl_vectors, rot_degrees)
+
+    _uvw_cache[key] = ret
+    while len(_uvw_cache) > UVW_CACHE_SIZE:
+        _uvw_cache.popitem(last=False)
+    return ret
+
+
+class AntennaCalibration:
+    """
+    Per-antenna gains and phase offsets, held as the complex gain vector
+
+        c_i = gain_i exp(-j phase_offset_i)
+
+    so that a calibrated visibility is v_ij c_i conj(c_j). The version counter
+    is incremented by every change, so that caches of calibrated data can
+    tell when they are stale. The gains and phase offsets are read-only
+    views, and must be changed through set_gain() and set_phase_offset().
+    """
+    def __init__(self, gain, phase_offset):
+        self._gain = np.array(gain, dtype=np.float64)
+        self._phase_offset = np.array(phase_offset, dtype=np.float64) % (2 * np.pi)
+        self.version = 0
+        self._c = None
+
+    @staticmethod
+    def _read_only(arr):
+        ret = arr.view()
+        ret.flags.writeable = False
+        return ret
+
+    @property
+    def gain(self):
+        return self._read_only(self._gain)
+
+    @property
+    def phase_offset(self):
+        return self._read_only(self._phase_offset)
+
+    @classmethod
+    def unity(cls, num_ant):
+        return cls(np.ones(num_ant), np.zeros(num_ant))
+
+    def _changed(self):
+        self.version += 1
+        self._c = None
+
+    def set_gain(self, i, val):
+        self._gain[i] = val
+        self._changed()
+
+    def set_phase_offset(self, i, val):
+        self._phase_offset[i] = np.asarray(val) % (2 * np.pi)
+        self._changed()
+
+    def get_complex_gain(self):
+        """ Return the (n_ant,) complex gain vector c """
+        if self._c is None:
+            self._c = self._gain * np.exp(-1j * self._phase_offset)
+        return self._c
+
+    def get_baseline_factor(self, baselines):
+        """ Return c_i conj(c_j) for an (n_bl, 2) array of baselines """
+        c = self.get_complex_gain()
+        bl = np.asarray(baselines)
+        return c[bl[:, 0]] * np.conjugate(c[bl[:, 1]])
+
+    def apply(self, v, baselines):
+        """
+        Calibrate visibilities v, an (n_bl,) or (n_t, n_bl) block whose
+        columns are the (n_bl, 2) baselines, with one broadcast multiply.
+        """
+        return np.asarray(v) * self.get_baseline_factor(baselines)
+
+    def apply_to_list(self, vis_list):
+        """
+        Return the calibrated (n_t, n_bl) block of a list of Visibility
+        objects sharing the same baselines, and the baselines.
+        """
+        bl = vis_list[0].bl_arr
+        v = np.stack([vis.v for vis in vis_list])
+        return self.apply(v, bl), bl
+
+
 class CalibratedVisibility:
-    def __init__(self, vis):
+    """
+    Visibilities with per-antenna gains and phase offsets applied.
+
+    The gains and phase offsets are held in an AntennaCalibration, which may
+    be shared between the CalibratedVisibility objects of several snapshots.
+    Flags are held as a boolean mask (flags) over the baselines of the
+    underlying Visibility. The mask-applied visibilities and uvw returned by
+    get_all_visibility() and get_all_uvw() are cached, and rebuilt only when
+    the calibration, flags or antenna positions change. The version changes
+    whenever the calibrated visibilities may have changed (including when a
+    different AntennaCalibration is assigned to cal).
+    """
+    def __init__(self, vis, cal=None):
         self.vis = vis
-        self.flagged_baselines = []
-        nant = vis.config.get_num_antenna()
-        self.phase_offset = np.zeros(nant)
-        self.gain = np.ones(nant)
+        self.flags = np.zeros(len(vis.baselines), dtype=bool)
+        if cal is None:
+            cal = AntennaCalibration.unity(vis.config.get_num_antenna())
+        self.cal = cal
+        self._flag_version = 0
+        self._vis_cache = None
+        self.rotation = 0.0
+        self.reference_positions = None
+
+    @property
+    def gain(self):
+        return self.cal.gain
+
+    @property
+    def phase_offset(self):
+        return self.cal.phase_offset
+
+    @property
+    def version(self):
+        return (id(self.cal), self.cal.version, self._flag_version)
+
+    def _invalidate(self):
+        self._flag_version += 1
 
     def set_config(self, config):
         self.vis.config = config
+        self.reference_positions = None
+        self._invalidate()
 
     def get_config(self):
         return self.vis.config
 
+    def set_rotation(self, rot_degrees, reference_positions):
+        """
+        Rotate the array counter-clockwise by rot_degrees from the reference
+        positions. The antenna positions of the config are updated, and the
+        uvw are rotated analytically from the cached baseline vectors.
+        """
+        self.rotation = float(rot_degrees)
+        self.reference_positions = np.array(reference_positions, dtype=np.float64)
+        self.vis.config.set_antenna_positions(self.get_antenna_positions().tolist())
+
+    def get_antenna_positions(self):
+        """ Return the (n_ant, 3) antenna positions, including any rotation """
+        if self.reference_positions is None:
+            return np.asarray(self.vis.config.get_antenna_positions(), dtype=np.float64)
+        return rotate_baselines(self.reference_positions, self.rotation)
+
     def get_timestamp(self):
         return self.vis.timestamp
 
-    def __get_vis(self, bl):
-        return self.vis.v[self.vis.baselines.index(bl)]
+    @property
+    def flagged_baselines(self):
+        return self.vis.bl_arr[self.flags].tolist()
+
+    def flag_mask(self, mask):
+        """ Flag the baselines where the boolean mask (over the baselines) is True """
+        self.flags = self.flags | np.asarray(mask, dtype=bool)
+        self._invalidate()
 
     def flag_baseline(self, i, j):
-        bl = [i, j]
-        if bl not in self.flagged_baselines:
-            # vis_idx = self.vis.baselines.index(bl)
-            self.flagged_baselines.append(bl)
-            # print('flagged', vis_idx, bl)
+        idx, _ = self.vis.get_index([i], [j])
+        if idx[0] >= 0:
+            self.flags[idx[0]] = True
+            self._invalidate()
 
     def flag_antenna(self, i):
-        for bl in self.vis.baselines:
-            if i in bl:
-                [a, b] = bl
-                self.flag_baseline(a, b)
+        self.flag_mask((self.vis.bl_arr == i).any(axis=1))
 
     def get_visibility(self, i, j):
         if j < i:
             return np.conjugate(self.get_visibility(j, i))
 
-        bl = [i, j]
-        if bl in self.flagged_baselines:
-            raise
-        else:
-            v = self.__get_vis(bl)
-            return (
-                v
-                * self.get_gain(i)
-                * self.get_gain(j)
-                * np.exp(-1j * (self.get_phase_offset(i) - self.get_phase_offset(j)))
-            )
+        idx, _ = self.vis.get_index([i], [j])
+        if idx[0] < 0 or self.flags[idx[0]]:
+            raise RuntimeError("Baseline [%d,%d] is flagged or invalid" % (i, j))
+        c = self.cal.get_complex_gain()
+        return self.vis.v[idx[0]] * c[i] * np.conjugate(c[j])
 
     def get_all_visibility(self):
-        bl = np.asarray(self.get_baselines())
-        v_arr = np.asarray(self.get_unflagged_vis())
-        ret = (
-            v_arr
-            * self.get_gain(bl[:, 0])
-            * self.get_gain(bl[:, 1])
-            * np.exp(
-                -1j
-                * (self.get_phase_offset(bl[:, 0]) - self.get_phase_offset(bl[:, 1]))
-            )
-        )
-        return ret, bl
+        """
+        Return the calibrated visibilities of the unflagged baselines, and an
+        (n, 2) array of those baselines. The arrays are cached, and must not
+        be modified by the caller.
+        """
+        # The cache holds the calibration itself, so its id() cannot be reused while cached
+        cache = self._vis_cache
+        if (cache is None or cache[0] is not self.vis.v or cache[1] is not self.cal
+                or cache[2] != self.version):
+            bl = self.vis.bl_arr[~self.flags]
+            ret = self.cal.apply(self.vis.v[~self.flags], bl)
+            self._vis_cache = (self.vis.v, self.cal, self.version, ret, bl)
+        return self._vis_cache[3], self._vis_cache[4]
 
     def get_all_uvw(self):
-        c = self.get_config()
-        ant_p = np.asarray(c.get_antenna_positions())
-
-        bls = np.asarray(self.get_baselines())
-        bl_pos = ant_p[bls]
-        uu_a, vv_a, ww_a = (bl_pos[:, 0] - bl_pos[:, 1]).T
-        return uu_a, vv_a, ww_a
+        """
+        Return the u, v and w (in meters) of the unflagged baselines. The
+        arrays are cached, and must not be modified by the caller.
+        """
+        if self.reference_positions is None:
+            ant_pos, rotation = self.get_antenna_positions(), 0.0
+        else:
+            ant_pos, rotation = self.reference_positions, self.rotation
+        uvw = get_baseline_uvw(ant_pos, self.vis.bl_arr[~self.flags], rotation)
+        return uvw[:, 0], uvw[:, 1], uvw[:, 2]
 
     def get_unflagged_vis(self):
-        return [
-            vis
-            for bl, vis in zip(self.vis.baselines, self.vis.v)
-            if bl not in self.flagged_baselines
-        ]
+        return self.vis.v[~self.flags]
 
     def get_baselines(self):
-        return [bl for bl in self.vis.baselines if bl not in self.flagged_baselines]
+        return self.vis.bl_arr[~self.flags].tolist()
 
     def get_baseline_lengths(self):
-        pos = self.get_config().get_antenna_positions()
-        # print(pos)
-        ret = []
-        for bln in self.get_baselines():
-            [i, j] = bln
-            ret.append([pos[j][0] - pos[i][0], pos[j][1] - pos[i][1]])
-        return np.abs(ret)
+        pos = self.get_antenna_positions()
+        bls = self.vis.bl_arr[~self.flags]
+        return np.abs(pos[bls[:, 1], 0:2] - pos[bls[:, 0], 0:2])
 
     def set_flagged_baselines(self, flaged_list):
-        self.flagged_baselines = flaged_list
+        self.flags = np.zeros(len(self.vis.baselines), dtype=bool)
+        if len(flaged_list) > 0:
+            bl = np.asarray(flaged_list, dtype=np.int64).reshape(-1, 2)
+            idx, _ = self.vis.get_index(bl[:, 0], bl[:, 1])
+            self.flags[idx[idx >= 0]] = True
+        self._invalidate()
 
     def flag_tile(self, tile_idx):
-        for bln in self.get_baselines():
-            [i, j] = bln
-            if ((i // 6) == tile_idx) or ((j // 6) == tile_idx):
-                self.flag_baseline(i, j)
+        tile = self.vis.bl_arr // ANTENNAS_PER_TILE
+        self.flag_mask((tile == tile_idx).any(axis=1))
+
+    def _baseline_vectors(self):
+        """ The (n_bl, 3) vectors pos[i] - pos[j] of all the baselines """
+        return get_baseline_uvw(self.get_antenna_positions(), self.vis.bl_arr)
 
     def leave_parallel_baselines(self, ew_threshold=10, ns_threshold=10):
-        ant_positions = np.array(self.get_config().get_antenna_positions())
-        for bln in self.get_baselines():
-            [i, j] = bln
-            diff = ant_positions[i] - ant_positions[j]
-            if np.abs(diff[0]) > ew_threshold or np.abs(diff[1]) > ns_threshold:
-                self.flag_baseline(i, j)
+        diff = self._baseline_vectors()
+        self.flag_mask((np.abs(diff[:, 0]) > ew_threshold) | (np.abs(diff[:, 1]) > ns_threshold))
 
     def leave_intra_tile_baselines(self):
-        ant_positions = np.array(self.get_config().get_antenna_positions())
-        for bln in self.get_baselines():
-            [i, j] = bln
-            if (i // 6) != (j // 6):
-                self.flag_baseline(i, j)
+        tile = self.vis.bl_arr // ANTENNAS_PER_TILE
+        self.flag_mask(tile[:, 0] != tile[:, 1])
+
+    def leave_baseline_lengths(self, min_length=0.0, max_length=np.inf):
+        """ Flag the baselines whose horizontal (east-north) length in meters is outside [min_length, max_length] """
+        diff = self._baseline_vectors()
+        length = np.hypot(diff[:, 0], diff[:, 1])
+        self.flag_mask((length < min_length) | (length > max_length))
+
+    def leave_orientation(self, orientation, tolerance):
+        """
+        Flag the baselines whose horizontal orientation (radians anticlockwise
+        from east, modulo pi) is further than tolerance from orientation.
+        """
+        diff = self._baseline_vectors()
+        bl_angle = np.arctan2(diff[:, 1], diff[:, 0])
+        delta = np.angle(np.exp(2j * (bl_angle - orientation))) / 2
+        self.flag_mask(np.abs(delta) > tolerance)
 
     def set_phase_offset(self, i, val):
-        self.phase_offset[i] = np.asarray(val) % (2 * np.pi)
+        self.cal.set_phase_offset(i, val)
 
     def get_phase_offset(self, i):
         return self.phase_offset[i]
 
     def set_gain(self, i, val):
-        self.gain[i] = val
+        self.cal.set_gain(i, val)
 
     def get_gain(self, i):
         return self.gain[i]
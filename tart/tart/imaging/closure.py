@@ -0,0 +1,116 @@
+#
+# Closure phases and closure amplitudes for every antenna triangle and quadrangle.
+#
+# Closure quantities are independent of the antenna based gains and phases,
+# so they are useful as calibration independent health metrics. All the
+# triangles (or quadrangles) of a snapshot, or of a time series of snapshots,
+# are evaluated at once.
+#
+import itertools
+
+import numpy as np
+
+from tart.imaging import visibility
+
+
+def triangles(num_ant):
+    '''Return an (n_tri, 3) array of the antenna triangles [i, j, k] with i < j < k'''
+    ret = np.array(list(itertools.combinations(range(num_ant), 3)), dtype=np.int64)
+    return ret.reshape(-1, 3)
+
+
+def quadrangles(num_ant):
+    '''Return an (n_quad, 4) array of the antenna quadrangles [i, j, k, l] with i < j < k < l'''
+    ret = np.array(list(itertools.combinations(range(num_ant), 4)), dtype=np.int64)
+    return ret.reshape(-1, 4)
+
+
+def get_vis_matrix(vis):
+    '''
+        Return the visibilities as an (n_t, n_bl) array, and a Visibility object
+        whose baseline index table describes the columns.
+
+        - vis a Visibility, a list of Visibility objects (which must share the
+          same baselines) or the dictionary returned by visibility.from_hdf5()
+    '''
+    if isinstance(vis, dict):
+        vis = vis["vis_list"]
+    if isinstance(vis, visibility.Visibility):
+        vis = [vis]
+    if len(vis) == 0:
+        raise ValueError("No visibilities supplied")
+
+    ref = vis[0]
+    for v in vis[1:]:
+        if not np.array_equal(v.bl_arr, ref.bl_arr):
+            raise ValueError("All visibilities must have the same baselines")
+    v_matrix = np.stack([np.asarray(v.v) for v in vis])
+    return v_matrix, ref
+
+
+def _lookup(v_matrix, ref, i, j):
+    ''' Return the (n_t, len(i)) visibilities of the antenna pairs (i, j) '''
+    idx, conj = ref.get_index(i, j)
+    if np.any(idx < 0):
+        bad = np.argwhere(idx < 0)[0][0]
+        raise RuntimeError("Baseline [%d,%d] is invalid" % (i[bad], j[bad]))
+    ret = v_matrix[:, idx]
+    return np.where(conj, np.conjugate(ret), ret)
+
+
+def closure_phases(vis, tri=None):
+    '''
+        Return the closure phases arg(V_ij V_jk V_ik^*) of the antenna triangles.
+
+        - vis a Visibility, a list of Visibility objects or the dictionary
+          returned by visibility.from_hdf5()
+        - tri an (n_tri, 3) array of triangles (default: all the triangles)
+
+        Returns an (n_t, n_tri) array of phases wrapped to [-pi, pi], or an
+        (n_tri,) array if vis is a single Visibility. The order of the
+        triangles is returned by triangles().
+    '''
+    v_matrix, ref = get_vis_matrix(vis)
+    if tri is None:
+        tri = triangles(ref.bl_index.shape[0])
+    tri = np.asarray(tri, dtype=np.int64).reshape(-1, 3)
+    i, j, k = tri[:, 0], tri[:, 1], tri[:, 2]
+
+    bispectrum = (_lookup(v_matrix, ref, i, j) *
+                  _lookup(v_matrix, ref, j, k) *
+                  np.conjugate(_lookup(v_matrix, ref, i, k)))
+    ret = np.angle(bispectrum)
+    if isinstance(vis, visibility.Visibility):
+        return ret[0]
+    return ret
+
+
+def closure_amplitudes(vis, quad=None):
+    '''
+        Return the two independent closure amplitudes of the antenna quadrangles,
+
+            |V_ij V_kl| / |V_ik V_jl|  and  |V_il V_jk| / |V_ik V_jl|
+
+        - vis a Visibility, a list of Visibility objects or the dictionary
+          returned by visibility.from_hdf5()
+        - quad an (n_quad, 4) array of quadrangles (default: all the quadrangles)
+
+        Returns an (n_t, n_quad, 2) array, or an (n_quad, 2) array if vis is
+        a single Visibility. Quadrangles with a zero denominator give inf or nan.
+    '''
+    v_matrix, ref = get_vis_matrix(vis)
+    if quad is None:
+        quad = quadrangles(ref.bl_index.shape[0])
+    quad = np.asarray(quad, dtype=np.int64).reshape(-1, 4)
+    i, j, k, l = quad[:, 0], quad[:, 1], quad[:, 2], quad[:, 3]
+
+    def amp(a, b):
+        return np.abs(_lookup(v_matrix, ref, a, b))
+
+    denom = amp(i, k) * amp(j, l)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret = np.stack([amp(i, j) * amp(k, l) / denom,
+                        amp(i, l) * amp(j, k) / denom], axis=-1)
+    if isinstance(vis, visibility.Visibility):
+        return ret[0]
+    return ret
@@ -1,13 +1,13 @@
+import datetime
+
+import h5py
 import numpy as np
 
 from tart.imaging import visibility
 from tart.imaging import imaging
+from tart.operation import observation
 from tart.util import angle
-
-# import pyfftw
-# from pyfftw.interfaces.scipy_fftpack import hilbert as fftw_hilbert
-# from scipy.fftpack import hilbert as fftw_hilbert
-# from tart.util.hilbert import hilbert_fftw as fftw_hilbert
+from tart.util.hilbert import get_hilbert_transformer
 
 
 def van_vleck_correction(R):
@@ -24,6 +24,25 @@ def combine_real_imag(v_real, v_imag):
     return v_real - 1j * v_imag
 
 
+def correlate_matrix(data, data_hilb):
+    '''
+        Correlate every antenna with every other antenna using two matrix
+        products, so that the work is done by BLAS rather than a python loop.
+
+        - data the (..., n_ant, n_samples) mean-subtracted antenna signals
+        - data_hilb the (..., n_ant, n_samples) quadrature signals
+
+        Any leading dimensions (for example sub-integrations) are broadcast.
+        Returns the real and imaginary correlations of the upper triangle,
+        in the same baseline order as imaging.get_baseline_indices().
+    '''
+    n_samples = data.shape[-1]
+    i_idx, j_idx = np.triu_indices(data.shape[-2], k=1)
+    r_real = np.matmul(data, np.swapaxes(data, -1, -2)) / float(n_samples)
+    r_imag = np.matmul(data, np.swapaxes(data_hilb, -1, -2)) / float(n_samples)
+    return r_real[..., i_idx, j_idx], r_imag[..., i_idx, j_idx]
+
+
 class Correlator:
     def __init__(self, van_vleck_corr=True):
         self.vv = van_vleck_corr
@@ -36,33 +55,82 @@ class Correlator:
 
     def compute_complex_vis(self, obs, debug=False, mode="roll"):
         """Return an array of baselines and visibilities from this observation"""
-        v = []
-        data = []
-        data_hilb = []
+        if mode == "packed":
+            return self.compute_packed_vis(obs.get_packed_data(), obs.get_num_samples())
+
         num_antenna = obs.config.get_num_antenna()
-        for i in range(num_antenna):
-            ant_i = obs.get_antenna(i)
-            mean_i = np.mean(ant_i)
-            data.append(ant_i - mean_i)
-
-        if "fftw" in mode:
-            from pyfftw.interfaces.scipy_fftpack import hilbert as fftw_hilbert
-
-        for i, d in enumerate(data):
-            if mode == "roll":
-                data_hilb.append(np.roll(d, 1))
-            elif mode == "fftw_hilbert":
-                h_i = -fftw_hilbert(d)
-                data_hilb.append(h_i)
-            elif mode == "fftw_hilbert_sign":
-                h_i = -np.sign(fftw_hilbert(d))
-                data_hilb.append(h_i)
+        data = np.array([obs.get_antenna(i) for i in range(num_antenna)],
+                        dtype=np.float64)
+        data -= np.mean(data, axis=1, keepdims=True)
+        v_real, v_imag = correlate_matrix(data, self.quadrature(data, mode))
+        return self.complex_vis(v_real, v_imag), imaging.get_baseline_indices(num_antenna)
+
+    def correlate_subintegrations(self, obs, n_samples, mode="roll"):
+        '''
+            Return a list of Visibility objects, one for every n_samples samples
+            of the observation (any remaining samples are discarded). The timestamp
+            of each is the start of its sub-integration.
+        '''
+        v, baselines, timestamps = self.compute_subint_vis(obs, n_samples, mode=mode)
+        ret = []
+        for ts, v_t in zip(timestamps, v):
+            vis = visibility.Visibility.from_config(obs.config, ts)
+            vis.set_visibilities(v_t, baselines)
+            ret.append(vis)
+        return ret
+
+    def compute_subint_vis(self, obs, n_samples, mode="roll"):
+        '''
+            Return an (n_int, n_bl) array of visibilities, the baselines, and the
+            start timestamp of each of the n_int sub-integrations of n_samples samples.
+            All sub-integrations are correlated, and Van Vleck corrected, at once.
+        '''
+        num_antenna = obs.config.get_num_antenna()
+        data = np.array([obs.get_antenna(i) for i in range(num_antenna)],
+                        dtype=np.float64)
+        n_int = data.shape[1] // n_samples
+        if n_int == 0:
+            raise ValueError(f"Sub-integration of {n_samples} samples is longer than the observation")
+
+        # The quadrature signal is formed from the whole capture so that the
+        # edges of the sub-integrations use the true neighbouring samples.
+        data_hilb = self.quadrature(data - np.mean(data, axis=1, keepdims=True), mode)
+
+        def split(x):
+            x = x[:, :n_int * n_samples].reshape(num_antenna, n_int, n_samples)
+            x = np.ascontiguousarray(x.transpose(1, 0, 2))
+            return x - np.mean(x, axis=2, keepdims=True)
+
+        v_real, v_imag = correlate_matrix(split(data), split(data_hilb))
 
+        dt = n_samples / obs.get_sampling_rate()
+        timestamps = [obs.timestamp + datetime.timedelta(seconds=k * dt) for k in range(n_int)]
         baselines = imaging.get_baseline_indices(num_antenna)
-        for bl in baselines:
-            i, j = bl
-            v.append(self.V(data[i], data[j], data_hilb[j]))
-        return v, baselines
+        return self.complex_vis(v_real, v_imag), baselines, timestamps
+
+    def compute_packed_vis(self, packed, n_samples, block_size=None):
+        """Return visibilities and baselines from (n_ant, n_bytes) packed data"""
+        v_real, v_imag = correlate_packed(packed, n_samples, block_size)
+        baselines = imaging.get_baseline_indices(packed.shape[0])
+        return self.complex_vis(v_real, v_imag), baselines
+
+    def complex_vis(self, v_real, v_imag):
+        if self.vv:
+            v_real = van_vleck_correction(v_real)
+            v_imag = van_vleck_correction(v_imag)
+        return combine_real_imag(v_real, v_imag)
+
+    def quadrature(self, data, mode="roll"):
+        """Return the quadrature (n_ant, n_samples) signals used for the imaginary correlation"""
+        if mode == "roll":
+            return np.roll(data, 1, axis=1)
+        if mode in ["fftw_hilbert", "fftw_hilbert_sign"]:
+            # The transformer (and its FFT plans) is reused for every observation of this shape
+            data_hilb = -get_hilbert_transformer(data.shape)(data)
+            if mode == "fftw_hilbert_sign":
+                return np.sign(data_hilb)
+            return data_hilb
+        raise ValueError(f"Unknown correlator mode {mode}")
 
     def V(self, x, y, yhilb):
         v_real = np.dot(x, y) * 1.0 / float(len(x))
@@ -73,6 +141,41 @@ class Correlator:
         return combine_real_imag(v_real, v_imag)
 
 
+class StreamingCorrelator(Correlator):
+    """
+    A correlator for raw observations that are larger than memory.
+
+    The packed data are read in blocks of block_size samples, and the
+    per-baseline sums are accumulated block by block. Peak memory is bounded
+    by the block size rather than by the length of the capture.
+    """
+
+    def __init__(self, van_vleck_corr=True, block_size=2 ** 20):
+        super().__init__(van_vleck_corr=van_vleck_corr)
+        self.block_size = block_size
+
+    def compute_complex_vis(self, obs, debug=False, mode="packed"):
+        if mode != "packed":
+            raise ValueError(f"The streaming correlator only supports packed data, not {mode}")
+        return self.compute_packed_vis(obs.get_packed_data(), obs.get_num_samples(),
+                                       block_size=self.block_size)
+
+    def correlate_packed(self, packed, n_samples, config, timestamp):
+        """Correlate a (n_ant, n_bytes) packed buffer, for example a np.memmap"""
+        visibilities, baselines = self.compute_packed_vis(packed, n_samples,
+                                                          block_size=self.block_size)
+        vis = visibility.Visibility.from_config(config, timestamp)
+        vis.set_visibilities(visibilities, baselines)
+        return vis
+
+    def correlate_hdf5(self, filename):
+        """Correlate a raw observation HDF5 file without loading the data into memory"""
+        with h5py.File(filename, "r") as h5f:
+            config, timestamp = observation.hdf5_header(h5f)
+            dset = h5f["data"]
+            return self.correlate_packed(dset, observation.hdf5_num_samples(dset),
+                                         config, timestamp)
+
 
 def corr_b(x, y, n):
     # num_not_same = (x ^ y).sum()
@@ -82,6 +185,122 @@ def corr_b(x, y, n):
     return ret
 
 
+def packed_words(packed):
+    '''
+        Return a uint64 view of np.packbits data, zero padding each row
+        to a whole number of 64-bit words. Padding with zeros in every row
+        means the padding never contributes to an XOR.
+    '''
+    packed = np.ascontiguousarray(packed, dtype=np.uint8)
+    n_bytes = packed.shape[-1]
+    pad = (-n_bytes) % 8
+    if pad:
+        pad_width = [(0, 0)] * (packed.ndim - 1) + [(0, pad)]
+        packed = np.pad(packed, pad_width)
+    return packed.view(np.uint64)
+
+
+def packed_roll(packed, n_samples, carry=None):
+    '''
+        Shift packed (np.packbits) data by one sample along the last axis. This is
+        equivalent to np.roll(x, 1, axis=-1) on the unpacked data.
+
+        - packed the packed data (..., n_bytes) as uint8
+        - n_samples the number of valid samples in each row
+        - carry the bit shifted into the first sample. By default the last
+          sample wraps around, as np.roll does.
+    '''
+    packed = np.asarray(packed, dtype=np.uint8)
+    n_bytes = packed.shape[-1]
+    ret = packed >> 1
+    ret[..., 1:] |= packed[..., :-1] << 7
+    if carry is None:
+        last = n_samples - 1
+        carry = (packed[..., last // 8] >> (7 - last % 8)) & 1
+    ret[..., 0] |= np.asarray(carry, dtype=np.uint8) << 7
+
+    pad = n_bytes * 8 - n_samples
+    if pad > 0:
+        ret[..., -1] &= np.uint8((0xFF << pad) & 0xFF)
+    return ret
+
+
+def corr_b_packed(x, y, n):
+    '''
+        The packed equivalent of corr_b(). x and y are np.packbits data
+        of n samples, with zero padding bits.
+    '''
+    num_not_same = np.bitwise_count(packed_words(x) ^ packed_words(y)).sum()
+    ret = 1 - 2 * num_not_same / float(n)
+    return ret
+
+
+def popcount_upper(words_a, words_b):
+    '''
+        Return the (n_ant, n_ant) matrix of popcount(a_i XOR b_j) over uint64
+        words for j > i (the lower triangle is left as zero). This is done one
+        row of a at a time to bound the temporary memory.
+    '''
+    n_ant = words_a.shape[0]
+    ret = np.zeros((n_ant, n_ant), dtype=np.int64)
+    for i in range(n_ant - 1):
+        ret[i, i + 1:] = np.bitwise_count(words_a[i] ^ words_b[i + 1:]).sum(axis=1, dtype=np.int64)
+    return ret
+
+
+def correlate_packed(packed, n_samples, block_size=None):
+    '''
+        Correlate 1-bit antenna data directly from np.packbits bytes using XOR
+        and popcount. No float (or even unpacked) data is created.
+
+        - packed the (n_ant, n_bytes) packed antenna data. Anything that can be
+          sliced as packed[:, start:stop] will do, for example an h5py dataset.
+        - n_samples the number of samples per antenna
+        - block_size if given, the data are processed in blocks of this many
+          samples (rounded down to a multiple of 64), so that peak memory is
+          bounded by the block size rather than the length of the capture.
+
+        Returns the mean-subtracted real and lag-1 (roll) quadrature
+        correlations in the baseline order of imaging.get_baseline_indices().
+        These are identical to those of the "roll" mode of the Correlator.
+    '''
+    n_ant, n_bytes = packed.shape
+    if block_size is None:
+        block_bytes = n_bytes
+    else:
+        block_bytes = max(8, (int(block_size) // 64) * 8)
+
+    # The first sample of the rolled data is the last sample of the capture.
+    last = n_samples - 1
+    carry = (np.asarray(packed[:, last // 8], dtype=np.uint8) >> (7 - last % 8)) & 1
+
+    ones = np.zeros(n_ant, dtype=np.int64)
+    not_same = np.zeros((n_ant, n_ant), dtype=np.int64)
+    not_same_roll = np.zeros((n_ant, n_ant), dtype=np.int64)
+    for start in range(0, n_bytes, block_bytes):
+        block = np.asarray(packed[:, start:start + block_bytes], dtype=np.uint8)
+        n_block = min(block.shape[1] * 8, n_samples - start * 8)
+
+        words = packed_words(block)
+        words_roll = packed_words(packed_roll(block, n_block, carry))
+
+        # The last sample of this block is rolled into the next one.
+        last = n_block - 1
+        carry = (block[:, last // 8] >> (7 - last % 8)) & 1
+
+        ones += np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+        not_same += popcount_upper(words, words)
+        not_same_roll += popcount_upper(words, words_roll)
+
+    means = 2.0 * ones / float(n_samples) - 1.0
+    i_idx, j_idx = np.triu_indices(n_ant, k=1)
+    mean_prod = means[i_idx] * means[j_idx]
+
+    v_real = 1.0 - 2.0 * not_same[i_idx, j_idx] / float(n_samples) - mean_prod
+    v_imag = 1.0 - 2.0 * not_same_roll[i_idx, j_idx] / float(n_samples) - mean_prod
+    return v_real, v_imag
+
+
 def corr_b_pat(x, y):
     n = len(x)
     num_same = (x ^ (1 - y)).sum()
@@ -159,29 +378,107 @@ class FxCorrelator(Correlator):
            c = 3e8 (m s^-1)
            B = baseline (m)
            D = bw (s^-1)
+
+    Each antenna signal is split into blocks of 2*n_freq samples, and every block
+    is Fourier transformed (all antennas at once). The cross spectra of all baselines
+    are accumulated, one matrix product per channel, over the blocks. The FFTs use
+    scipy.fft, which caches its plans, with a pool of worker threads.
     """
 
-    def __init__(self, bandwidth, linewidth):
+    def __init__(self, bandwidth, linewidth, chunk_samples=2 ** 20, workers=-1):
+        super().__init__(van_vleck_corr=False)
         self.bandwidth = bandwidth
         n_log2 = int(np.log(bandwidth / linewidth) / np.log(2.0) + 0.5)
         self.n_freq = 2 ** n_log2
         self.linewidth = bandwidth / self.n_freq
+        self.chunk_samples = chunk_samples
+        self.workers = workers
 
     def get_linewidth(self):
         return self.linewidth
 
-    def correlate(self, obs):
-        data = self.convert_to_baseband(obs)
+    def get_frequencies(self, sampling_rate):
+        """Return the (intermediate) frequency of each channel"""
+        return np.arange(self.n_freq) * sampling_rate / (2.0 * self.n_freq)
+
+    def cross_spectra(self, obs):
+        """
+            Return the (n_freq, n_ant, n_ant) cross power spectra, summed over all the
+            FFT blocks of the observation. Element [f, i, j] is sum X_i(f) X_j^*(f).
+        """
+        from scipy import fft
+
+        num_antenna = obs.config.get_num_antenna()
+        block_len = 2 * self.n_freq
+        n_blocks = obs.get_num_samples() // block_len
+        if n_blocks == 0:
+            raise ValueError(f"Observation is shorter than one FFT block ({block_len} samples)")
+
+        data = np.array([obs.get_antenna(i) for i in range(num_antenna)], dtype=np.float32)
+        data -= np.mean(data, axis=1, keepdims=True)
+
+        blocks_per_chunk = max(1, self.chunk_samples // block_len)
+        ret = np.zeros((self.n_freq, num_antenna, num_antenna), dtype=np.complex128)
+        for b0 in range(0, n_blocks, blocks_per_chunk):
+            b1 = min(n_blocks, b0 + blocks_per_chunk)
+            x = data[:, b0 * block_len:b1 * block_len].reshape(num_antenna, b1 - b0, block_len)
+            spectra = fft.rfft(x, axis=-1, workers=self.workers)[..., :self.n_freq]
+            spectra = np.ascontiguousarray(spectra.transpose(2, 0, 1))  # (n_freq, n_ant, n_blocks)
+            ret += np.matmul(spectra, np.conjugate(np.swapaxes(spectra, -1, -2)))
+        return ret
+
+    def compute_channel_vis(self, obs):
+        """
+            Return the channelised visibility cube (n_freq, n_bl), the baselines, and
+            the channel frequencies. Each visibility is normalised by the auto power of
+            its two antennas in that channel.
+        """
+        xspec = self.cross_spectra(obs)
+        num_antenna = xspec.shape[1]
+        i_idx, j_idx = np.triu_indices(num_antenna, k=1)
+
+        auto = np.real(np.diagonal(xspec, axis1=1, axis2=2))
+        norm = np.sqrt(auto[:, i_idx] * auto[:, j_idx])
+        cube = np.zeros((self.n_freq, len(i_idx)), dtype=np.complex128)
+        np.divide(xspec[:, i_idx, j_idx], norm, out=cube, where=norm > 0)
+
+        baselines = imaging.get_baseline_indices(num_antenna)
+        return cube, baselines, self.get_frequencies(obs.get_sampling_rate())
+
+    def compute_complex_vis(self, obs, debug=False, mode="fx"):
+        """
+            Return the band integrated visibilities and the baselines. Baselines
+            with a dead (zero power) antenna are zero.
+        """
+        xspec = self.cross_spectra(obs).sum(axis=0)
+        i_idx, j_idx = np.triu_indices(xspec.shape[0], k=1)
+        auto = np.real(np.diagonal(xspec))
+        norm = np.sqrt(auto[i_idx] * auto[j_idx])
+        v = np.zeros(len(i_idx), dtype=np.complex128)
+        np.divide(xspec[i_idx, j_idx], norm, out=v, where=norm > 0)
+        return v, imaging.get_baseline_indices(xspec.shape[0])
+
+    def correlate(self, obs, debug=False, mode="fx"):
         vis = visibility.Visibility.from_obs(obs, angle.from_dms(90), angle.from_dms(0))
         visibilities, baselines = self.compute_complex_vis(obs)
         vis.set_visibilities(visibilities, baselines)
         return vis
 
-    """TODO this is not working yet.
-         this should return the maximum field of view possible before fringes get washed
-         out by the bandwidth of the signal."""
+    def correlate_channels(self, obs):
+        """Return a list of (frequency, Visibility) pairs, one for each channel"""
+        cube, baselines, freqs = self.compute_channel_vis(obs)
+        ret = []
+        for f, v in zip(freqs, cube):
+            vis = visibility.Visibility.from_obs(obs, angle.from_dms(90), angle.from_dms(0))
+            vis.set_visibilities(v, baselines)
+            ret.append((f, vis))
+        return ret
 
     def angular_resolution(self, baseline):
+        """
+            Return the maximum angle from the phase center before fringes on this
+            baseline (m) get washed out by the bandwidth of a channel.
+        """
         x = constants.V_LIGHT / (self.linewidth * baseline)
         if x >= 1.0:
             x = 1.0
@@ -0,0 +1,158 @@
+#
+# Direct Fourier transform imaging.
+#
+# With a few hundred baselines the sky can be imaged directly, as a complex
+# matrix product of the per-pixel phase factors (n_pix, n_bl) with the
+# visibilities (n_bl, n_snapshot). There is no gridding error, no zero padding,
+# and the pixels can be any set of directions above the horizon: the square l,m
+# grid of imaging.get_lm_index(), or a HEALPix hemisphere.
+#
+# The phase factors depend only on the baselines and the pixels, so they are
+# computed once (in blocks of pixels, to bound the temporaries) and held in an
+# LRU cache keyed by a hash of both. The cache is bounded by its total size
+# (PHASE_CACHE_BYTES); a phase matrix larger than that is never held, and its
+# phases are computed block by block as each block of pixels is imaged. The
+# brightness is
+#
+#   I(l, m) = (1/N) sum_k Re(V_k exp(2 pi j (u_k l - v_k m - w_k n)))
+#
+# over the N visibilities, with (u, v, w) = pos_i - pos_j in wavelengths and
+# l, m the direction cosines of elaz.ElAz (l = -east, m = north). TART
+# visibilities are not fringe stopped, so a source in the direction s has the
+# phase 2 pi (pos_i - pos_j).s, including the w n term, and a unit point
+# source has unit brightness at its ElAz.get_lm().
+#
+import collections
+import hashlib
+
+import numpy as np
+
+PHASE_CACHE_BYTES = 256 * 2**20
+BLOCK_PIXELS = 4096
+_phase_cache = collections.OrderedDict()
+
+
+def get_lm_grid(num_bin):
+    '''
+        Return the direction cosines (l, m), each (num_bin, num_bin), of the
+        pixels of a square image. Pixels are placed as imaging.get_lm_index(),
+        with l along the second index and m decreasing along the first.
+    '''
+    x0 = num_bin // 2
+    max_index = num_bin - 0.5
+    pix = np.arange(num_bin)
+    l = 2.0 * (pix - x0) / max_index
+    m = -2.0 * (pix - x0) / max_index
+    return np.meshgrid(l, m)
+
+
+def get_healpix_lm(nside):
+    '''
+        Return the HEALPix (RING ordered) pixels of the visible hemisphere for
+        nside, and their direction cosines (l, m). The zenith is the north pole
+        of the HEALPix sphere and phi the azimuth, as api_imaging.make_healpix_image().
+    '''
+    import healpy as hp
+
+    pixels = np.arange(hp.nside2npix(nside))
+    theta, phi = hp.pix2ang(nside, pixels)
+    above = theta < np.pi / 2
+    pixels, theta, phi = pixels[above], theta[above], phi[above]
+    # As elaz.ElAz, with el = 90 - theta, az = phi
+    l = -np.sin(phi) * np.sin(theta)
+    m = np.cos(phi) * np.sin(theta)
+    return pixels, l, m
+
+
+def pixel_key(uvw, l, m):
+    ''' A hash of the baselines (wavelengths) and the pixel directions, used to key the phase cache '''
+    h = hashlib.sha1()
+    for x in [uvw, l, m]:
+        h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def compute_phase_factors(uvw, l, m, block_pixels=BLOCK_PIXELS):
+    '''
+        Return the complex64 (n_pix, n_bl) phase factors
+        exp(2 pi j (u l - v m - w n)) of the (n_bl, 3) baselines uvw
+        (wavelengths) at the pixel directions l, m.
+    '''
+    uvw = np.asarray(uvw, dtype=np.float64)
+    l = np.ravel(l)
+    m = np.ravel(m)
+    n = np.sqrt(np.clip(1.0 - l**2 - m**2, 0.0, None))
+    lmn = np.stack([l, -m, -n], axis=1)
+
+    ret = np.empty((len(l), uvw.shape[0]), dtype=np.complex64)
+    for i in range(0, len(l), block_pixels):
+        phase = 2 * np.pi * (lmn[i:i + block_pixels] @ uvw.T)
+        ret[i:i + block_pixels] = np.exp(1j * phase)
+    ret.setflags(write=False)
+    return ret
+
+
+def phase_factor_nbytes(uvw, l):
+    ''' The size in bytes of the phase factors of the baselines uvw at the pixels l '''
+    return np.size(l) * len(uvw) * np.dtype(np.complex64).itemsize
+
+
+def get_phase_factors(uvw, l, m):
+    '''
+        As compute_phase_factors(), through an in-process LRU cache holding at
+        most PHASE_CACHE_BYTES. Phase factors larger than that are not cached.
+    '''
+    key = pixel_key(uvw, l, m)
+    if key in _phase_cache:
+        _phase_cache.move_to_end(key)
+        return _phase_cache[key]
+    ret = compute_phase_factors(uvw, l, m)
+    if ret.nbytes <= PHASE_CACHE_BYTES:
+        _phase_cache[key] = ret
+        while sum(p.nbytes for p in _phase_cache.values()) > PHASE_CACHE_BYTES:
+            _phase_cache.popitem(last=False)
+    return ret
+
+
+def image_snapshots(uvw_list, vis_list, l, m):
+    '''
+        Return the brightness at the pixel directions l, m (flattened) of a
+        list of snapshots, each with its own (n_bl, 3) baselines uvw (wavelengths)
+        and (n_bl,) visibilities. Snapshots sharing their baselines are imaged
+        together, as one matrix product.
+    '''
+    groups = collections.OrderedDict()
+    for uvw, vis in zip(uvw_list, vis_list):
+        key = hashlib.sha1(np.ascontiguousarray(uvw, dtype=np.float64).tobytes()).hexdigest()
+        groups.setdefault(key, (uvw, []))[1].append(vis)
+
+    ret = np.zeros(np.size(l))
+    n_vis = 0
+    for uvw, vis in groups.values():
+        vis = np.stack(vis, axis=1)
+        ret += image(uvw, vis, l, m) * vis.size
+        n_vis += vis.size
+    return ret / max(n_vis, 1)
+
+
+def image(uvw, vis, l, m, block_pixels=BLOCK_PIXELS):
+    '''
+        Return the brightness at the pixel directions l, m (flattened) of the
+        visibilities vis, (n_bl,) or (n_bl, n_snapshot), on the (n_bl, 3)
+        baselines uvw (wavelengths). Snapshots are summed.
+    '''
+    vis = np.asarray(vis, dtype=np.complex64).reshape(len(uvw), -1)
+    l = np.ravel(l)
+    m = np.ravel(m)
+    cached = phase_factor_nbytes(uvw, l) <= PHASE_CACHE_BYTES
+    if cached:
+        phase = get_phase_factors(uvw, l, m)
+    ret = np.empty(len(l))
+    for i in range(0, len(l), block_pixels):
+        block = slice(i, i + block_pixels)
+        if cached:
+            phase_block = phase[block]
+        else:
+            phase_block = compute_phase_factors(uvw, l[block], m[block], block_pixels)
+        ret[block] = (phase_block @ vis).real.sum(axis=1)
+    return ret / vis.size
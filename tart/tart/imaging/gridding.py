@@ -0,0 +1,399 @@
+#
+# Gridding of visibilities onto the uv-plane.
+#
+# The uv-plane is a (num_bin, num_bin) grid of cells covering -nw..nw
+# wavelengths in u (second index) and v (first index), with the same cell
+# edges as np.histogram2d. Each visibility, and its conjugate at (-u, -v),
+# is placed in its cell, and cells are averaged.
+#
+# The flat cell indices of a set of baselines are computed once and cached
+# (keyed by a hash of the uv coordinates and the grid), so the snapshots of a
+# time series that share their uvw do not repeat the binning. The indices can
+# also be kept on disk, in a directory of .npz files named by the same hash,
+# so a stored index can never be stale.
+#
+# Convolutional gridding spreads each visibility over the cells within
+# r_pixels of it with a Kaiser-Bessel kernel, looked up in an oversampled
+# table. The image must then be divided by the grid correction (the Fourier
+# transform of the kernel). Here u = 0 is the centre of cell num_bin // 2,
+# the origin of the FFT after ifftshift. Nearest-cell gridding averages the
+# entries of each cell, so its flux scale is set by the number of occupied
+# cells; the kernel weights are scaled (kernel_scale) to sum to that number,
+# so a point source has the same brightness whether or not the kernel is used.
+#
+# As the sky is real, a real image needs only the half-plane u >= 0, in FFT
+# order: a (num_bin, num_bin // 2 + 1) plane whose cell [kv, ku] holds the
+# frequency (kv, ku) (kv modulo num_bin), ready for irfft2 without ifftshift.
+# Cell num_bin // 2 of the full plane is the frequency 0, as for the ifftshift
+# of the full plane. The real part of the image of a full plane P is the image
+# of its Hermitian part (P(k) + conj(P(-k))) / 2, so the half-plane holds that.
+# With the histogram cells a visibility and its conjugate are not in mirrored
+# cells, so each entry of the full plane is gridded twice, at its cell and
+# (conjugated) at the mirror of its cell, with half its averaging weight.
+#
+import collections
+import functools
+import hashlib
+import os
+
+import numpy as np
+
+INDEX_CACHE_SIZE = 32
+_index_cache = collections.OrderedDict()
+
+KERNEL_OVERSAMPLE = 128
+KERNEL_ALPHA = 2.0    # The grid oversampling factor assumed for the kernel shape
+
+
+def get_edges(num_bin, nw):
+    ''' The cell edges of the uv-plane (wavelengths) '''
+    return np.linspace(-nw, nw, num_bin + 1)
+
+
+def uv_key(uu, vv, num_bin, nw):
+    ''' A hash of the uv coordinates and the grid, used to key the index caches '''
+    h = hashlib.sha1(np.ascontiguousarray(uu, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(vv, dtype=np.float64).tobytes())
+    h.update(repr((int(num_bin), float(nw))).encode())
+    return h.hexdigest()
+
+
+def cell_index(x, edges):
+    '''
+        Return the cell of each x, with the semantics of np.histogram2d (the
+        last edge belongs to the last cell). Values outside the edges give -1.
+    '''
+    num_bin = len(edges) - 1
+    idx = np.searchsorted(edges, x, side="right") - 1
+    idx[x == edges[-1]] = num_bin - 1
+    idx[(x < edges[0]) | (x > edges[-1])] = -1
+    return idx
+
+
+def compute_grid_indices(uu, vv, num_bin, nw):
+    '''
+        Return the flat (v, u) cell indices into a (num_bin, num_bin) plane of
+        the visibilities at (uu, vv) followed by their conjugates at (-uu, -vv).
+        Visibilities outside the plane have index -1.
+    '''
+    edges = get_edges(num_bin, nw)
+    uu = np.asarray(uu, dtype=np.float64)
+    vv = np.asarray(vv, dtype=np.float64)
+    i_u = cell_index(np.concatenate((uu, -uu)), edges)
+    i_v = cell_index(np.concatenate((vv, -vv)), edges)
+    ret = i_v * num_bin + i_u
+    ret[(i_u < 0) | (i_v < 0)] = -1
+    return ret
+
+
+def _cached(key, compute):
+    if key in _index_cache:
+        _index_cache.move_to_end(key)
+        return _index_cache[key]
+    ret = compute()
+    _index_cache[key] = ret
+    while len(_index_cache) > INDEX_CACHE_SIZE:
+        _index_cache.popitem(last=False)
+    return ret
+
+
+def get_index_file(cache_dir, key):
+    ''' The content-addressed file of the grid indices with this key '''
+    return os.path.join(cache_dir, f"grid_{key}.npz")
+
+
+def load_grid_indices(cache_dir, key):
+    ''' Load stored grid indices, or return None if there are none '''
+    try:
+        with np.load(get_index_file(cache_dir, key)) as f:
+            return f["idx"]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_grid_indices(cache_dir, key, idx):
+    ''' Store grid indices. The file is written under a temporary name and renamed into place '''
+    fname = get_index_file(cache_dir, key)
+    tmp = f"{fname}.{os.getpid()}.tmp.npz"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(tmp, idx=idx)
+        os.replace(tmp, fname)
+    except OSError:
+        print(f"could not save grid indices to {cache_dir}")
+
+
+def get_grid_indices(uu, vv, num_bin, nw, cache_dir=None):
+    '''
+        As compute_grid_indices(), through an in-process LRU cache. If
+        cache_dir is given, indices missing from the LRU cache are looked up
+        in (and added to) the .npz files of that directory.
+    '''
+    key = uv_key(uu, vv, num_bin, nw)
+
+    def compute():
+        idx = None if cache_dir is None else load_grid_indices(cache_dir, key)
+        if idx is None:
+            idx = compute_grid_indices(uu, vv, num_bin, nw)
+            if cache_dir is not None:
+                save_grid_indices(cache_dir, key, idx)
+        return idx
+
+    return _cached(key, compute)
+
+
+def kernel_support(r_pixels):
+    ''' The number of cells (in each direction) a kernel of radius r_pixels spans '''
+    return 2 * int(np.ceil(r_pixels - 0.5)) + 1
+
+
+@functools.lru_cache(maxsize=16)
+def get_kernel_table(r_pixels, oversample=KERNEL_OVERSAMPLE):
+    '''
+        Return the Kaiser-Bessel kernel of radius r_pixels, sampled every
+        1/oversample cells from -r_pixels to r_pixels, normalised so that it
+        sums to one over the cells it spans. The beta parameter follows
+        Beatty, Nishimura and Pauly (2005) for a width of 2 r_pixels cells.
+    '''
+    width = 2.0 * r_pixels
+    beta = np.pi * np.sqrt(max((width / KERNEL_ALPHA)**2 * (KERNEL_ALPHA - 0.5)**2 - 0.8, 0.0))
+    n = int(np.round(r_pixels * oversample))
+    x = np.arange(-n, n + 1) / oversample
+    ret = np.i0(beta * np.sqrt(np.clip(1.0 - (x / r_pixels)**2, 0.0, None))) / np.i0(beta)
+    ret /= ret.sum() / oversample
+    ret.setflags(write=False)
+    return ret
+
+
+@functools.lru_cache(maxsize=16)
+def get_grid_correction(r_pixels, num_bin, oversample=KERNEL_OVERSAMPLE):
+    '''
+        Return the (num_bin, num_bin) grid correction of the kernel: its
+        Fourier transform at each pixel of the fftshift-ed image. Divide the
+        image by this to undo the taper of convolutional gridding.
+    '''
+    table = get_kernel_table(r_pixels, oversample)
+    n = (len(table) - 1) // 2
+    x = np.arange(-n, n + 1) / oversample
+    p = np.arange(num_bin) - num_bin // 2
+    c = (table[np.newaxis, :] * np.cos(2 * np.pi * np.outer(p, x) / num_bin)).sum(axis=1) / oversample
+    ret = np.outer(c, c)
+    ret.setflags(write=False)
+    return ret
+
+
+def compute_kernel_weights(uu, vv, num_bin, nw, r_pixels):
+    '''
+        Return the flat cell indices and kernel weights, both (2 n_vis, n_sup**2),
+        of the visibilities at (uu, vv) followed by their conjugates at
+        (-uu, -vv). Cells outside the plane have index -1.
+    '''
+    table = get_kernel_table(r_pixels)
+    n_half = (len(table) - 1) // 2
+    half = kernel_support(r_pixels) // 2
+    offsets = np.arange(-half, half + 1)
+
+    du = 2.0 * nw / num_bin
+    uu = np.asarray(uu, dtype=np.float64)
+    vv = np.asarray(vv, dtype=np.float64)
+    pu = np.concatenate((uu, -uu)) / du + num_bin // 2
+    pv = np.concatenate((vv, -vv)) / du + num_bin // 2
+
+    def axis(p):
+        cells = np.round(p).astype(np.int64)[:, np.newaxis] + offsets
+        t = np.round((cells - p[:, np.newaxis]) * KERNEL_OVERSAMPLE).astype(np.int64)
+        inside = np.abs(t) <= n_half
+        w = np.where(inside, table[np.clip(t + n_half, 0, 2 * n_half)], 0.0)
+        valid = (cells >= 0) & (cells < num_bin)
+        return cells, w, valid
+
+    c_u, w_u, ok_u = axis(pu)
+    c_v, w_v, ok_v = axis(pv)
+    idx = (c_v[:, :, np.newaxis] * num_bin + c_u[:, np.newaxis, :])
+    weights = w_v[:, :, np.newaxis] * w_u[:, np.newaxis, :]
+    valid = ok_v[:, :, np.newaxis] & ok_u[:, np.newaxis, :]
+    idx[~valid] = -1
+    n = len(pu)
+    return idx.reshape(n, -1), weights.reshape(n, -1)
+
+
+def get_kernel_weights(uu, vv, num_bin, nw, r_pixels):
+    ''' As compute_kernel_weights(), through the in-process LRU cache '''
+    key = (uv_key(uu, vv, num_bin, nw), float(r_pixels))
+    return _cached(key, lambda: compute_kernel_weights(uu, vv, num_bin, nw, r_pixels))
+
+
+def kernel_scale(idx, weights, grid_idx):
+    '''
+        Return the factor scaling the kernel weights (with full-plane cell
+        indices idx, as get_kernel_weights) so that they sum to the number of
+        cells occupied by nearest-cell gridding (with the cell indices
+        grid_idx, as get_grid_indices). Gridded with the scaled weights, a
+        point source has the brightness of the accumulate() image.
+    '''
+    total = weights[idx >= 0].sum()
+    if total <= 0:
+        return 1.0
+    return len(np.unique(grid_idx[grid_idx >= 0])) / total
+
+
+def to_half_plane(idx, num_bin):
+    '''
+        Map flat indices into a (num_bin, num_bin) plane centred on cell
+        num_bin // 2 to flat indices into the (num_bin, num_bin // 2 + 1)
+        half-plane in FFT order. Cells with u < 0 (other than the Nyquist
+        column) map to -1.
+    '''
+    idx = np.asarray(idx)
+    half = num_bin // 2
+    k_v = (idx // num_bin - half) % num_bin
+    k_u = idx % num_bin - half
+    if num_bin % 2 == 0:
+        k_u[k_u == -half] = half      # The Nyquist column
+    ret = k_v * (half + 1) + k_u
+    ret[(idx < 0) | (k_u < 0)] = -1
+    return ret
+
+
+def shift_signs(idx, num_bin):
+    '''
+        Return the factors (-1)^(kv + ku) of flat half-plane indices. Applied
+        to the values gridded there, they fftshift the image of irfft2 (for
+        an even num_bin), so the shift costs nothing.
+    '''
+    k_v, k_u = np.divmod(idx, num_bin // 2 + 1)
+    return 1 - 2 * ((k_v + k_u) & 1)
+
+
+def mirror_indices(idx, num_bin):
+    '''
+        Map flat indices into a (num_bin, num_bin) plane centred on cell
+        num_bin // 2 to the indices of the cells of the negated frequencies
+        (modulo num_bin, as the FFT). -1 stays -1.
+    '''
+    idx = np.asarray(idx)
+    half = num_bin // 2
+    c_v, c_u = np.divmod(idx, num_bin)
+    ret = ((2 * half - c_v) % num_bin) * num_bin + (2 * half - c_u) % num_bin
+    ret[idx < 0] = -1
+    return ret
+
+
+def compute_half_plane_indices(uu, vv, num_bin, nw):
+    '''
+        Return the (2, 2 n_vis) flat half-plane indices (see to_half_plane) of
+        the cells of the visibilities at (uu, vv) and their conjugates, as
+        get_grid_indices(), and of the mirrors of those cells.
+    '''
+    idx = get_grid_indices(uu, vv, num_bin, nw)
+    return np.stack((to_half_plane(idx, num_bin),
+                     to_half_plane(mirror_indices(idx, num_bin), num_bin)))
+
+
+def get_half_plane_indices(uu, vv, num_bin, nw):
+    ''' As compute_half_plane_indices(), through the in-process LRU cache '''
+    key = (uv_key(uu, vv, num_bin, nw), "half")
+    return _cached(key, lambda: compute_half_plane_indices(uu, vv, num_bin, nw))
+
+
+def accumulate_half_plane(idx, half_idx, values, num_bin, shift=False):
+    '''
+        Accumulate complex values onto the (num_bin, num_bin // 2 + 1) half-plane,
+        given their flat full-plane cell indices idx (-1 values are dropped) and
+        the (2, n) half-plane indices of those cells and of their mirrors (see
+        compute_half_plane_indices). The half-plane holds the Hermitian part of
+        the plane of accumulate(idx, values, num_bin), so the irfft2 of one is
+        the real part of the ifft2 of the other. With shift, each entry is
+        multiplied by its shift_signs().
+
+        Returns the complex64 half-plane.
+    '''
+    idx = np.asarray(idx)
+    values = np.asarray(values)
+    _, inverse, counts = np.unique(idx, return_inverse=True, return_counts=True)
+    half_idx = np.ravel(half_idx)
+    weights = np.tile(0.5 / counts[inverse.ravel()], 2)
+    if shift:
+        weights = weights * shift_signs(half_idx, num_bin)
+    return accumulate_weighted(half_idx[:, np.newaxis], weights[:, np.newaxis],
+                               np.concatenate((values, np.conjugate(values))), num_bin,
+                               (num_bin, num_bin // 2 + 1))[0]
+
+
+def get_half_plane_kernel_weights(uu, vv, num_bin, nw, r_pixels):
+    ''' As get_kernel_weights(), with the indices mapped to the half-plane (see to_half_plane) '''
+    def compute():
+        idx, weights = get_kernel_weights(uu, vv, num_bin, nw, r_pixels)
+        return to_half_plane(idx, num_bin), weights
+
+    key = (uv_key(uu, vv, num_bin, nw), float(r_pixels), "half")
+    return _cached(key, compute)
+
+
+def accumulate(idx, values, num_bin, shape=None):
+    '''
+        Accumulate complex values into a (num_bin, num_bin) uv-plane (or a
+        plane of the given shape) in one pass, given their flat cell indices
+        (-1 values are dropped). Cells with several entries are averaged.
+
+        Returns the complex64 uv-plane and the number of entries in each cell.
+    '''
+    valid = idx >= 0
+    idx = idx[valid]
+    values = np.asarray(values)[valid]
+
+    if shape is None:
+        shape = (num_bin, num_bin)
+    n_cells = shape[0] * shape[1]
+    num_entries = np.bincount(idx, minlength=n_cells)
+    plane = (np.bincount(idx, weights=values.real, minlength=n_cells) +
+             1j * np.bincount(idx, weights=values.imag, minlength=n_cells))
+    pos = num_entries > 1
+    plane[pos] /= num_entries[pos]
+    return (plane.reshape(shape).astype(np.complex64),
+            num_entries.reshape(shape))
+
+
+def accumulate_weighted(idx, weights, values, num_bin, shape=None):
+    '''
+        Convolve complex values onto a (num_bin, num_bin) uv-plane (or a plane
+        of the given shape), given the (n, n_sup**2) cell indices and kernel
+        weights of each value. The weighted values are summed (see kernel_scale).
+
+        Returns the complex64 uv-plane and the sum of the weights in each cell.
+    '''
+    values = np.asarray(values)
+    valid = idx >= 0
+    w = weights[valid]
+    flat = idx[valid]
+    v = np.broadcast_to(values[:, np.newaxis], idx.shape)[valid]
+
+    if shape is None:
+        shape = (num_bin, num_bin)
+    n_cells = shape[0] * shape[1]
+    weight_sum = np.bincount(flat, weights=w, minlength=n_cells)
+    plane = (np.bincount(flat, weights=w * v.real, minlength=n_cells) +
+             1j * np.bincount(flat, weights=w * v.imag, minlength=n_cells))
+    return (plane.reshape(shape).astype(np.complex64),
+            weight_sum.reshape(shape))
+
+
+def grid(uu, vv, vis, num_bin, nw, grid_kernel_r_pixels=0.5):
+    '''
+        Grid visibilities at (uu, vv) wavelengths, and their conjugates, onto a
+        (num_bin, num_bin) uv-plane. If grid_kernel_r_pixels > 0.5 the
+        visibilities are convolved with a Kaiser-Bessel kernel of that radius,
+        with the weights scaled by kernel_scale(), and the image must be
+        divided by get_grid_correction(). Otherwise each is placed in its
+        nearest cell.
+
+        Returns the uv-plane and the number (or kernel weight) of entries in each cell.
+    '''
+    vis = np.asarray(vis)
+    values = np.concatenate((vis, np.conjugate(vis)))
+    if grid_kernel_r_pixels > 0.5:
+        idx, weights = get_kernel_weights(uu, vv, num_bin, nw, grid_kernel_r_pixels)
+        weights = weights * kernel_scale(idx, weights, get_grid_indices(uu, vv, num_bin, nw))
+        return accumulate_weighted(idx, weights, values, num_bin)
+    idx = get_grid_indices(uu, vv, num_bin, nw)
+    return accumulate(idx, values, num_bin)
@@ -2,7 +2,6 @@
 import numpy as np
 
 from tart.imaging import synthesis
-from tart.operation import settings
 
 # Following for simulation only
 from tart.util import angle
@@ -110,19 +109,23 @@ def rotate_vis(rot_degrees, cv, reference_positions):
     '''
         Note. This rotates counter_clockwise
         (antennas in the north move towards the east)
-    '''
-    conf = cv.vis.config
 
-    new_positions = settings.rotate_location(
-        rot_degrees, np.array(reference_positions).T
-    )
-    conf.set_antenna_positions((np.array(new_positions).T).tolist())
+        The config of cv.vis is updated with the rotated positions, and the
+        uvw are rotated analytically from the cached baselines of cv (see
+        CalibratedVisibility.set_rotation), so it is cheap to call inside
+        calibration loops.
+    '''
+    cv.set_rotation(rot_degrees, reference_positions)
 
 
-def image_from_calibrated_vis(cv, nw, num_bin):
+def image_from_calibrated_vis(cv, nw, num_bin, use_rfft=False, workers=None):
+    ''' With use_rfft the (real) image is made from the Hermitian half-plane, see Synthesis_Imaging.get_rift '''
     cal_syn = synthesis.Synthesis_Imaging([cv])
 
-    cal_ift, cal_extent = cal_syn.get_ift(nw=nw, num_bin=num_bin)
+    if use_rfft:
+        cal_ift, cal_extent = cal_syn.get_rift(nw=nw, num_bin=num_bin, workers=workers)
+    else:
+        cal_ift, cal_extent = cal_syn.get_ift(nw=nw, num_bin=num_bin)
     # beam = cal_syn.get_beam(nw=nw, num_bin=num_bin, use_kernel=False)
     n_fft = len(cal_ift)
     assert n_fft == num_bin
@@ -1,134 +1,293 @@
-import pickle
+import os
 
 import numpy as np
 
 # import pyfftw.interfaces.numpy_fft as fft
 from numpy import fft
 
-from tart.imaging import location, radio_source
+from tart.imaging import dft, gridding, location, radio_source
 from tart.simulation import antennas
 from tart.util import angle, constants
 
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
 cc = np.concatenate
 
 
+DEFAULT_KERNEL_R_PIXELS = 3.5
+
+
 def get_max_ang(nw, num_bin):
     ret = np.degrees(num_bin / (4.0 * nw))
     return ret
 
 
+def irfft2(half_plane, num_bin, workers=None):
+    """
+    Return the real (num_bin, num_bin) image of a Hermitian half-plane in FFT
+    order, using scipy.fft (with workers threads) if it is available.
+    """
+    if scipy_fft is not None:
+        return scipy_fft.irfft2(half_plane, s=(num_bin, num_bin), workers=workers)
+    return np.fft.irfft2(half_plane, s=(num_bin, num_bin))
+
+
 class Synthesis_Imaging:
     def __init__(self, cal_vis_list):
         self.cal_vis_list = cal_vis_list
         self.phase_center = None
-        self.grid_file = "grid.idx"
-        self.grid_idx = None
+        self.grid_cache_dir = None
+
+    def set_grid_cache_dir(self, cache_dir):
+        """
+        Keep the grid indices in cache_dir (as .npz files named by a hash of
+        the uvw and the grid) as well as in the in-process cache.
+        """
+        self.grid_cache_dir = cache_dir
 
     def set_grid_file(self, fpath):
-        self.grid_file = fpath
+        """ Deprecated: the grid indices are stored in the directory of fpath """
+        self.set_grid_cache_dir(os.path.dirname(os.path.abspath(fpath)))
 
     def get_uuvvwwvis_zenith(self):
-        vis_l = []
-        # for cal_vis in copy.deepcopy(self.cal_vis_list[:1]):
-        for cal_vis in self.cal_vis_list[:1]:
-            ant_p = np.array(cal_vis.get_config().get_antenna_positions())
-            bls = cal_vis.get_baselines()
-            pos_pairs = ant_p[np.array(bls)]
-            uu_a, vv_a, ww_a = (
-                pos_pairs[:, 0] - pos_pairs[:, 1]
-            ).T / constants.L1_WAVELENGTH
-            for bl in bls:
-                ant_i, ant_j = bl
-                vis_l.append(cal_vis.get_visibility(ant_i, ant_j))
-        return uu_a, vv_a, ww_a, np.array(vis_l)
+        cal_vis = self.cal_vis_list[0]
+        uu_a, vv_a, ww_a = cal_vis.get_all_uvw()
+        vis_l, bls = cal_vis.get_all_visibility()
+        return (uu_a / constants.L1_WAVELENGTH, vv_a / constants.L1_WAVELENGTH,
+                ww_a / constants.L1_WAVELENGTH, vis_l)
+
+    def get_grid_flat_idxs(self, uu_a, vv_a, num_bin, nw):
+        """
+        Return the flat cell indices of the baselines (uu_a, vv_a) followed by
+        their conjugates (see gridding.compute_grid_indices). These are cached
+        by a hash of the uv coordinates and the grid.
+        """
+        return gridding.get_grid_indices(uu_a, vv_a, num_bin, nw,
+                                         cache_dir=self.grid_cache_dir)
 
     def get_grid_idxs(self, uu_a, vv_a, num_bin, nw):
-        try:
-            if self.grid_idx is None:
-                self.grid_idx = pickle.load(open(self.grid_file, "rb"))
-                # print('finished loading ' + self.grid_file)
-        except:
-            print("generating...")
-            uu_edges = np.linspace(-nw, nw, num_bin + 1)
-            vv_edges = np.linspace(-nw, nw, num_bin + 1)
-            grid_idx = []
-            for uu, vv in zip(uu_a, vv_a):
-                i = uu_edges.__lt__(uu).sum() - 1
-                j = vv_edges.__lt__(vv).sum() - 1
-                i2 = uu_edges.__lt__(-uu).sum() - 1
-                j2 = vv_edges.__lt__(-vv).sum() - 1
-                grid_idx.append([i, j, i2, j2])
-            self.grid_idx = np.array(grid_idx)
-            save_ptr = open(self.grid_file, "wb")
-            pickle.dump(self.grid_idx, save_ptr, pickle.HIGHEST_PROTOCOL)
-            save_ptr.close()
-        return self.grid_idx
+        """
+        Return the (n_bl, 4) cell indices [u, v, -u, -v] of each baseline and
+        its conjugate (-1 outside the grid).
+        """
+        idx = self.get_grid_flat_idxs(uu_a, vv_a, num_bin, nw)
+        i_u = np.where(idx < 0, -1, idx % num_bin)
+        i_v = np.where(idx < 0, -1, idx // num_bin)
+        n = len(idx) // 2
+        return np.stack([i_u[:n], i_v[:n], i_u[n:], i_v[n:]], axis=1)
 
     def get_uvplane_zenith(self, num_bin=1600, nw=36):
         uu_a, vv_a, ww_a, vis_l = self.get_uuvvwwvis_zenith()
-        arr = np.zeros((num_bin, num_bin), dtype=np.complex64)
-        # place complex visibilities in the UV grid and prepare averaging by counting entries.
-        grid_idxs = self.get_grid_idxs(uu_a, vv_a, num_bin, nw)
-        count_arr = np.zeros((num_bin, num_bin), dtype=np.int16)
-
-        arr[grid_idxs[:, 1], grid_idxs[:, 0]] = vis_l
-        arr[grid_idxs[:, 3], grid_idxs[:, 2]] = np.conjugate(vis_l)
-        n_arr = np.ma.masked_array(arr[:, :], count_arr.__lt__(1.0))
+        idx = self.get_grid_flat_idxs(uu_a, vv_a, num_bin, nw)
+        arr, num_entries = gridding.accumulate(idx, np.concatenate((vis_l, np.conjugate(vis_l))),
+                                               num_bin)
+        n_arr = np.ma.masked_array(arr, num_entries.__lt__(1))
         return n_arr
 
+    def get_kernel_weights(self, num_bin, nw, grid_kernel_r_pixels, half=False):
+        """
+        Return lists of the kernel cell indices and weights of the visibilities
+        (and their conjugates) of each snapshot. The weights are scaled by
+        gridding.kernel_scale(), so the kernel images have the flux scale of
+        the nearest-cell images. With half, the indices are into the half-plane
+        (see gridding.to_half_plane).
+        """
+        idx_list = []
+        full_idx_list = []
+        weight_list = []
+        grid_idx_list = []
+        for cal_vis in self.cal_vis_list:
+            uu_a, vv_a, ww_a = cal_vis.get_all_uvw()
+            uu_a = uu_a / constants.L1_WAVELENGTH
+            vv_a = vv_a / constants.L1_WAVELENGTH
+            idx, weights = gridding.get_kernel_weights(uu_a, vv_a, num_bin, nw,
+                                                       grid_kernel_r_pixels)
+            full_idx_list.append(idx)
+            weight_list.append(weights)
+            grid_idx_list.append(self.get_grid_flat_idxs(uu_a, vv_a, num_bin, nw))
+            if half:
+                idx, _ = gridding.get_half_plane_kernel_weights(uu_a, vv_a, num_bin, nw,
+                                                                grid_kernel_r_pixels)
+            idx_list.append(idx)
+        scale = gridding.kernel_scale(cc(full_idx_list), cc(weight_list), cc(grid_idx_list))
+        return idx_list, [w * scale for w in weight_list]
+
     def get_uvplane(self, num_bin=1600, nw=36, grid_kernel_r_pixels=0.5):
-        uu_list = []
-        vv_list = []
+        """
+        Grid the visibilities onto the uv-plane. If grid_kernel_r_pixels > 0.5
+        they are convolved with a Kaiser-Bessel kernel of that radius (in
+        cells), otherwise each is placed in its nearest cell. Either way a
+        point source has the same brightness in the image.
+        """
+        use_kernel = grid_kernel_r_pixels > 0.5
+        idx_list = []
+        weight_list = []
         vis_list_ = []
+        if use_kernel:
+            idx_list, weight_list = self.get_kernel_weights(num_bin, nw, grid_kernel_r_pixels)
         for cal_vis in self.cal_vis_list:
             uu_a, vv_a, ww_a = cal_vis.get_all_uvw()
-            uu_list.append(uu_a / constants.L1_WAVELENGTH)
-            vv_list.append(vv_a / constants.L1_WAVELENGTH)
             vis_l, bls = cal_vis.get_all_visibility()
+            uu_a = uu_a / constants.L1_WAVELENGTH
+            vv_a = vv_a / constants.L1_WAVELENGTH
+            # The cell indices are cached, so snapshots sharing their uvw are binned once.
+            if not use_kernel:
+                idx_list.append(self.get_grid_flat_idxs(uu_a, vv_a, num_bin, nw))
             vis_list_.append(vis_l)
+            vis_list_.append(np.conjugate(vis_l))
 
-        uu_a = np.concatenate(uu_list)
-        vv_a = np.concatenate(vv_list)
-        vis_l = np.concatenate(vis_list_)
-
-        uu_edges = np.linspace(-nw, nw, num_bin + 1)
-        vv_edges = np.linspace(-nw, nw, num_bin + 1)
+        uu_edges = gridding.get_edges(num_bin, nw)
+        vv_edges = gridding.get_edges(num_bin, nw)
 
         # TODO: Throw an exception if the UV-plant does not have sufficient
         # resolution to manage the baselines.
 
-        n_arr = np.zeros((num_bin, num_bin), dtype=np.complex64)
-        uu_comb = np.concatenate((uu_a, -uu_a))
-        vv_comb = np.concatenate((vv_a, -vv_a))
-        all_v = np.concatenate((vis_l, np.conjugate(vis_l)))
-        h_real, _, _ = np.histogram2d(
-            vv_comb, uu_comb, weights=all_v.real, bins=[vv_edges, uu_edges]
-        )
-        h_imag, _, _ = np.histogram2d(
-            vv_comb, uu_comb, weights=all_v.imag, bins=[vv_edges, uu_edges]
-        )
-        num_entries, _, _ = np.histogram2d(
-            vv_comb, uu_comb, bins=[vv_edges, uu_edges]
-        )
-        n_arr[:, :] = h_real + (1j * h_imag)
-        pos = np.where(num_entries.__gt__(1))
-        n_arr[pos] /= num_entries[pos]
+        if use_kernel:
+            n_arr, weight_sum = gridding.accumulate_weighted(np.concatenate(idx_list),
+                                                             np.concatenate(weight_list),
+                                                             np.concatenate(vis_list_), num_bin)
+        else:
+            n_arr, num_entries = gridding.accumulate(np.concatenate(idx_list),
+                                                     np.concatenate(vis_list_), num_bin)
 
         return (n_arr, uu_edges, vv_edges)
 
-    def get_ift(self, nw=30, num_bin=2 ** 7):
+    def get_uvplane_half(self, num_bin=1600, nw=36, grid_kernel_r_pixels=0.5, shift=False):
+        """
+        Grid the visibilities onto the Hermitian half-plane u >= 0, in FFT
+        order (see gridding.to_half_plane). This is a (num_bin, num_bin // 2 + 1)
+        plane, ready for irfft2, holding the Hermitian part of the plane of
+        get_uvplane() (with the same cells, and the kernel used as there).
+
+        With shift (and an even num_bin) each cell is multiplied by
+        (-1)^(kv + ku), so the image from irfft2 is already fftshift-ed.
+        """
+        use_kernel = grid_kernel_r_pixels > 0.5
+        shift = shift and num_bin % 2 == 0
+        idx_list = []
+        full_idx_list = []
+        weight_list = []
+        vis_list_ = []
+        if use_kernel:
+            idx_list, weight_list = self.get_kernel_weights(num_bin, nw, grid_kernel_r_pixels,
+                                                            half=True)
+            if shift:
+                weight_list = [w * gridding.shift_signs(idx, num_bin)
+                               for idx, w in zip(idx_list, weight_list)]
+        for cal_vis in self.cal_vis_list:
+            uu_a, vv_a, ww_a = cal_vis.get_all_uvw()
+            vis_l, bls = cal_vis.get_all_visibility()
+            uu_a = uu_a / constants.L1_WAVELENGTH
+            vv_a = vv_a / constants.L1_WAVELENGTH
+            if use_kernel:
+                vis_list_ += [vis_l, np.conjugate(vis_l)]
+            else:
+                full_idx_list.append(gridding.get_grid_indices(uu_a, vv_a, num_bin, nw))
+                idx_list.append(gridding.get_half_plane_indices(uu_a, vv_a, num_bin, nw))
+                vis_list_.append(np.concatenate((vis_l, np.conjugate(vis_l))))
+
+        shape = (num_bin, num_bin // 2 + 1)
+        if use_kernel:
+            half_plane, _ = gridding.accumulate_weighted(np.concatenate(idx_list),
+                                                         np.concatenate(weight_list),
+                                                         np.concatenate(vis_list_), num_bin, shape)
+        else:
+            half_plane = gridding.accumulate_half_plane(np.concatenate(full_idx_list),
+                                                        np.concatenate(idx_list, axis=1),
+                                                        np.concatenate(vis_list_), num_bin, shift)
+        return half_plane
+
+    def get_rift(self, nw=30, num_bin=2 ** 7, grid_kernel_r_pixels=0.5, workers=None):
+        """
+        As get_ift(), but the sky is imaged with a real inverse FFT of the
+        Hermitian half-plane (see get_uvplane_half), which needs half the
+        memory and about half the time. The image is the real part of the
+        image of get_ift(). workers is the
+        number of threads used by scipy.fft (if it is installed).
+        """
+        # The fftshift of the image is folded into the gridding, as a sign per cell
+        half_plane = self.get_uvplane_half(num_bin=num_bin, nw=nw,
+                                           grid_kernel_r_pixels=grid_kernel_r_pixels,
+                                           shift=True)
+        img = irfft2(half_plane, num_bin, workers=workers)
+        if num_bin % 2 == 1:
+            img = np.fft.fftshift(img)
+        if grid_kernel_r_pixels > 0.5:
+            img = img / gridding.get_grid_correction(grid_kernel_r_pixels, num_bin)
+        maxang = get_max_ang(nw, num_bin)
+        extent = [maxang, -maxang, -maxang, maxang]
+        return [img, extent]
+
+    def get_ift(self, nw=30, num_bin=2 ** 7, grid_kernel_r_pixels=0.5):
         uv_plane, uu_edges, vv_edges = self.get_uvplane(
-            num_bin=num_bin, nw=nw)
+            num_bin=num_bin, nw=nw, grid_kernel_r_pixels=grid_kernel_r_pixels)
         ift = np.fft.fftshift(fft.ifft2(np.fft.ifftshift(uv_plane)))
+        if grid_kernel_r_pixels > 0.5:
+            ift = ift / gridding.get_grid_correction(grid_kernel_r_pixels, num_bin)
         maxang = get_max_ang(nw, num_bin)
         extent = [maxang, -maxang, -maxang, maxang]
         return [ift, extent]
 
-    def get_beam(self, nw=30, num_bin=2 ** 7):
-        uv_plane, uu_edges, vv_edges = self.get_uvplane(
-            num_bin=num_bin, nw=nw)
-        ift = np.fft.ifftshift(fft.ifft2(np.fft.ifftshift(np.abs(uv_plane).__gt__(0))))
-        return ift  # /np.sum(ret)
+    def get_beam(self, nw=30, num_bin=2 ** 7, use_kernel=False,
+                 grid_kernel_r_pixels=DEFAULT_KERNEL_R_PIXELS):
+        """
+        Return the beam (point spread function). With use_kernel the uv
+        sampling is convolved with the gridding kernel (of radius
+        grid_kernel_r_pixels) and grid corrected, as in get_ift(). The peak
+        of either beam is the number of occupied cells over num_bin**2.
+        """
+        if not use_kernel:
+            uv_plane, uu_edges, vv_edges = self.get_uvplane(
+                num_bin=num_bin, nw=nw)
+            ift = np.fft.ifftshift(fft.ifft2(np.fft.ifftshift(np.abs(uv_plane).__gt__(0))))
+            return ift  # /np.sum(ret)
+
+        idx_list, weight_list = self.get_kernel_weights(num_bin, nw, grid_kernel_r_pixels)
+        idx = np.concatenate(idx_list)
+        sampling, _ = gridding.accumulate_weighted(idx, np.concatenate(weight_list),
+                                                   np.ones(idx.shape[0]), num_bin)
+        ift = np.fft.fftshift(fft.ifft2(np.fft.ifftshift(sampling)))
+        return ift / gridding.get_grid_correction(grid_kernel_r_pixels, num_bin)
+
+    def _get_dft_image(self, l, m):
+        uvw_list = []
+        vis_list = []
+        for cal_vis in self.cal_vis_list:
+            uvw_list.append(np.stack(cal_vis.get_all_uvw(), axis=1) / constants.L1_WAVELENGTH)
+            vis_list.append(cal_vis.get_all_visibility()[0])
+        return dft.image_snapshots(uvw_list, vis_list, l, m)
+
+    def get_dft(self, num_bin=2 ** 7):
+        """
+        Image by direct Fourier transform onto a square (num_bin, num_bin)
+        grid of l,m pixels (as imaging.get_lm_index). There is no gridding,
+        and the image is in the units of the visibilities (a unit point
+        source has unit brightness). Pixels below the horizon are zero.
+
+        Returns [img, extent], with the extent in direction cosines.
+        """
+        l, m = dft.get_lm_grid(num_bin)
+        visible = l**2 + m**2 < 1.0
+        img = np.zeros((num_bin, num_bin))
+        img[visible] = self._get_dft_image(l[visible], m[visible])
+        return [img, [-1, 1, -1, 1]]
+
+    def get_dft_healpix(self, nside=32):
+        """
+        Image by direct Fourier transform onto the HEALPix pixels (RING
+        ordering, the zenith at the pole) of the visible hemisphere.
+
+        Returns the HEALPix map, with hp.UNSEEN below the horizon.
+        """
+        import healpy as hp
+
+        pixels, l, m = dft.get_healpix_lm(nside)
+        ret = np.full(hp.nside2npix(nside), hp.UNSEEN)
+        ret[pixels] = self._get_dft_image(l, m)
+        return ret
 
     def get_image(self, CAL_IFT, CAL_EXTENT):
         abs_ift = np.abs(CAL_IFT)
@@ -0,0 +1,63 @@
+#
+# Visibilities shared by the imaging tests.
+#
+import numpy as np
+
+from tart.imaging import calibration, visibility
+from tart.operation import settings
+from tart.util import constants, utc
+
+CONFIG_FILE = "tart/test/test_telescope_config.json"
+ANT_POS_FILE = "tart/test/test_calibrated_antenna_positions.json"
+
+
+def dummy_config():
+    ''' The test telescope config, with the calibrated antenna positions '''
+    config = settings.from_file(CONFIG_FILE)
+    config.load_antenna_positions(cal_ant_positions_file=ANT_POS_FILE)
+    return config
+
+
+def dummy_baselines(num_ant=24):
+    ''' Every baseline [i, j] (i < j) of the first num_ant antennas '''
+    i, j = np.triu_indices(num_ant, 1)
+    return np.stack([i, j], axis=1).tolist()
+
+
+def dummy_vis(v=None, num_ant=24, config=None, timestamp=None):
+    '''
+        A Visibility of dummy_baselines(num_ant), at timestamp (default now)
+        with config (default dummy_config()). Unless v is given, the
+        visibilities are random, with amplitudes between 0.1 and 1 and
+        uniform phases.
+    '''
+    if config is None:
+        config = dummy_config()
+    if timestamp is None:
+        timestamp = utc.now()
+    ret = visibility.Visibility.from_config(config=config, timestamp=timestamp)
+    b = dummy_baselines(num_ant)
+    if v is None:
+        v = np.random.uniform(0.1, 1, len(b)) * np.exp(1.0j * np.random.uniform(-np.pi, np.pi, len(b)))
+    ret.set_visibilities(b=b, v=v)
+    return ret
+
+
+def dummy_cal_vis(v=None):
+    ''' A CalibratedVisibility (unity gains) of dummy_vis() '''
+    return calibration.CalibratedVisibility(dummy_vis(v))
+
+
+def point_source_cal_vis(el, az, config=None):
+    '''
+        A CalibratedVisibility of a unit point source at (el, az) degrees, on
+        the antenna positions of config (default dummy_config())
+    '''
+    if config is None:
+        config = dummy_config()
+    pos = np.array(config.get_antenna_positions())
+    el_r, az_r = np.radians(el), np.radians(az)
+    s = np.array([np.sin(az_r) * np.cos(el_r), np.cos(az_r) * np.cos(el_r), np.sin(el_r)])
+    i, j = np.triu_indices(len(pos), 1)
+    v = np.exp(2j * np.pi * (pos[i] - pos[j]) @ s / constants.L1_WAVELENGTH)
+    return calibration.CalibratedVisibility(dummy_vis(v, config=config))
@@ -0,0 +1,100 @@
+import datetime
+import os
+import unittest
+
+import numpy as np
+
+from tart.imaging import averaging, visibility
+from tart.imaging.test.helpers import dummy_baselines, dummy_config, dummy_vis
+from tart.imaging.visibility_series import VisibilityTimeSeries
+from tart.util import angle, skyloc, utc
+
+
+class TestVisibilityAverager(unittest.TestCase):
+
+    def setUp(self):
+        self.config = dummy_config()
+        self.baselines = dummy_baselines()
+        self.n_t = 95
+        self.t0 = utc.utc_datetime(2019, 2, 22, 5, 11, 0)
+        self.ts = [self.t0 + datetime.timedelta(seconds=k) for k in range(self.n_t)]
+        n_bl = len(self.baselines)
+        self.v = (np.random.normal(size=(self.n_t, n_bl)) +
+                  1.0j * np.random.normal(size=(self.n_t, n_bl)))
+        self.vis_list = [dummy_vis(v, config=self.config, timestamp=ts)
+                         for v, ts in zip(self.v, self.ts)]
+
+    def check_averages(self, ret, v):
+        # The bins are aligned to whole minutes (t0 is on a minute boundary)
+        self.assertEqual([r[2] for r in ret], [60, 35])
+        for (vis, var, n), a in zip(ret, [0, 60]):
+            seg = v[a:a + n]
+            self.assertTrue(np.allclose(vis.v, seg.mean(axis=0)))
+            self.assertTrue(np.allclose(var, (np.abs(seg - seg.mean(axis=0))**2).sum(axis=0) / (n - 1)))
+        self.assertEqual(ret[0][0].timestamp, self.t0 + datetime.timedelta(seconds=29.5))
+
+    def test_average(self):
+        dut = averaging.VisibilityAverager(60.0)
+        ret = dut.add(self.vis_list)
+        self.assertEqual(len(ret), 1)
+        ret += dut.flush()
+        self.check_averages(ret, self.v)
+
+    def test_blocks(self):
+        dut = averaging.VisibilityAverager(datetime.timedelta(minutes=1))
+        ts_ns = utc.to_epoch_ns(self.ts)
+        ret = []
+        for a in range(0, self.n_t, 7):
+            ret += dut.add_block(self.v[a:a + 7], ts_ns[a:a + 7],
+                                 config=self.config, baselines=self.baselines)
+        ret += dut.flush()
+        self.check_averages(ret, self.v)
+
+        dut.add_block(self.v[0:1], ts_ns[0:1])
+        with self.assertRaises(ValueError):
+            dut.add_block(self.v[0:1], ts_ns[0:1] - 10**12)
+
+    def test_fringe_stop(self):
+        sky = skyloc.Skyloc(angle.from_dms(30.0), angle.from_dms(-45.0))
+        dut = averaging.VisibilityAverager(60.0, sky_location=sky)
+        ret = dut.add(self.vis_list) + dut.flush()
+
+        stopped = []
+        for vis in self.vis_list:
+            vis.rotate(sky)
+            stopped.append(vis.v)
+        self.check_averages(ret, np.array(stopped))
+
+    def test_average_hdf5(self):
+        fname = "test_avg_in.hdf"
+        fout = "test_avg_out.hdf"
+        visibility.to_hdf5(self.vis_list, ant_pos=self.config.get_antenna_positions(),
+                           cal_gain=np.ones(24), cal_ph=np.zeros(24), filename=fname)
+        n = averaging.average_hdf5(fname, fout, 60.0, block_rows=16)
+        self.assertEqual(n, 2)
+
+        with VisibilityTimeSeries(fout) as dut:
+            rows = dut.read()
+            self.assertTrue(np.allclose(rows["vis"][1], self.v[60:].mean(axis=0), atol=1e-6))
+            self.assertEqual(rows["n_avg"].tolist(), [60, 35])
+        ret = visibility.from_hdf5(fout)
+        self.assertEqual(len(ret["vis_list"]), 2)
+        os.remove(fname)
+        os.remove(fout)
+
+    def test_average_hdf5_fringe_stop(self):
+        fname = "test_avg_in_fs.hdf"
+        fout = "test_avg_out_fs.hdf"
+        visibility.to_hdf5(self.vis_list, ant_pos=self.config.get_antenna_positions(),
+                           cal_gain=np.ones(24), cal_ph=np.zeros(24), filename=fname)
+        sky = skyloc.Skyloc(angle.from_dms(30.0), angle.from_dms(-45.0))
+        averaging.average_hdf5(fname, fout, 60.0, sky_location=sky, block_rows=16)
+
+        # The output is phased to the sky location, not the input zenith
+        expected = averaging.VisibilityAverager(60.0, sky_location=sky).add(self.vis_list)[0][0]
+        with VisibilityTimeSeries(fout) as dut:
+            self.assertAlmostEqual(dut.phase_el.to_degrees(), expected.phase_el.to_degrees(), 6)
+            self.assertAlmostEqual(dut.phase_az.to_degrees(), expected.phase_az.to_degrees(), 6)
+            self.assertNotAlmostEqual(dut.phase_el.to_degrees(), 90.0, 3)
+        os.remove(fname)
+        os.remove(fout)
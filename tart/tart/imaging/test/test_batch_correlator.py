@@ -0,0 +1,77 @@
+import datetime
+import json
+import os
+import unittest
+
+import numpy as np
+
+from tart.imaging import batch_correlator, visibility
+from tart.imaging.correlator import Correlator
+from tart.operation import observation, settings
+from tart.util import utc
+
+TEST_SCOPE_CONFIG = os.path.join(os.path.dirname(__file__), "../../test/test_telescope_config.json")
+ANT_POS_FILE = os.path.join(os.path.dirname(__file__), "../../test/test_calibrated_antenna_positions.json")
+
+
+class TestBatchCorrelator(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(3)
+        config = settings.from_file(TEST_SCOPE_CONFIG)
+        t0 = utc.now()
+        self.files = []
+        self.obs = []
+        # File names are in reverse time order, the output must be in time order.
+        for k in range(3):
+            ts = t0 + datetime.timedelta(seconds=10 * k)
+            data = [np.random.randint(0, 2, 2 ** 10) for _ in range(config.get_num_antenna())]
+            obs = observation.Observation(timestamp=ts, config=config, data=data)
+            fname = f"test_batch_obs_{2 - k}.hdf"
+            obs.to_hdf5(fname)
+            self.files.append(fname)
+            self.obs.append(obs)
+
+    def tearDown(self):
+        for f in self.files:
+            os.remove(f)
+
+    def test_correlate_files(self):
+        vis_list, stats = batch_correlator.correlate_files(self.files, processes=2)
+        self.assertEqual(len(vis_list), 3)
+
+        cor = Correlator()
+        for vis, obs, s in zip(vis_list, self.obs, stats):
+            self.assertEqual(vis.timestamp, obs.timestamp)
+            self.assertEqual(s["timestamp"], obs.timestamp)
+            self.assertGreater(s["samples_per_second"], 0)
+            expected = cor.correlate(obs)
+            self.assertTrue(np.allclose(vis.v, expected.v))
+
+    def test_correlate_to_hdf5(self):
+        with open(ANT_POS_FILE) as f:
+            ant_pos = json.load(f)
+        fname = "test_batch_vis.hdf"
+        batch_correlator.correlate_to_hdf5("test_batch_obs_*.hdf", fname,
+                                           ant_pos=ant_pos, processes=2)
+        ret = visibility.from_hdf5(fname)
+        os.remove(fname)
+        self.assertEqual(ret["timestamps"], [o.timestamp for o in self.obs])
+
+        with self.assertRaisesRegex(ValueError, "no input files"):
+            batch_correlator.correlate_to_hdf5([], fname, ant_pos=ant_pos)
+
+    def test_packed_mode(self):
+        vis_list, stats = batch_correlator.correlate_files(self.files, mode="packed",
+                                                           processes=2, load_threads=2)
+        cor = Correlator()
+        for vis, obs, s in zip(vis_list, self.obs, stats):
+            self.assertEqual(s["n_samples"], obs.get_num_samples())
+            self.assertTrue(np.allclose(vis.v, cor.correlate(obs).v))
+
+    @unittest.skipIf(not os.path.isdir("/dev/shm"), "No /dev/shm to inspect")
+    def test_worker_error_releases_memory(self):
+        before = set(os.listdir("/dev/shm"))
+        self.assertRaises(ValueError, batch_correlator.correlate_files, self.files,
+                          mode="not_a_mode", processes=2)
+        self.assertEqual(set(os.listdir("/dev/shm")) - before, set())
@@ -0,0 +1,189 @@
+import json
+import os
+import unittest
+from copy import deepcopy
+
+import numpy as np
+
+from tart.imaging import calibration, imaging
+from tart.imaging.test.helpers import dummy_vis
+from tart.operation import settings
+
+
+class TestCalibratedVisibility(unittest.TestCase):
+
+    def setUp(self):
+        self.vis = dummy_vis()
+        self.cv = calibration.CalibratedVisibility(self.vis)
+        self.gain = np.random.uniform(0.5, 2.0, 24)
+        self.phase = np.random.uniform(0, 2 * np.pi, 24)
+        self.cv.set_gain(np.arange(24), self.gain)
+        self.cv.set_phase_offset(np.arange(24), self.phase)
+
+    def test_get_all_visibility(self):
+        self.cv.flag_antenna(3)
+        v, bl = self.cv.get_all_visibility()
+        self.assertEqual(len(v), 276 - 23)
+        self.assertFalse((bl == 3).any())
+        for k in [0, 40, 200]:
+            i, j = bl[k]
+            expected = (self.vis.vis(i, j) * self.gain[i] * self.gain[j] *
+                        np.exp(-1j * (self.phase[i] - self.phase[j])))
+            self.assertAlmostEqual(v[k], expected, 12)
+            self.assertAlmostEqual(self.cv.get_visibility(i, j), expected, 12)
+            self.assertAlmostEqual(self.cv.get_visibility(j, i), np.conjugate(expected), 12)
+
+        with self.assertRaises(RuntimeError):
+            self.cv.get_visibility(3, 5)
+
+    def test_cache(self):
+        v1, _ = self.cv.get_all_visibility()
+        v2, _ = self.cv.get_all_visibility()
+        self.assertIs(v1, v2)
+
+        self.cv.set_gain(0, 10.0)
+        v3, _ = self.cv.get_all_visibility()
+        self.assertIsNot(v1, v3)
+        self.assertAlmostEqual(v3[0] / v1[0], 10.0 / self.gain[0], 10)
+
+        uvw1 = self.cv.get_all_uvw()
+        self.assertIs(uvw1[0].base, self.cv.get_all_uvw()[0].base)
+        self.cv.flag_baseline(0, 1)
+        uu, vv, ww = self.cv.get_all_uvw()
+        self.assertEqual(len(uu), 275)
+        pos = np.array(self.vis.config.get_antenna_positions())
+        self.assertAlmostEqual(uu[0], pos[0][0] - pos[2][0], 10)
+
+    def test_flagged_baselines(self):
+        self.cv.flag_baseline(5, 2)
+        self.cv.flag_baseline(0, 1)
+        self.assertEqual(self.cv.flagged_baselines, [[0, 1], [2, 5]])
+        self.assertNotIn([2, 5], self.cv.get_baselines())
+
+        fname = "test_gain_calibration.json"
+        json_str = self.cv.to_json(fname)
+        os.remove(fname)
+        self.assertEqual(json.loads(json_str)["flagged_baselines"], [[0, 1], [2, 5]])
+        cv2 = calibration.from_JSON(self.vis, json_str)
+        self.assertTrue((cv2.flags == self.cv.flags).all())
+
+    def test_tiles(self):
+        self.cv.leave_intra_tile_baselines()
+        for i, j in self.cv.get_baselines():
+            self.assertEqual(i // 6, j // 6)
+        self.assertEqual(len(self.cv.get_baselines()), 4 * 15)
+
+        self.cv.flag_tile(1)
+        for i, j in self.cv.get_baselines():
+            self.assertNotEqual(i // 6, 1)
+
+    def test_geometry(self):
+        pos = np.array(self.vis.config.get_antenna_positions())
+        self.cv.leave_baseline_lengths(1.0, 2.0)
+        for i, j in self.cv.get_baselines():
+            d = np.hypot(*(pos[i] - pos[j])[0:2])
+            self.assertTrue(1.0 <= d <= 2.0)
+
+        cv = calibration.CalibratedVisibility(self.vis)
+        cv.leave_orientation(0.0, np.radians(10))
+        self.assertGreater(len(cv.get_baselines()), 0)
+        for i, j in cv.get_baselines():
+            d = pos[i] - pos[j]
+            self.assertLessEqual(np.abs(d[1]), np.abs(d[0]) * np.tan(np.radians(10)) + 1e-9)
+
+        lengths = cv.get_baseline_lengths()
+        i, j = cv.get_baselines()[0]
+        self.assertTrue(np.allclose(lengths[0], np.abs(pos[j][0:2] - pos[i][0:2])))
+
+    def test_rotation(self):
+        reference = deepcopy(self.vis.config.get_antenna_positions())
+        self.cv.flag_antenna(7)
+        for rot in [0.0, 12.5, -40.0, 12.5]:
+            imaging.rotate_vis(rot, self.cv, reference)
+            uu, vv, ww = self.cv.get_all_uvw()
+
+            rotated = np.array(settings.rotate_location(rot, np.array(reference).T)).T
+            bl = np.array(self.cv.get_baselines())
+            expected = rotated[bl[:, 0]] - rotated[bl[:, 1]]
+            self.assertTrue(np.allclose(uu, expected[:, 0]))
+            self.assertTrue(np.allclose(vv, expected[:, 1]))
+            self.assertTrue(np.allclose(ww, expected[:, 2]))
+
+            # The config of the visibility holds the rotated positions
+            pos = np.array(self.vis.config.get_antenna_positions())
+            self.assertTrue(np.allclose(pos, rotated))
+
+    def test_uvw_cache_base(self):
+        calibration._uvw_cache.clear()
+        pos = np.random.normal(size=(5, 3))
+        bl = np.array([[0, 1], [2, 4]])
+        calibration.get_baseline_uvw(pos, bl, 30.0)
+        self.assertEqual(len(calibration._uvw_cache), 2)
+        calibration.get_baseline_uvw(pos, bl, 45.0)
+        self.assertEqual(len(calibration._uvw_cache), 3)
+        self.assertTrue(np.allclose(calibration.get_baseline_uvw(pos, bl), pos[[0, 2]] - pos[[1, 4]]))
+
+
+class TestAntennaCalibration(unittest.TestCase):
+
+    def setUp(self):
+        self.gain = np.random.uniform(0.5, 2.0, 24)
+        self.phase = np.random.uniform(0, 2 * np.pi, 24)
+        self.cal = calibration.AntennaCalibration(self.gain, self.phase)
+
+    def test_apply_block(self):
+        vis_list = [dummy_vis() for _ in range(4)]
+        block, bl = self.cal.apply_to_list(vis_list)
+        self.assertEqual(block.shape, (4, 276))
+        for k, vis in enumerate(vis_list):
+            cv = calibration.CalibratedVisibility(vis, cal=self.cal)
+            v, _ = cv.get_all_visibility()
+            self.assertTrue(np.allclose(block[k], v))
+            i, j = bl[7]
+            expected = (vis.vis(i, j) * self.gain[i] * self.gain[j] *
+                        np.exp(-1j * (self.phase[i] - self.phase[j])))
+            self.assertAlmostEqual(block[k, 7], expected, 12)
+
+    def test_version(self):
+        vis = dummy_vis()
+        cv1 = calibration.CalibratedVisibility(vis, cal=self.cal)
+        cv2 = calibration.CalibratedVisibility(dummy_vis(), cal=self.cal)
+        v1, _ = cv1.get_all_visibility()
+        v2, _ = cv2.get_all_visibility()
+        version = cv2.version
+
+        # A shared calibration invalidates every snapshot using it
+        cv1.set_gain(np.arange(24), 2 * self.gain)
+        self.assertEqual(self.cal.version, 1)
+        self.assertNotEqual(cv2.version, version)
+        v2b, _ = cv2.get_all_visibility()
+        self.assertTrue(np.allclose(v2b, 4 * v2))
+
+        version = cv1.version
+        cv1.flag_antenna(0)
+        self.assertNotEqual(cv1.version, version)
+        self.assertEqual(len(cv1.get_all_visibility()[0]), 253)
+
+    def test_read_only(self):
+        cv = calibration.CalibratedVisibility(dummy_vis(), cal=self.cal)
+        # The gains can only change through set_gain(), which updates the version
+        for arr in [cv.gain, cv.phase_offset, self.cal.gain, self.cal.phase_offset]:
+            with self.assertRaises(ValueError):
+                arr[0] = 3.0
+        version = cv.version
+        cv.set_gain(0, 3.0)
+        self.assertEqual(cv.gain[0], 3.0)
+        self.assertNotEqual(cv.version, version)
+
+    def test_new_calibration(self):
+        cv = calibration.CalibratedVisibility(dummy_vis())
+        cv.set_gain(0, 3.0)
+        v1, _ = cv.get_all_visibility()
+        # A fresh calibration (version 0) after a flag must not reuse the cache
+        cv.flag_antenna(23)
+        cv.cal = calibration.AntennaCalibration(2 * self.gain, self.phase)
+        v2, bl = cv.get_all_visibility()
+        i, j = bl[5]
+        expected = (cv.vis.vis(i, j) * 4 * self.gain[i] * self.gain[j] *
+                    np.exp(-1j * (self.phase[i] - self.phase[j])))
+        self.assertAlmostEqual(v2[5], expected, 12)
@@ -0,0 +1,69 @@
+import os
+import unittest
+
+import numpy as np
+
+from tart.imaging import closure, visibility
+from tart.imaging.test.helpers import dummy_vis
+
+
+def corrupt(vis, gain, phase):
+    ''' Apply antenna based gains and phases to a copy of the visibilities '''
+    ret = visibility.Visibility.from_config(config=vis.config, timestamp=vis.timestamp)
+    i, j = vis.bl_arr[:, 0], vis.bl_arr[:, 1]
+    c = gain * np.exp(1.0j * phase)
+    ret.set_visibilities(b=vis.baselines, v=vis.v * c[i] * np.conjugate(c[j]))
+    return ret
+
+
+def wrap(x):
+    return np.angle(np.exp(1.0j * x))
+
+
+class TestClosure(unittest.TestCase):
+
+    def test_counts(self):
+        self.assertEqual(closure.triangles(24).shape, (2024, 3))
+        self.assertEqual(closure.quadrangles(24).shape, (10626, 4))
+
+    def test_closure_phase(self):
+        vis = dummy_vis()
+        cp = closure.closure_phases(vis)
+        tri = closure.triangles(24)
+        self.assertEqual(cp.shape, (len(tri),))
+        for n in [0, 17, 999, 2023]:
+            i, j, k = tri[n]
+            self.assertAlmostEqual(cp[n], wrap(vis.get_closure_phase(i, j, k)), 10)
+
+    def test_gain_invariance(self):
+        vis = dummy_vis()
+        gain = np.random.uniform(0.5, 2.0, 24)
+        phase = np.random.uniform(-np.pi, np.pi, 24)
+        bad = corrupt(vis, gain, phase)
+
+        delta = wrap(closure.closure_phases(vis) - closure.closure_phases(bad))
+        self.assertLess(np.max(np.abs(delta)), 1e-9)
+
+        ca = closure.closure_amplitudes(vis)
+        self.assertEqual(ca.shape, (10626, 2))
+        self.assertTrue(np.allclose(ca, closure.closure_amplitudes(bad)))
+
+    def test_time_series(self):
+        vis_list = [dummy_vis() for _ in range(3)]
+        cp = closure.closure_phases(vis_list)
+        self.assertEqual(cp.shape, (3, 2024))
+        self.assertTrue(np.allclose(cp[1], closure.closure_phases(vis_list[1])))
+
+        config = vis_list[0].config
+        fname = "test_closure.hdf"
+        visibility.to_hdf5(vis_list, ant_pos=config.get_antenna_positions(),
+                           cal_gain=[0], cal_ph=[0], filename=fname)
+        ca = closure.closure_amplitudes(visibility.from_hdf5(fname))
+        os.remove(fname)
+        self.assertEqual(ca.shape, (3, 10626, 2))
+        self.assertTrue(np.allclose(ca, closure.closure_amplitudes(vis_list)))
+
+    def test_missing_baseline(self):
+        vis = dummy_vis(num_ant=4)
+        with self.assertRaises(RuntimeError):
+            closure.closure_phases(vis, tri=[[0, 1, 5]])
@@ -1,10 +1,12 @@
 import os
+import tempfile
 import unittest
 
 import numpy as np
 from scipy.signal import hilbert
 
-from tart.imaging.correlator import Correlator, corr_b, corr_b_pat
+from tart.imaging.correlator import Correlator, FxCorrelator, StreamingCorrelator, corr_b, corr_b_pat
+from tart.imaging.correlator import corr_b_packed, packed_roll
 
 from tart.operation import observation
 from tart.operation import settings
@@ -113,6 +115,151 @@ class TestCorrelator(unittest.TestCase):
             # self.assertTrue(np.abs(cor_out - input_angle) < 20.)
 
 
+    def test_correlate_matrix(self):
+        np.random.seed(42)
+        c = settings.from_file(TEST_SCOPE_CONFIG)
+        c.Dict["num_antenna"] = 5
+        d = [np.random.randint(0, 2, 2 ** 12) for _ in range(5)]
+        o = observation.Observation(timestamp=utc.now(), config=c, data=d)
+
+        cor = Correlator(van_vleck_corr=True)
+        v, baselines = cor.compute_complex_vis(o, mode="roll")
+        self.assertEqual(len(v), len(baselines))
+
+        data = [o.get_antenna(i) - np.mean(o.get_antenna(i)) for i in range(5)]
+        for vis, (i, j) in zip(v, baselines):
+            expected = cor.V(data[i], data[j], np.roll(data[j], 1))
+            self.assertAlmostEqual(vis, expected, 10)
+
+    def test_packed_roll(self):
+        np.random.seed(1)
+        for n in [64, 100, 2 ** 10 + 3]:
+            x = np.random.randint(0, 2, (3, n)).astype(np.uint8)
+            rolled = packed_roll(np.packbits(x, axis=1), n)
+            self.assertTrue((rolled == np.packbits(np.roll(x, 1, axis=1), axis=1)).all())
+
+    def test_packed_correlator(self):
+        np.random.seed(42)
+        c = settings.from_file(TEST_SCOPE_CONFIG)
+        c.Dict["num_antenna"] = 4
+        for n in [2 ** 12, 2 ** 12 + 5]:
+            d = [np.random.randint(0, 2, n) for _ in range(4)]
+            self.assertAlmostEqual(corr_b(d[0], d[1], n),
+                                   corr_b_packed(np.packbits(d[0]), np.packbits(d[1]), n))
+
+            o = observation.Observation(timestamp=utc.now(), config=c, data=d)
+            cor = Correlator(van_vleck_corr=True)
+            v_roll, bl_roll = cor.compute_complex_vis(o, mode="roll")
+            v_packed, bl_packed = cor.compute_complex_vis(o, mode="packed")
+            self.assertEqual(bl_roll, bl_packed)
+            self.assertTrue(np.allclose(v_roll, v_packed, atol=1e-12))
+
+    def test_streaming_correlator(self):
+        np.random.seed(7)
+        c = settings.from_file(TEST_SCOPE_CONFIG)
+        c.Dict["num_antenna"] = 4
+        n = 2 ** 12 + 24
+        d = [np.random.randint(0, 2, n) for _ in range(4)]
+        o = observation.Observation(timestamp=utc.now(), config=c, data=d)
+
+        v_roll, _ = Correlator().compute_complex_vis(o, mode="roll")
+        for block_size in [64, 200, 2 ** 11, 2 ** 14]:
+            cor = StreamingCorrelator(block_size=block_size)
+            v_stream, _ = cor.compute_complex_vis(o)
+            self.assertTrue(np.allclose(v_roll, v_stream, atol=1e-12))
+
+    def test_streaming_correlator_hdf5(self):
+        np.random.seed(8)
+        c = settings.from_file(TEST_SCOPE_CONFIG)
+        d = [np.random.randint(0, 2, 2 ** 12) for _ in range(c.get_num_antenna())]
+        o = observation.Observation(timestamp=utc.now(), config=c, data=d)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "test_streaming_obs.hdf")
+            o.to_hdf5(fname)
+
+            vis = StreamingCorrelator(block_size=2 ** 8).correlate_hdf5(fname)
+            expected = Correlator().correlate(observation.Observation_Load(fname), mode="roll")
+            self.assertEqual(vis.timestamp, expected.timestamp)
+            self.assertTrue(np.allclose(vis.v, expected.v, atol=1e-12))
+
+            packed_obs = observation.PackedObservation.from_hdf5(fname)
+            vis = Correlator().correlate(packed_obs, mode="packed")
+            self.assertTrue(np.allclose(vis.v, expected.v, atol=1e-12))
+
+    def test_subintegrations(self):
+        np.random.seed(9)
+        c = settings.from_file(TEST_SCOPE_CONFIG)
+        c.Dict["num_antenna"] = 4
+        n = 2 ** 12
+        d = [np.random.randint(0, 2, n) for _ in range(4)]
+        o = observation.Observation(timestamp=utc.now(), config=c, data=d)
+        cor = Correlator(van_vleck_corr=True)
+
+        # A single sub-integration is the whole observation
+        vis_list = cor.correlate_subintegrations(o, n)
+        self.assertEqual(len(vis_list), 1)
+        self.assertTrue(np.allclose(vis_list[0].v, cor.correlate(o).v, atol=1e-12))
+
+        n_sub = 2 ** 10
+        vis_list = cor.correlate_subintegrations(o, n_sub)
+        self.assertEqual(len(vis_list), 4)
+        dt = (vis_list[1].timestamp - vis_list[0].timestamp).total_seconds()
+        self.assertAlmostEqual(dt, n_sub / o.get_sampling_rate(), 5)
+
+        data = np.array([o.get_antenna(i) for i in range(4)])
+        hilb = np.roll(data, 1, axis=1)
+        for k, vis in enumerate(vis_list):
+            x = data[:, k * n_sub:(k + 1) * n_sub]
+            h = hilb[:, k * n_sub:(k + 1) * n_sub]
+            x = x - x.mean(axis=1, keepdims=True)
+            h = h - h.mean(axis=1, keepdims=True)
+            for v, (i, j) in zip(vis.v, vis.baselines):
+                self.assertAlmostEqual(v, cor.V(x[i], x[j], h[j]), 10)
+
+        self.assertRaises(ValueError, cor.correlate_subintegrations, o, 2 * n)
+
+    def test_fx_correlator(self):
+        np.random.seed(10)
+        c = settings.from_file(TEST_SCOPE_CONFIG)
+        c.Dict["num_antenna"] = 3
+        fs = c.get_sampling_frequency()
+        n = 2 ** 16
+        t = np.arange(n) / fs
+        f0 = fs / 4
+        phases = [0.0, 0.7, -1.2]
+        d = [(np.cos(2 * np.pi * f0 * t - p) + np.random.normal(0, 1, n) > 0).astype(np.uint8)
+             for p in phases]
+        o = observation.Observation(timestamp=utc.now(), config=c, data=d)
+
+        fx = FxCorrelator(bandwidth=fs / 2, linewidth=fs / 128)
+        self.assertEqual(fx.n_freq, 64)
+        cube, baselines, freqs = fx.compute_channel_vis(o)
+        self.assertEqual(cube.shape, (64, 3))
+
+        # The tone is in one channel, with the phase difference of the antennas
+        k = np.argmin(np.abs(freqs - f0))
+        for v, (i, j) in zip(cube[k], baselines):
+            self.assertLess(np.abs(np.angle(v * np.exp(-1j * (phases[j] - phases[i])))), 0.15)
+            self.assertGreater(np.abs(v), 0.9)
+
+        # The band integrated visibilities agree with the XF correlator
+        v_fx = fx.correlate(o).v
+        v_xf = Correlator().correlate(o).v
+        for a, b in zip(v_fx, v_xf):
+            self.assertLess(np.abs(np.angle(a * np.conjugate(b))), 0.15)
+
+        channels = fx.correlate_channels(o)
+        self.assertEqual(len(channels), 64)
+
+        # A dead (constant) antenna gives zero, not NaN, visibilities
+        d[2] = np.ones(n, dtype=np.uint8)
+        o = observation.Observation(timestamp=utc.now(), config=c, data=d)
+        v = fx.correlate(o).v
+        self.assertTrue(np.all(np.isfinite(v)))
+        self.assertTrue(np.all(v[1:] == 0))
+        self.assertNotEqual(v[0], 0)
+
+
 class TestHilbert(unittest.TestCase):
     def test_hilbert(self):
         import scipy.signal
@@ -0,0 +1,91 @@
+import unittest
+
+import numpy as np
+
+from tart.imaging import dft, elaz, synthesis
+from tart.imaging.test.helpers import dummy_config, point_source_cal_vis
+
+
+class TestDFT(unittest.TestCase):
+
+    def test_point_source(self):
+        num_bin = 128
+        syn = synthesis.Synthesis_Imaging([point_source_cal_vis(60.0, 30.0)])
+        img, extent = syn.get_dft(num_bin=num_bin)
+        self.assertEqual(img.shape, (num_bin, num_bin))
+
+        src = elaz.ElAz(60.0, 30.0)
+        peak = np.unravel_index(np.argmax(img), img.shape)
+        self.assertEqual(peak, src.get_px(num_bin))
+        self.assertGreater(img[peak], 0.9)
+
+        l, m = src.get_lm()
+        self.assertAlmostEqual(syn._get_dft_image(np.array([l]), np.array([m]))[0], 1.0, places=4)
+
+        l, m = dft.get_lm_grid(num_bin)
+        self.assertTrue(np.all(img[l**2 + m**2 >= 1.0] == 0))
+
+    def test_antenna_heights(self):
+        ''' Baselines with a vertical component (w != 0) image the source at unit brightness '''
+        config = dummy_config()
+        pos = np.array(config.get_antenna_positions())
+        pos[:, 2] = np.random.uniform(-0.5, 0.5, len(pos))
+        config.set_antenna_positions(pos.tolist())
+        syn = synthesis.Synthesis_Imaging([point_source_cal_vis(50.0, -120.0, config)])
+
+        l, m = elaz.ElAz(50.0, -120.0).get_lm()
+        self.assertAlmostEqual(syn._get_dft_image(np.array([l]), np.array([m]))[0], 1.0, places=4)
+
+    def test_snapshots(self):
+        cv_list = [point_source_cal_vis(70.0, -40.0), point_source_cal_vis(50.0, 100.0)]
+        l, m = dft.get_lm_grid(32)
+        both = synthesis.Synthesis_Imaging(cv_list).get_dft(num_bin=32)[0]
+        each = [synthesis.Synthesis_Imaging([cv]).get_dft(num_bin=32)[0] for cv in cv_list]
+        self.assertTrue(np.allclose(both, (each[0] + each[1]) / 2, atol=1e-5))
+
+    def test_phase_cache(self):
+        uvw = np.random.normal(size=(20, 3))
+        l, m = dft.get_lm_grid(16)
+        p1 = dft.get_phase_factors(uvw, l, m)
+        self.assertIs(p1, dft.get_phase_factors(uvw.copy(), l, m))
+        self.assertEqual(p1.shape, (16 * 16, 20))
+        self.assertTrue(np.allclose(p1, dft.compute_phase_factors(uvw, l, m, block_pixels=7)))
+
+    def test_phase_cache_bytes(self):
+        uvw = np.random.normal(size=(20, 3))
+        vis = np.random.normal(size=(20, 2)) + 1.0j * np.random.normal(size=(20, 2))
+        l, m = dft.get_lm_grid(16)
+        nbytes = dft.phase_factor_nbytes(uvw, l)
+        dft._phase_cache.clear()
+        expected = dft.image(uvw, vis, l, m)
+        limit = dft.PHASE_CACHE_BYTES
+        try:
+            # Room for two phase matrices: the oldest is evicted
+            dft.PHASE_CACHE_BYTES = 2 * nbytes
+            for k in range(3):
+                dft.get_phase_factors(uvw + k, l, m)
+            self.assertEqual(len(dft._phase_cache), 2)
+            self.assertLessEqual(sum(p.nbytes for p in dft._phase_cache.values()), 2 * nbytes)
+
+            # Too large to cache: imaged block by block, and nothing is held
+            dft._phase_cache.clear()
+            dft.PHASE_CACHE_BYTES = nbytes - 1
+            self.assertTrue(np.allclose(dft.image(uvw, vis, l, m, block_pixels=37), expected, atol=1e-5))
+            self.assertEqual(len(dft._phase_cache), 0)
+        finally:
+            dft.PHASE_CACHE_BYTES = limit
+            dft._phase_cache.clear()
+
+    def test_healpix(self):
+        try:
+            import healpy as hp
+        except ImportError:
+            self.skipTest("healpy is not installed")
+        nside = 16
+        syn = synthesis.Synthesis_Imaging([point_source_cal_vis(60.0, 30.0)])
+        hp_map = syn.get_dft_healpix(nside=nside)
+        self.assertEqual(len(hp_map), hp.nside2npix(nside))
+        theta, phi = hp.pix2ang(nside, np.argmax(hp_map))
+        self.assertAlmostEqual(90.0 - np.degrees(theta), 60.0, delta=4.0)
+        self.assertAlmostEqual(np.degrees(phi), 30.0, delta=8.0)
+        self.assertTrue(np.all(hp_map[hp.pix2ang(nside, np.arange(len(hp_map)))[0] > np.pi / 2] == hp.UNSEEN))
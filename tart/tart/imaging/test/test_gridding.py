@@ -0,0 +1,203 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from tart.imaging import gridding, synthesis
+from tart.imaging.test.helpers import dummy_cal_vis, point_source_cal_vis
+from tart.util import constants
+
+
+def histogram_uvplane(uu_a, vv_a, vis_l, num_bin, nw):
+    ''' The triple histogram2d gridder that get_uvplane used previously '''
+    uu_edges = np.linspace(-nw, nw, num_bin + 1)
+    vv_edges = np.linspace(-nw, nw, num_bin + 1)
+    n_arr = np.zeros((num_bin, num_bin), dtype=np.complex64)
+    uu_comb = np.concatenate((uu_a, -uu_a))
+    vv_comb = np.concatenate((vv_a, -vv_a))
+    all_v = np.concatenate((vis_l, np.conjugate(vis_l)))
+    h_real, _, _ = np.histogram2d(vv_comb, uu_comb, weights=all_v.real, bins=[vv_edges, uu_edges])
+    h_imag, _, _ = np.histogram2d(vv_comb, uu_comb, weights=all_v.imag, bins=[vv_edges, uu_edges])
+    num_entries, _, _ = np.histogram2d(vv_comb, uu_comb, bins=[vv_edges, uu_edges])
+    n_arr[:, :] = h_real + (1j * h_imag)
+    pos = np.where(num_entries.__gt__(1))
+    n_arr[pos] /= num_entries[pos]
+    return n_arr
+
+
+class TestGridding(unittest.TestCase):
+
+    def test_matches_histogram(self):
+        nw = 10.0
+        num_bin = 64
+        uu = np.random.uniform(-12, 12, 500)
+        vv = np.random.uniform(-12, 12, 500)
+        # Include points on the cell edges
+        uu[0:3] = [-nw, nw, 0.0]
+        vv[0:3] = [nw, 0.0, -nw]
+        vis = np.random.normal(size=500) + 1.0j * np.random.normal(size=500)
+
+        dut, num_entries = gridding.grid(uu, vv, vis, num_bin, nw)
+        expected = histogram_uvplane(uu, vv, vis, num_bin, nw)
+        self.assertTrue(np.allclose(dut, expected, atol=1e-5))
+        self.assertEqual(num_entries.sum(), 2 * np.sum((np.abs(uu) <= nw) & (np.abs(vv) <= nw)))
+
+    def test_index_cache(self):
+        uu = np.random.uniform(-5, 5, 100)
+        vv = np.random.uniform(-5, 5, 100)
+        idx1 = gridding.get_grid_indices(uu, vv, 32, 6.0)
+        self.assertIs(idx1, gridding.get_grid_indices(uu.copy(), vv.copy(), 32, 6.0))
+        self.assertIsNot(idx1, gridding.get_grid_indices(uu, vv, 64, 6.0))
+
+    def test_synthesis_uvplane(self):
+        cv_list = [dummy_cal_vis() for _ in range(3)]
+        syn = synthesis.Synthesis_Imaging(cv_list)
+        n_arr, uu_edges, vv_edges = syn.get_uvplane(num_bin=128, nw=32)
+
+        uu, vv, vis = [], [], []
+        for cv in cv_list:
+            uu_a, vv_a, ww_a = cv.get_all_uvw()
+            uu.append(uu_a / constants.L1_WAVELENGTH)
+            vv.append(vv_a / constants.L1_WAVELENGTH)
+            vis.append(cv.get_all_visibility()[0])
+        expected = histogram_uvplane(np.concatenate(uu), np.concatenate(vv),
+                                     np.concatenate(vis), 128, 32)
+        self.assertTrue(np.allclose(n_arr, expected, atol=1e-5))
+
+    def test_kernel_table(self):
+        for r in [1.5, 2.5, 3.5]:
+            table = gridding.get_kernel_table(r)
+            self.assertIs(table, gridding.get_kernel_table(r))
+            # Sampled at whole cells the kernel sums to one, for any sub-cell offset
+            os = gridding.KERNEL_OVERSAMPLE
+            centre = (len(table) - 1) // 2
+            for offset in [0, os // 4, os // 2]:
+                sup = np.arange((centre + offset) % os, len(table), os)
+                self.assertAlmostEqual(table[sup].sum(), 1.0, places=2)
+
+    def test_kernel_point_source(self):
+        ''' The grid corrected kernel image matches a direct Fourier transform '''
+        nw = 8.0
+        num_bin = 64
+        du = 2 * nw / num_bin
+        uu = np.random.uniform(-6, 6, 300)
+        vv = np.random.uniform(-6, 6, 300)
+        vis = np.exp(-2j * np.pi * (uu * 0.1 - vv * 0.15))
+
+        x = (np.arange(num_bin) - num_bin // 2) / (num_bin * du)
+        u_all = np.concatenate((uu, -uu))
+        v_all = np.concatenate((vv, -vv))
+        expected = np.einsum('k,yk,xk->yx', np.concatenate((vis, np.conjugate(vis))),
+                             np.exp(2j * np.pi * np.outer(x, v_all)),
+                             np.exp(2j * np.pi * np.outer(x, u_all))) / num_bin**2
+
+        # The kernel weights sum to the number of cells nearest-cell gridding occupies
+        grid_idx = gridding.get_grid_indices(uu, vv, num_bin, nw)
+        n_cells = len(np.unique(grid_idx[grid_idx >= 0]))
+        expected *= n_cells / (2 * len(uu))
+
+        plane, weight_sum = gridding.grid(uu, vv, vis, num_bin, nw, grid_kernel_r_pixels=3.5)
+        self.assertAlmostEqual(weight_sum.sum(), n_cells, places=3)
+        img = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(plane)))
+        img /= gridding.get_grid_correction(3.5, num_bin)
+
+        inner = slice(num_bin // 4, 3 * num_bin // 4)
+        err = np.abs(img - expected)[inner, inner].max() / np.abs(expected).max()
+        self.assertLess(err, 1e-2)
+
+    def test_kernel_synthesis(self):
+        cv_list = [dummy_cal_vis() for _ in range(2)]
+        syn = synthesis.Synthesis_Imaging(cv_list)
+        ift, extent = syn.get_ift(nw=32, num_bin=128, grid_kernel_r_pixels=2.5)
+        self.assertEqual(ift.shape, (128, 128))
+        self.assertTrue(np.all(np.isfinite(ift)))
+
+        # Both beams peak at the number of occupied cells
+        beam = syn.get_beam(nw=32, num_bin=128, use_kernel=True)
+        nearest = syn.get_beam(nw=32, num_bin=128, use_kernel=False)
+        self.assertEqual(nearest.shape, (128, 128))
+        self.assertAlmostEqual(beam[64, 64].real / nearest[64, 64].real, 1.0, places=2)
+
+    def test_kernel_flux_scale(self):
+        ''' A point source has the same peak brightness with and without the kernel '''
+        # Near the zenith, where nearest-cell gridding loses little coherence
+        cv = point_source_cal_vis(80.0, 30.0)
+        syn = synthesis.Synthesis_Imaging([cv, cv])
+
+        nearest = np.abs(syn.get_ift(nw=32, num_bin=128)[0]).max()
+        for r in [2.5, 3.5]:
+            kernel = np.abs(syn.get_ift(nw=32, num_bin=128, grid_kernel_r_pixels=r)[0]).max()
+            self.assertAlmostEqual(kernel / nearest, 1.0, delta=0.05)
+            rift = syn.get_rift(nw=32, num_bin=128, grid_kernel_r_pixels=r)[0].max()
+            self.assertAlmostEqual(rift / nearest, 1.0, delta=0.05)
+
+    def test_index_store(self):
+        uu = np.random.uniform(-5, 5, 100)
+        vv = np.random.uniform(-5, 5, 100)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            idx = gridding.get_grid_indices(uu, vv, 32, 7.0, cache_dir=cache_dir)
+            key = gridding.uv_key(uu, vv, 32, 7.0)
+            self.assertTrue(os.path.exists(gridding.get_index_file(cache_dir, key)))
+            self.assertTrue(np.array_equal(gridding.load_grid_indices(cache_dir, key), idx))
+            # A different grid has a different file
+            self.assertIsNone(gridding.load_grid_indices(cache_dir, gridding.uv_key(uu, vv, 64, 7.0)))
+
+            gridding._index_cache.clear()
+            self.assertTrue(np.array_equal(gridding.get_grid_indices(uu, vv, 32, 7.0, cache_dir=cache_dir), idx))
+
+    def test_synthesis_zenith(self):
+        cv = dummy_cal_vis()
+        syn = synthesis.Synthesis_Imaging([cv])
+        uu, vv, ww, vis = syn.get_uuvvwwvis_zenith()
+        grid_idxs = syn.get_grid_idxs(uu, vv, 64, 32)
+        self.assertEqual(grid_idxs.shape, (len(vis), 4))
+
+        edges = gridding.get_edges(64, 32)
+        self.assertTrue(np.array_equal(grid_idxs[:, 0], gridding.cell_index(uu, edges)))
+        self.assertTrue(np.array_equal(grid_idxs[:, 3], gridding.cell_index(-vv, edges)))
+
+        n_arr = syn.get_uvplane_zenith(num_bin=64, nw=32)
+        expected = histogram_uvplane(uu, vv, vis, 64, 32)
+        self.assertTrue(np.allclose(n_arr.filled(0), expected, atol=1e-5))
+        self.assertEqual(n_arr.count(), np.count_nonzero(expected))
+
+    def test_rfft_image(self):
+        cv_list = [dummy_cal_vis() for _ in range(2)]
+        syn = synthesis.Synthesis_Imaging(cv_list)
+        num_bin, nw = 128, 32
+
+        img, extent = syn.get_rift(nw=nw, num_bin=num_bin)
+        self.assertEqual(img.shape, (num_bin, num_bin))
+        self.assertFalse(np.iscomplexobj(img))
+        self.assertEqual(extent, syn.get_ift(nw=nw, num_bin=num_bin)[1])
+
+        # The nearest-cell image is the real part of that of get_ift
+        for n in [128, 127]:
+            ift, _ = syn.get_ift(nw=nw, num_bin=n)
+            img, _ = syn.get_rift(nw=nw, num_bin=n)
+            self.assertTrue(np.allclose(img, ift.real, atol=1e-7))
+
+        for n in [128, 127]:
+            ift, _ = syn.get_ift(nw=nw, num_bin=n, grid_kernel_r_pixels=2.5)
+            img, _ = syn.get_rift(nw=nw, num_bin=n, grid_kernel_r_pixels=2.5)
+            self.assertTrue(np.allclose(img, ift.real, atol=1e-6))
+
+    def test_half_plane_indices(self):
+        num_bin = 8
+        half = num_bin // 2
+        # Centred cells (v, u) -> FFT order (kv mod num_bin, ku), u < 0 dropped
+        centred = np.array([half * num_bin + half, (half + 1) * num_bin + half + 3,
+                            (half - 2) * num_bin + half, half * num_bin + half - 1,
+                            half * num_bin, -1])
+        expected = np.array([0, 1 * (half + 1) + 3, (num_bin - 2) * (half + 1), -1, half, -1])
+        self.assertTrue(np.array_equal(gridding.to_half_plane(centred, num_bin), expected))
+        # With an odd num_bin there is no Nyquist column
+        self.assertEqual(gridding.to_half_plane(np.array([7 * 9]), 9).tolist(), [-1])
+        # Mirrored cells (v, u) -> (-v, -u) about the centre, modulo num_bin
+        mirrored = gridding.mirror_indices(centred, num_bin)
+        self.assertEqual(mirrored.tolist(), [half * num_bin + half, (half - 1) * num_bin + half - 3,
+                                             (half + 2) * num_bin + half, half * num_bin + half + 1,
+                                             half * num_bin, -1])
+        # (kv, ku) = (0, 0), (0, 1), (1, 0), (1, 3)
+        self.assertTrue(np.array_equal(gridding.shift_signs(np.array([0, 1, 5, 8]), num_bin), [1, -1, -1, 1]))
@@ -1,42 +1,25 @@
+import json
+import os
+import tempfile
 import unittest
 
+import h5py
 import numpy as np
 
 from tart.imaging import visibility
-from tart.operation import settings
+from tart.imaging.test.helpers import dummy_vis
 from tart.util import angle, skyloc, utc
 
 VIS_DATA_FILE = "tart/test/test_data/fpga_2019-02-22_05_11_41.765212.vis"
-ANT_POS_FILE = "tart/test/test_calibrated_antenna_positions.json"
-
-
-def dummy_vis():
-    config = settings.from_file("tart/test/test_telescope_config.json")
-    ret = visibility.Visibility.from_config(config=config, timestamp=utc.now())
-    b = []
-    v = []
-    for j in range(24):
-        for i in range(24):
-            if i > j:
-                b.append([j, i])
-                v.append(np.random.uniform(0, 1) + np.random.uniform(0, 1) * (1.0j))
-    ret.set_visibilities(b=b, v=np.array(v))
-    return ret
 
 
 def dummy_vis_list():
-    ret = []
-    for i in range(2):
-        ret.append(dummy_vis())
-    return ret
+    return [dummy_vis() for _ in range(2)]
 
 
 class TestVisibility(unittest.TestCase):
     def setUp(self):
         self.v_array = dummy_vis_list()
-        self.v_array[0].config.load_antenna_positions(
-            cal_ant_positions_file=ANT_POS_FILE
-        )
         self.ant_pos=self.v_array[0].config.get_antenna_positions()
 
     def check_vis(self, dut, dut2):
@@ -47,12 +30,22 @@ class TestVisibility(unittest.TestCase):
 
         keys = dut.config.Dict.keys()
         for k in keys:
-            self.assertEqual(dut.config.Dict[k], dut2.config.Dict[k])
+            if k == "antenna_positions":
+                self.assertTrue(np.allclose(dut.config.get_antenna_positions(),
+                                            dut2.config.get_antenna_positions()))
+            else:
+                self.assertEqual(dut.config.Dict[k], dut2.config.Dict[k])
 
     def test_load_save(self):
         dut = dummy_vis()
-        visibility.Visibility_Save_JSON(self.v_array[0], "test_vis.json")
-        # TODO add tests here
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "test_vis.json")
+            visibility.Visibility_Save_JSON(dut, fname)
+            with open(fname) as f:
+                ret = json.load(f)
+        self.assertEqual(len(ret["vis"]), len(dut.v))
+        self.assertTrue(np.array_equal([complex(x) for x in ret["vis"]], dut.v))
+        self.assertEqual(ret["baselines"], dut.baselines)
 
     def test_list_load_save_hdf(self):
         dut_list = dummy_vis_list()
@@ -76,6 +69,19 @@ class TestVisibility(unittest.TestCase):
         vl = dut2['vis_list']
         self.check_vis(dut, vl[0])
 
+    def test_hdf5_string_timestamps(self):
+        """ Files written before timestamp_ns was stored must still load """
+        dut_list = dummy_vis_list()
+        fname = "test_vis_strings.hdf"
+        visibility.to_hdf5(dut_list, ant_pos=self.ant_pos,
+                           cal_gain=[0], cal_ph=[0], filename=fname)
+        with h5py.File(fname, "a") as h5f:
+            self.assertEqual(h5f["timestamp_ns"][1], utc.to_epoch_ns(dut_list[1].timestamp))
+            del h5f["timestamp_ns"]
+        ret = visibility.from_hdf5(fname)
+        os.remove(fname)
+        self.assertEqual(ret["timestamps"], [v.timestamp for v in dut_list])
+
 
     def test_zero_rotation(self):
         v = self.v_array[0]
@@ -109,5 +115,106 @@ class TestVisibility(unittest.TestCase):
         v_after = np.array(v.v)
         self.assertAlmostEqual(v.phase_el.to_degrees(), el1.to_degrees(), 0)
         for x, y in zip(v_before, v_after):
-            self.assertAlmostEqual(np.angle(x), np.angle(y), 1)
+            # The phases may wrap at +/- pi
+            self.assertAlmostEqual(np.angle(y / x), 0.0, 1)
             self.assertAlmostEqual(np.abs(x), np.abs(y), 2)
+
+    def test_lookup(self):
+        dut = dummy_vis()
+        self.assertEqual(dut.bl_arr.shape, (len(dut.baselines), 2))
+        for k, b in enumerate(dut.baselines):
+            self.assertEqual(dut.vis(b[0], b[1]), dut.v[k])
+            self.assertEqual(dut.vis(b[1], b[0]), np.conjugate(dut.v[k]))
+        with self.assertRaises(RuntimeError):
+            dut.vis(3, 3)
+        with self.assertRaises(RuntimeError):
+            dut.vis(0, 99)
+
+    def test_vis_array(self):
+        dut = dummy_vis()
+        i = np.array([0, 5, 23, 7])
+        j = np.array([1, 2, 4, 8])
+        v = dut.vis_array(i, j)
+        for k in range(len(i)):
+            self.assertEqual(v[k], dut.vis(i[k], j[k]))
+        with self.assertRaises(RuntimeError):
+            dut.vis_array([0, 1], [2, 1])
+
+    def test_legacy_pickle(self):
+        vis_list = visibility.from_pkl(VIS_DATA_FILE)
+        dut = vis_list[0]
+        self.assertTrue(isinstance(dut.v, np.ndarray))
+        self.assertTrue(np.iscomplexobj(dut.v))
+        b = dut.baselines[10]
+        self.assertEqual(dut.vis(b[0], b[1]), dut.v[10])
+
+        fname = "test_vis_array.pkl"
+        visibility.to_pkl(vis_list, fname)
+        dut2 = visibility.from_pkl(fname)[0]
+        self.check_vis(dut, dut2)
+        self.assertTrue((dut.bl_arr == dut2.bl_arr).all())
+        os.remove(fname)
+
+    def test_rotation_matches_per_baseline(self):
+        from tart.simulation import antennas
+        from tart.simulation.simulation_source import HorizontalSource
+
+        v = self.v_array[0]
+        v_before = np.array(v.v)
+        ra, decl = v.config.get_loc().horizontal_to_equatorial(v.timestamp, v.phase_el, v.phase_az)
+        sky = skyloc.Skyloc(ra + angle.from_dms(5.0), decl + angle.from_dms(10.0))
+        v.rotate(sky)
+
+        loc = v.config.get_loc()
+        el, az = loc.equatorial_to_horizontal(v.timestamp, sky.ra, sky.dec)
+        hsource = HorizontalSource(r=9.0e99, azimuth=az, elevation=el)
+        ant_pos = v.config.get_antenna_positions()
+        omega = v.config.get_operating_frequency() * 2.0 * np.pi
+        for k in [0, 50, 275]:
+            b = v.baselines[k]
+            a0 = antennas.Antenna(loc, ant_pos[b[0]])
+            a1 = antennas.Antenna(loc, ant_pos[b[1]])
+            tg = antennas.get_geo_delay_horizontal(a0, a1, hsource)
+            self.assertAlmostEqual(v.v[k], v_before[k] * np.exp(-1.0j * omega * tg), 10)
+
+    def test_rotate_list(self):
+        config = self.v_array[0].config
+        vis_list = [dummy_vis() for _ in range(3)]
+        for k, vis in enumerate(vis_list):
+            vis.config = config
+            vis.timestamp = utc.utc_datetime(2019, 2, 22, 5, 11 + 10 * k, 41)
+        expected = []
+        for vis in vis_list:
+            dut = visibility.Visibility.from_config(config, vis.timestamp)
+            dut.set_visibilities(b=vis.baselines, v=np.array(vis.v))
+            expected.append(dut)
+
+        sky = skyloc.Skyloc(angle.from_dms(30.0), angle.from_dms(-45.0))
+        visibility.rotate(vis_list, sky)
+        for vis, dut in zip(vis_list, expected):
+            dut.rotate(sky)
+            self.assertTrue(np.allclose(vis.v, dut.v))
+            self.assertEqual(vis.phase_el.to_degrees(), dut.phase_el.to_degrees())
+
+    def test_json_layouts(self):
+        dut = dummy_vis()
+        for layout in [visibility.JSON_ROWS, visibility.JSON_COLUMNAR, visibility.JSON_BASE64]:
+            vis_json = json.loads(json.dumps(dut.to_json(layout)))
+            dut2 = visibility.Visibility.from_json(vis_json, dut.config)
+            self.assertEqual(dut2.baselines, dut.baselines)
+            self.assertEqual(dut2.timestamp, dut.timestamp)
+            tol = 1e-6 if layout == visibility.JSON_BASE64 else 0.0
+            self.assertTrue(np.allclose(dut2.v, dut.v, rtol=0, atol=tol))
+
+        with self.assertRaises(ValueError):
+            dut.to_json("xml")
+
+    def test_json_legacy_rows(self):
+        """ The per-baseline layout produced by the API must still be readable """
+        dut = dummy_vis()
+        data = [{"i": b[0], "j": b[1], "re": float(v.real), "im": float(v.imag)}
+                for b, v in zip(dut.baselines, dut.v)]
+        v, baselines = visibility.json_decode(data)
+        self.assertEqual(baselines, dut.baselines)
+        self.assertTrue((v == dut.v).all())
+        self.assertEqual(dut.to_json()["data"], data)
@@ -0,0 +1,83 @@
+import datetime
+import os
+import unittest
+
+import numpy as np
+
+from tart.imaging import visibility
+from tart.imaging.test.helpers import dummy_baselines, dummy_config, dummy_vis
+from tart.imaging.visibility_series import VisibilityTimeSeries
+from tart.util import utc
+
+
+class TestVisibilityTimeSeries(unittest.TestCase):
+
+    def setUp(self):
+        self.config = dummy_config()
+        self.ant_pos = self.config.get_antenna_positions()
+        self.baselines = dummy_baselines()
+        self.t0 = utc.utc_datetime(2019, 2, 22, 5, 11, 41)
+        self.n_t = 20
+        n_bl = len(self.baselines)
+        self.v = (np.random.normal(size=(self.n_t, n_bl)) +
+                  1.0j * np.random.normal(size=(self.n_t, n_bl))).astype(np.complex64)
+        self.ts = [self.t0 + datetime.timedelta(seconds=k) for k in range(self.n_t)]
+        self.fname = "test_vis_series.hdf"
+
+    def tearDown(self):
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def create(self):
+        return VisibilityTimeSeries.create(self.fname, self.config, self.baselines,
+                                           self.ant_pos, chunk_rows=8)
+
+    def test_append_and_read(self):
+        with self.create() as dut:
+            dut.append(self.v[0:5], self.ts[0:5])
+            dut.append(self.v[5], self.ts[5], gains=2 * np.ones(24))
+            dut.append(self.v[6:], utc.to_epoch_ns(self.ts[6:]))
+            self.assertEqual(len(dut), self.n_t)
+
+        with VisibilityTimeSeries(self.fname) as dut:
+            self.assertEqual(len(dut), self.n_t)
+            self.assertEqual(dut.timestamps, self.ts)
+            rows = dut.read()
+            self.assertTrue(np.array_equal(rows["vis"], self.v))
+            self.assertEqual(rows["gain"][5, 0], 2.0)
+            self.assertEqual(rows["gain"][6, 0], 1.0)
+
+            vis = dut.get_visibility(7)
+            self.assertEqual(vis.timestamp, self.ts[7])
+            self.assertEqual(vis.vis(3, 1), np.conjugate(self.v[7][vis.bl_index[1, 3]]))
+
+    def test_time_range(self):
+        with self.create() as dut:
+            dut.append(self.v, self.ts)
+            rows = dut.select(self.ts[3], self.ts[11])
+            self.assertTrue(np.array_equal(rows["vis"], self.v[3:11]))
+            self.assertEqual(dut.get_range(None, self.ts[2]), slice(0, 2))
+            self.assertEqual(dut.get_range(self.ts[-1] + datetime.timedelta(seconds=1)),
+                             slice(self.n_t, self.n_t))
+
+            vis_list = list(dut.iter_visibilities(self.ts[2], self.ts[17], block_rows=4))
+            self.assertEqual(len(vis_list), 15)
+            self.assertEqual(vis_list[0].timestamp, self.ts[2])
+            self.assertTrue(np.array_equal(vis_list[-1].v, self.v[16]))
+
+    def test_append_order(self):
+        with self.create() as dut:
+            dut.append(self.v[5:], self.ts[5:])
+            with self.assertRaises(ValueError):
+                dut.append(self.v[0], self.ts[0])
+
+    def test_legacy_reader(self):
+        with self.create() as dut:
+            vis_list = [dummy_vis(v, config=self.config, timestamp=ts)
+                        for v, ts in zip(self.v, self.ts)]
+            dut.append_vis(vis_list)
+
+        ret = visibility.from_hdf5(self.fname)
+        self.assertEqual(ret["timestamps"], self.ts)
+        self.assertEqual(len(ret["vis_list"]), self.n_t)
+        self.assertTrue(np.array_equal(ret["vis_list"][4].v, self.v[4]))
@@ -1,3 +1,4 @@
+import base64
 import json
 import os
 
@@ -14,9 +15,69 @@ from tart.simulation.simulation_source import HorizontalSource
 from tart.util import angle, utc
 
 
+"""
+    JSON codec for the visibility data
+
+    JSON_ROWS      a list with one {'i', 'j', 're', 'im'} dict per baseline
+    JSON_COLUMNAR  a dict of parallel lists {'i': [], 'j': [], 're': [], 'im': []}
+    JSON_BASE64    a dict {'i': [], 'j': [], 'vis': '...'} where vis is the
+                   base64 encoding of the little-endian complex64 visibilities
+"""
+JSON_ROWS = "rows"
+JSON_COLUMNAR = "columnar"
+JSON_BASE64 = "base64"
+
+
+def json_encode(baselines, v, layout=JSON_ROWS):
+    """
+    Encode an (n_bl, 2) array of baselines and the visibilities for JSON.
+    """
+    bl = np.asarray(baselines, dtype=np.int64).reshape(-1, 2)
+    v = np.asarray(v)
+    i = bl[:, 0].tolist()
+    j = bl[:, 1].tolist()
+    if layout == JSON_ROWS:
+        return [{'i': a, 'j': b, 're': re, 'im': im}
+                for a, b, re, im in zip(i, j, v.real.tolist(), v.imag.tolist())]
+    if layout == JSON_COLUMNAR:
+        return {'i': i, 'j': j, 're': v.real.tolist(), 'im': v.imag.tolist()}
+    if layout == JSON_BASE64:
+        blob = np.ascontiguousarray(v, dtype="<c8").tobytes()
+        return {'i': i, 'j': j, 'vis': base64.b64encode(blob).decode('ascii')}
+    raise ValueError(f"Unknown JSON layout '{layout}'")
+
+
+def json_decode(data):
+    """
+    Decode visibility data written by json_encode() in any layout.
+    Returns the complex visibilities (ndarray) and the list of baselines.
+    """
+    if isinstance(data, list):
+        if len(data) == 0:
+            return np.zeros(0, dtype=np.complex128), []
+        cols = np.array([(d['i'], d['j'], d['re'], d['im']) for d in data], dtype=np.float64)
+        v = cols[:, 2] + 1.0j * cols[:, 3]
+        baselines = cols[:, 0:2].astype(np.int64).tolist()
+        return v, baselines
+
+    baselines = np.stack([np.asarray(data['i'], dtype=np.int64),
+                          np.asarray(data['j'], dtype=np.int64)], axis=1).tolist()
+    if 'vis' in data:
+        v = np.frombuffer(base64.b64decode(data['vis']), dtype="<c8").astype(np.complex128)
+    else:
+        v = np.asarray(data['re'], dtype=np.float64) + 1.0j * np.asarray(data['im'], dtype=np.float64)
+    if len(v) != len(baselines):
+        raise ValueError(f"{len(v)} visibilities for {len(baselines)} baselines")
+    return v, baselines
+
+
 class Visibility:
     """
     A container class for visibilities from a single observation.
+
+    The visibilities (v) are held as a complex ndarray, and the baselines as
+    a list of [i, j] pairs, with an (n_bl, 2) integer array copy (bl_arr) and
+    an antenna pair to baseline index table for O(1) lookup.
     """
     def __init__(self, config, timestamp,
                     phase_el, phase_az):
@@ -45,6 +106,80 @@ class Visibility:
         self.baselines = b
         self.v = v
 
+    @property
+    def v(self):
+        return self._v
+
+    @v.setter
+    def v(self, v):
+        v = np.asarray(v)
+        if not np.iscomplexobj(v):
+            v = v.astype(np.complex128)
+        self._v = v
+
+    @property
+    def baselines(self):
+        return self._baselines
+
+    @baselines.setter
+    def baselines(self, b):
+        self._baselines = b
+        self.bl_arr = np.array(b, dtype=np.int64).reshape(-1, 2)
+        n_ant = int(self.bl_arr.max()) + 1 if len(self.bl_arr) > 0 else 0
+        self.bl_index = np.full((n_ant, n_ant), -1, dtype=np.int64)
+        self.bl_index[self.bl_arr[:, 0], self.bl_arr[:, 1]] = np.arange(len(self.bl_arr))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ["_v", "_baselines", "bl_arr", "bl_index"]:
+            state.pop(k, None)
+        if "_baselines" in self.__dict__:
+            state["baselines"] = self._baselines
+        if "_v" in self.__dict__:
+            state["v"] = self._v
+        return state
+
+    def __setstate__(self, state):
+        # Also used for pickles written before the visibilities were array backed.
+        state = dict(state)
+        b = state.pop("baselines", None)
+        v = state.pop("v", None)
+        self.__dict__.update(state)
+        if b is not None:
+            self.baselines = b
+        if v is not None:
+            self.v = v
+
+    def get_index(self, i, j):
+        """
+        Return the baseline indices and a conjugation mask for arrays of
+        antenna pairs (i, j). Pairs with j < i refer to the conjugate of the
+        baseline [j, i]. An index of -1 marks a pair with no baseline.
+        """
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+        conj = j < i
+        a = np.where(conj, j, i)
+        b = np.where(conj, i, j)
+        n_ant = self.bl_index.shape[0]
+        valid = (a >= 0) & (b < n_ant) & (a != b)
+        idx = np.full(a.shape, -1, dtype=np.int64)
+        idx[valid] = self.bl_index[a[valid], b[valid]]
+        return idx, conj
+
+    def vis_array(self, i, j):
+        """
+        Return the visibilities for arrays of antenna pairs (i, j), conjugating
+        those with j < i.
+        """
+        idx, conj = self.get_index(i, j)
+        if np.any(idx < 0):
+            bad = np.argwhere(np.atleast_1d(idx) < 0)[0][0]
+            i_bad, j_bad = np.atleast_1d(i)[bad], np.atleast_1d(j)[bad]
+            raise RuntimeError("Baseline [%d,%d] is invalid" % (i_bad, j_bad))
+        ret = self.v[idx]
+        return np.where(conj, np.conjugate(ret), ret)
+
     r"""Rotated one, aimed at ra, decl
 
     Justification:
@@ -69,44 +204,36 @@ class Visibility:
     """
 
     def rotate(self, sky_location):
-        from tart.simulation import antennas
-
-        stopped_vis = []
         omega = self.config.get_operating_frequency() * 2.0 * np.pi
         # Now we must do fringe stopping
 
-        loc = self.config.get_loc()
-        el, az = loc.equatorial_to_horizontal(
-            self.timestamp, sky_location.ra, sky_location.dec
-        )
-        hsource = HorizontalSource(r=9.0e99, azimuth=az, elevation=el)
-
-        ant_pos = self.config.get_antenna_positions()
-        for v, b in zip(self.v, self.baselines):
-            a0 = antennas.Antenna(loc, ant_pos[b[0]])
-            a1 = antennas.Antenna(loc, ant_pos[b[1]])
-
-            tg = antennas.get_geo_delay_horizontal(a0, a1, hsource)
-            # tg is t_a1 - t_a0
-            # (negative if a1 is closer to source than a0)
+        el, az, delays = self.get_delays(sky_location)
 
-            # print(b, omega*tg)
-            v = v * np.exp(-1.0j * omega * tg)
-            stopped_vis.append(v)
+        # tg is t_a1 - t_a0
+        # (negative if a1 is closer to source than a0)
+        tg = delays[self.bl_arr[:, 1]] - delays[self.bl_arr[:, 0]]
 
         self.phase_el = el
         self.phase_az = az
-        self.v = stopped_vis
+        self.v = self.v * np.exp(-1.0j * omega * tg)
+
+    def get_delays(self, sky_location):
+        """
+        Return the elevation and azimuth of the sky_location at the time
+        of this observation, and the geometric delays of every antenna.
+        """
+        return get_delays(self.config, self.timestamp, sky_location)
 
     def vis(self, i, j):
         if j == i:
             raise RuntimeError("Baseline [%d,%d] is invalid" % (i, j))
         if j < i:  # The first index should be before the second
             return np.conjugate(self.vis(j, i))
-        for k, b in enumerate(self.baselines):
-            if b == [i, j]:
-                return self.v[k]
-        raise RuntimeError("Baseline [%d,%d] is invalid" % (i, j))
+        n_ant = self.bl_index.shape[0]
+        k = self.bl_index[i, j] if (0 <= i and j < n_ant) else -1
+        if k < 0:
+            raise RuntimeError("Baseline [%d,%d] is invalid" % (i, j))
+        return self.v[k]
 
     def get_closure_phase(self, i, j, k):
         return (
@@ -121,22 +248,88 @@ class Visibility:
             ret += " V(%s)=%g, I%g" % (str(b), np.abs(self.v[i]), np.angle(self.v[i]))
         return ret
 
-    def to_json(self):
+    def to_json(self, layout=JSON_ROWS):
+        """
+        Return a JSON serializable dict of the visibilities, in one of the
+        layouts of json_encode(). The default is the per-baseline layout.
+        """
         ret = {}
-        vlist = []
-        for i, b in enumerate(self.baselines):
-            vlist.append({'i': b[0],
-                          'j': b[1],
-                          're': float(np.real(self.v[i])),
-                          'im': float(np.imag(self.v[i]))})
-        ret['data'] = vlist
+        ret['data'] = json_encode(self.bl_arr, self.v, layout)
         ret['timestamp'] = self.timestamp.isoformat()
         return ret
 
+    @classmethod
+    def from_json(cls, vis_json, config):
+        """
+        Create a Visibility from a dict produced by to_json() (in any layout).
+        """
+        ret = cls.from_config(config, utc.from_string(vis_json['timestamp']))
+        v, baselines = json_decode(vis_json['data'])
+        ret.set_visibilities(v, baselines)
+        return ret
+
     def __repr__(self):
         return f"vis(ts={self.timestamp})"
 
 
+def get_delays(config, timestamp, sky_location):
+    """
+    Return the elevation and azimuth of the sky_location at the timestamp,
+    and the geometric delays of every antenna in the config.
+    """
+    from tart.simulation import antennas
+
+    loc = config.get_loc()
+    el, az = loc.equatorial_to_horizontal(
+        timestamp, sky_location.ra, sky_location.dec
+    )
+    hsource = HorizontalSource(r=9.0e99, azimuth=az, elevation=el)
+
+    ant_pos = np.asarray(config.get_antenna_positions())
+    return el, az, antennas.get_geo_delays_horizontal(ant_pos, hsource)
+
+
+def get_fringe_stop(config, timestamp, sky_location, bl_arr):
+    """
+    Return the (n_bl,) phasors exp(-j omega tg) that fringe stop visibilities
+    with the (n_bl, 2) baselines bl_arr to the sky_location (see Visibility.rotate).
+    """
+    _, _, delays = get_delays(config, timestamp, sky_location)
+    omega = config.get_operating_frequency() * 2.0 * np.pi
+    tg = delays[bl_arr[:, 1]] - delays[bl_arr[:, 0]]
+    return np.exp(-1.0j * omega * tg)
+
+
+def rotate(vis_list, sky_location):
+    """
+    Re-phase a list of Visibility objects (possibly with different
+    timestamps) to the sky_location. The antenna delays of each snapshot
+    are computed once, and the phases of snapshots sharing the same
+    baselines are applied in a single array operation.
+    """
+    if len(vis_list) == 0:
+        return
+    tg = []
+    for vis in vis_list:
+        el, az, delays = vis.get_delays(sky_location)
+        vis.phase_el = el
+        vis.phase_az = az
+        tg.append(delays[vis.bl_arr[:, 1]] - delays[vis.bl_arr[:, 0]])
+
+    omega = np.array([vis.config.get_operating_frequency() * 2.0 * np.pi
+                      for vis in vis_list])
+
+    ref = vis_list[0].bl_arr
+    if all(np.array_equal(vis.bl_arr, ref) for vis in vis_list):
+        v = np.stack([vis.v for vis in vis_list])
+        v = v * np.exp(-1.0j * omega[:, None] * np.stack(tg))
+        for vis, v_i in zip(vis_list, v):
+            vis.v = v_i
+    else:
+        for vis, w, t in zip(vis_list, omega, tg):
+            vis.v = vis.v * np.exp(-1.0j * w * t)
+
+
 def Visibility_Lsq(vis1, vis2):
     """ Return least square based on the phases of 2 visibilities """
     if vis1.config.get_num_antenna() == vis2.config.get_num_antenna():
@@ -163,7 +356,8 @@ def Visibility_Save_JSON(vis, filename):
     json_data["phase_az"] = vis.phase_az.to_degrees()
     json_data["config"] = vis.config.Dict
     json_data["baselines"] = vis.baselines
-    json_data["vis"] = vis.v
+    # One string per visibility, as when v was a list
+    json_data["vis"] = [str(x) for x in vis.v]
     with open(filename, "w") as outfile:
         # The default=str handles datetime objects as strings
         json.dump(
@@ -275,6 +469,8 @@ def to_hdf5(vis_list, ant_pos, cal_gain, cal_ph, filename):
         h5f.create_dataset("antenna_positions", data=np.array(ant_pos, dtype=np.float32))
 
         h5f.create_dataset("timestamp", data=np.array(vis_ts, dtype=object), dtype=dt)
+        h5f.create_dataset("timestamp_ns",
+                           data=utc.to_epoch_ns([vis.timestamp for vis in vis_list]))
 
         # ts_dset = h5f.create_dataset('timestamp', (len(vis_ts),), dtype=dt)
         # for i,ts in enumerate(vis_ts):
@@ -297,8 +493,10 @@ def from_hdf5(filename):
         ant_pos = h5f["antenna_positions"][:]
         hdf_phase_elaz = h5f["phase_elaz"][:]
 
-        hdf_timestamps = h5f["timestamp"]
-        timestamps = [utc.from_string(x) for x in hdf_timestamps]
+        if "timestamp_ns" in h5f:
+            timestamps = utc.from_epoch_ns(h5f["timestamp_ns"][:])
+        else:
+            timestamps = utc.from_strings(h5f["timestamp"][:])
 
         hdf_vis = h5f["vis"][:]
         config.set_antenna_positions(ant_pos)
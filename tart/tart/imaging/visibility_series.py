@@ -0,0 +1,260 @@
+#
+# An appendable, columnar store for a time series of visibilities.
+#
+# The visibilities are held in resizable, chunked HDF5 datasets so that
+# snapshots can be appended during live ingest, and time ranges can be read
+# without loading the whole file. The file keeps the datasets of the
+# visibility.to_hdf5() format, so visibility.from_hdf5() can also read it.
+#
+#   vis           complex64 (n_t, n_bl)
+#   timestamp_ns  int64 (n_t,) nanoseconds since the unix epoch
+#   timestamp     isoformat strings (n_t,)
+#   row_gains     float32 (n_t, n_ant) the gains in force for each snapshot
+#   row_phases    float32 (n_t, n_ant) the phases in force for each snapshot
+#   gains, phases the calibration supplied when the file was created
+#
+# Files of averaged visibilities (create(..., with_variance=True)) also have
+#
+#   vis_var       float32 (n_t, n_bl) the variance of the averaged visibilities
+#   n_avg         int64 (n_t,) the number of snapshots in each average
+#
+import h5py
+import numpy as np
+
+from tart.imaging import visibility
+from tart.operation import settings
+from tart.util import angle, utc
+
+
+class VisibilityTimeSeries:
+    '''
+        A time series of visibilities stored in an appendable HDF5 file.
+
+        Use VisibilityTimeSeries.create() to make a new file, or open an
+        existing one with VisibilityTimeSeries(filename, mode). The snapshots
+        must be appended in time order.
+    '''
+
+    def __init__(self, filename, mode="r"):
+        self.filename = filename
+        self.h5f = h5py.File(filename, mode)
+        self.config = settings.from_json(np.bytes_(self.h5f["config"][0]))
+        self.ant_pos = self.h5f["antenna_positions"][:]
+        self.config.set_antenna_positions(self.ant_pos)
+        self.baselines = self.h5f["baselines"][:].tolist()
+        phase_elaz = self.h5f["phase_elaz"][:]
+        self.phase_el = angle.from_dms(phase_elaz[0])
+        self.phase_az = angle.from_dms(phase_elaz[1])
+        self._timestamp_ns = None
+
+    @classmethod
+    def create(cls, filename, config, baselines, ant_pos, cal_gain=None, cal_ph=None,
+               phase_el=None, phase_az=None, chunk_rows=256, compression=None,
+               with_variance=False):
+        '''
+            Create a new (empty) time series file, and return it open for appending.
+
+            - baselines the list of [i, j] baselines (the columns of the vis dataset)
+            - ant_pos the antenna positions
+            - cal_gain, cal_ph the calibration (default unity gain and zero phase),
+              used for appended rows that do not supply their own.
+            - chunk_rows the number of snapshots in each HDF5 chunk
+            - with_variance also store the variance and number of snapshots
+              of each (averaged) row
+        '''
+        num_ant = len(ant_pos)
+        n_bl = len(baselines)
+        if cal_gain is None:
+            cal_gain = np.ones(num_ant)
+        if cal_ph is None:
+            cal_ph = np.zeros(num_ant)
+        if phase_el is None:
+            phase_el = angle.from_dms(90.0)
+        if phase_az is None:
+            phase_az = angle.from_dms(0.0)
+
+        with h5py.File(filename, "w") as h5f:
+            conftype = h5py.special_dtype(vlen=bytes)
+            conf_dset = h5f.create_dataset("config", (1,), dtype=conftype)
+            conf_dset[0] = config.to_json()
+            h5f.create_dataset("phase_elaz",
+                               data=[phase_el.to_degrees(), phase_az.to_degrees()])
+            h5f.create_dataset("baselines", data=np.array(baselines).reshape(-1, 2))
+            h5f.create_dataset("gains", data=np.array(cal_gain, dtype=np.float32))
+            h5f.create_dataset("phases", data=np.array(cal_ph, dtype=np.float32))
+            h5f.create_dataset("antenna_positions", data=np.array(ant_pos, dtype=np.float32))
+
+            h5f.create_dataset("vis", shape=(0, n_bl), maxshape=(None, n_bl),
+                               dtype=np.complex64, chunks=(chunk_rows, n_bl),
+                               compression=compression)
+            h5f.create_dataset("timestamp_ns", shape=(0,), maxshape=(None,),
+                               dtype=np.int64, chunks=(chunk_rows,))
+            h5f.create_dataset("timestamp", shape=(0,), maxshape=(None,),
+                               dtype=h5py.special_dtype(vlen=str), chunks=(chunk_rows,))
+            for name in ["row_gains", "row_phases"]:
+                h5f.create_dataset(name, shape=(0, num_ant), maxshape=(None, num_ant),
+                                   dtype=np.float32, chunks=(chunk_rows, num_ant))
+            if with_variance:
+                h5f.create_dataset("vis_var", shape=(0, n_bl), maxshape=(None, n_bl),
+                                   dtype=np.float32, chunks=(chunk_rows, n_bl),
+                                   compression=compression)
+                h5f.create_dataset("n_avg", shape=(0,), maxshape=(None,),
+                                   dtype=np.int64, chunks=(chunk_rows,))
+
+        return cls(filename, mode="r+")
+
+    def set_phase_centre(self, phase_el, phase_az):
+        ''' Set the phase centre (angle.Angle elevation and azimuth) of the visibilities '''
+        self.h5f["phase_elaz"][:] = [phase_el.to_degrees(), phase_az.to_degrees()]
+        self.phase_el = phase_el
+        self.phase_az = phase_az
+
+    def close(self):
+        self.h5f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.h5f["vis"].shape[0]
+
+    @property
+    def timestamp_ns(self):
+        ''' The (n_t,) int64 timestamps (nanoseconds since the unix epoch) '''
+        if self._timestamp_ns is None:
+            self._timestamp_ns = self.h5f["timestamp_ns"][:]
+        return self._timestamp_ns
+
+    @property
+    def timestamps(self):
+        ''' The timestamps as a list of UTC datetime objects '''
+        return utc.from_epoch_ns(self.timestamp_ns)
+
+    @property
+    def has_variance(self):
+        return "vis_var" in self.h5f
+
+    def append(self, v, timestamps, gains=None, phases=None, variance=None, n_avg=None):
+        '''
+            Append one or more snapshots.
+
+            - v the visibilities, (n_bl,) or (n_t, n_bl)
+            - timestamps a datetime, a list of datetimes or int64 epoch nanoseconds
+            - gains, phases the calibration of each snapshot, (n_ant,) or
+              (n_t, n_ant) (default: the calibration the file was created with)
+            - variance, n_avg the variance (n_t, n_bl) and number of snapshots (n_t,)
+              of averaged rows, for files created with_variance (default 0 and 1)
+        '''
+        v = np.atleast_2d(np.asarray(v, dtype=np.complex64))
+        n_new = v.shape[0]
+        if isinstance(timestamps, list) or hasattr(timestamps, "tzinfo"):
+            ts_ns = np.atleast_1d(utc.to_epoch_ns(timestamps))
+        else:
+            ts_ns = np.atleast_1d(np.asarray(timestamps, dtype=np.int64))
+        if len(ts_ns) != n_new:
+            raise ValueError(f"{n_new} snapshots, but {len(ts_ns)} timestamps")
+
+        n_t = len(self)
+        last = self.h5f["timestamp_ns"][n_t - 1] if n_t > 0 else None
+        if np.any(np.diff(ts_ns) < 0) or (last is not None and ts_ns[0] < last):
+            raise ValueError("Snapshots must be appended in time order")
+
+        if gains is None:
+            gains = self.h5f["gains"][:]
+        if phases is None:
+            phases = self.h5f["phases"][:]
+        num_ant = self.h5f["row_gains"].shape[1]
+        gains = np.broadcast_to(np.asarray(gains, dtype=np.float32), (n_new, num_ant))
+        phases = np.broadcast_to(np.asarray(phases, dtype=np.float32), (n_new, num_ant))
+
+        iso = [ts.isoformat() for ts in utc.from_epoch_ns(ts_ns)]
+        columns = [("vis", v), ("timestamp_ns", ts_ns),
+                   ("timestamp", np.array(iso, dtype=object)),
+                   ("row_gains", gains), ("row_phases", phases)]
+        if self.has_variance:
+            if variance is None:
+                variance = np.zeros(v.shape)
+            if n_avg is None:
+                n_avg = np.ones(n_new)
+            columns.append(("vis_var", np.asarray(variance, dtype=np.float32).reshape(v.shape)))
+            columns.append(("n_avg", np.asarray(n_avg, dtype=np.int64).reshape(n_new)))
+        elif variance is not None or n_avg is not None:
+            raise ValueError("This file was not created with_variance")
+        for name, data in columns:
+            dset = self.h5f[name]
+            dset.resize(n_t + n_new, axis=0)
+            dset[n_t:] = data
+
+        if self._timestamp_ns is not None:
+            self._timestamp_ns = np.concatenate([self._timestamp_ns, ts_ns])
+
+    def append_vis(self, vis_list, gains=None, phases=None):
+        ''' Append a Visibility object, or a list of them, with the baselines of this file '''
+        if isinstance(vis_list, visibility.Visibility):
+            vis_list = [vis_list]
+        for vis in vis_list:
+            if vis.baselines != self.baselines:
+                raise ValueError("The visibility baselines differ from those of the file")
+        self.append(np.stack([vis.v for vis in vis_list]),
+                    [vis.timestamp for vis in vis_list], gains, phases)
+
+    def get_range(self, start=None, stop=None):
+        '''
+            Return the row slice covering the times start <= t < stop
+            (datetimes or epoch nanoseconds, None for an open end).
+        '''
+        def to_ns(t):
+            return utc.to_epoch_ns(t) if hasattr(t, "tzinfo") else np.int64(t)
+
+        ts_ns = self.timestamp_ns
+        i0 = 0 if start is None else int(np.searchsorted(ts_ns, to_ns(start), side="left"))
+        i1 = len(ts_ns) if stop is None else int(np.searchsorted(ts_ns, to_ns(stop), side="left"))
+        return slice(i0, max(i0, i1))
+
+    def read(self, rows=slice(None)):
+        '''
+            Read a slice of rows. Only the HDF5 chunks covering the rows are read.
+
+            Returns a dict with the 'vis', 'timestamp_ns', 'gain' and 'phase'
+            arrays, and the 'variance' and 'n_avg' arrays if the file has them.
+        '''
+        ret = {
+            "vis": self.h5f["vis"][rows],
+            "timestamp_ns": self.h5f["timestamp_ns"][rows],
+            "gain": self.h5f["row_gains"][rows],
+            "phase": self.h5f["row_phases"][rows],
+        }
+        if self.has_variance:
+            ret["variance"] = self.h5f["vis_var"][rows]
+            ret["n_avg"] = self.h5f["n_avg"][rows]
+        return ret
+
+    def select(self, start=None, stop=None):
+        ''' Read the rows with start <= t < stop (see read()) '''
+        return self.read(self.get_range(start, stop))
+
+    def get_visibility(self, index):
+        ''' Return a single snapshot as a Visibility object '''
+        ts = utc.from_epoch_ns(self.h5f["timestamp_ns"][index])
+        return self._to_visibility(self.h5f["vis"][index], ts)
+
+    def _to_visibility(self, v, ts):
+        vis = visibility.Visibility(self.config, ts, self.phase_el, self.phase_az)
+        vis.set_visibilities(v=v, b=self.baselines)
+        return vis
+
+    def iter_visibilities(self, start=None, stop=None, block_rows=None):
+        '''
+            Generate Visibility objects for the times start <= t < stop,
+            reading block_rows snapshots (default: one chunk) at a time.
+        '''
+        rows = self.get_range(start, stop)
+        if block_rows is None:
+            block_rows = self.h5f["vis"].chunks[0]
+        for i in range(rows.start, rows.stop, block_rows):
+            block = self.read(slice(i, min(i + block_rows, rows.stop)))
+            for v, ts in zip(block["vis"], utc.from_epoch_ns(block["timestamp_ns"])):
+                yield self._to_visibility(v, ts)
@@ -1,5 +1,10 @@
+import collections
+import glob
+import hashlib
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 try:
@@ -21,33 +26,116 @@ def boolean_mean(x_bool_arr):
     return ret
 
 
+def hdf5_header(h5f):
+    '''Return the config and timestamp from an open raw observation HDF5 file'''
+    config_json = np.bytes_(h5f['config'][0])
+    config = settings.from_json(config_json)
+    if 'timestamp_ns' in h5f:
+        timestamp = utc.from_epoch_ns(h5f['timestamp_ns'][0])
+    else:
+        timestamp = utc.from_string(h5f['timestamp'][0])
+    return config, timestamp
+
+
+LAYOUT_CONTIGUOUS = 1
+LAYOUT_CHUNKED = 2
+
+
+def hdf5_layout(h5f):
+    '''
+    Return the layout version of an open raw observation HDF5 file. Files
+    written before the version was stored are contiguous. Raise a ValueError
+    for a layout this version of the code does not know.
+    '''
+    version = int(h5f.attrs.get('layout_version', LAYOUT_CONTIGUOUS))
+    if version not in (LAYOUT_CONTIGUOUS, LAYOUT_CHUNKED):
+        raise ValueError(f"Unknown raw observation layout version {version}")
+    return version
+
+
+def hdf5_num_samples(dset):
+    '''Return the number of samples per antenna in a packed HDF5 data dataset'''
+    return int(dset.attrs.get('n_samples', dset.shape[1] * 8))
+
+
+def hdf5_packed_data(h5f, sample_range=None, antennas=None):
+    '''
+    Read the packed data from an open raw observation HDF5 file. Only the
+    chunks that hold the requested samples and antennas are read.
+
+    - sample_range an optional (start, stop) range of samples
+    - antennas an optional list of antenna indices
+
+    Returns the (n_ant, n_bytes) packed data (with zero padding bits) and the
+    number of samples.
+    '''
+    hdf5_layout(h5f)
+    dset = h5f['data']
+    n_samples = hdf5_num_samples(dset)
+    start, stop = 0, n_samples
+    if sample_range is not None:
+        start = max(0, sample_range[0])
+        stop = min(n_samples, sample_range[1])
+        if stop <= start:
+            raise ValueError(f"Empty sample range {sample_range}")
+
+    byte_start = start // 8
+    byte_stop = (stop + 7) // 8
+    if antennas is None:
+        packed = dset[:, byte_start:byte_stop]
+    else:
+        rows = sorted(set(antennas))  # h5py requires increasing indices
+        packed = dset[rows, byte_start:byte_stop]
+        packed = packed[[rows.index(a) for a in antennas]]
+
+    n = stop - start
+    offset = start - byte_start * 8
+    if offset != 0 or n != packed.shape[1] * 8:
+        # Re-align the range to a byte boundary, and clear the padding bits.
+        bits = np.unpackbits(packed, axis=1)[:, offset:offset + n]
+        packed = np.packbits(bits, axis=1)
+    return np.asarray(packed, dtype=np.uint8), n
+
+
 class Observation:
     '''Antenna positions are going to be in meters from the array reference position.
     They will be in 3D ENU co-ordinates'''
 
 
-    def __init__(self, timestamp, config, data=None, savedata=None):
+    def __init__(self, timestamp, config, data=None, savedata=None, packed_data=None):
         '''
             Create an observation from binary (boolean 0...1) data
 
+            - packed_data optional (n_ant, n_bytes) np.packbits form of the data,
+              as stored on disk. Kept so that correlators can work on it directly.
         '''
         self.timestamp = timestamp
         self.config = config
         self.data = np.asarray(data)
         self.savedata = savedata
+        self.packed_data = packed_data
 
     def get_means(self):
         '''Calculate and return means of antenna data'''
-        ret = []
-        for i in range(self.config.get_num_antenna()):
-            ret.append(boolean_mean(self.data[i]))
-        return np.array(ret)
+        data = self.data[:self.config.get_num_antenna()]
+        return data.sum(axis=1)/float(data.shape[1])*2.-1
 
     def get_antenna(self, ant_num):
         if ant_num >= self.config.get_num_antenna():
             raise ValueError("Antenna %d doesn't exist" % ant_num)
         return self.data[ant_num]*2-1. # Return to bipolar binary
 
+    def get_num_samples(self):
+        if self.data.ndim == 2:
+            return self.data.shape[1]
+        return self.packed_data.shape[1] * 8
+
+    def get_packed_data(self):
+        '''Return the (n_ant, n_bytes) np.packbits form of the antenna data'''
+        if self.packed_data is None:
+            self.packed_data = np.packbits(np.asarray(self.data, dtype=np.uint8), axis=1)
+        return self.packed_data
+
     def get_sampling_rate(self):
         return self.config.get_sampling_frequency()    # See the Max 2769 data sheet. We operate in one of the predefined modes
 
@@ -57,6 +145,16 @@ class Observation:
     def get_mjd(self):
         return tart_util.get_mjd(self.timestamp)
 
+    def get_save_packed(self):
+        ''' Return the (n_ant, n_bytes) packed antenna data to be saved '''
+        if self.savedata is None:
+            return np.asarray(self.get_packed_data(), dtype=np.uint8)
+
+        t = []
+        for ant in self.savedata:
+            t.append(np.packbits(ant))
+        return np.array(t, dtype=np.uint8)
+
     def save(self, filename):
         ''' Save the Observation object,
             Data is saved as one bit
@@ -64,30 +162,37 @@ class Observation:
         d = {}
         d['config'] = self.config.Dict
         d['timestamp'] = self.timestamp
-
-        if self.savedata is None:
-            #self.savedata = np.array((self.data+1)/2,dtype=np.uint8)
-            self.savedata = np.array(self.data, dtype=np.uint8)
-
-        t = []
-        for ant in self.savedata:
-            t.append(np.packbits(ant))
-
-        d['data'] = t
+        d['data'] = list(self.get_save_packed())
 
         save_ptr = gzip.open(filename, 'wb')
         pickle.dump(d, save_ptr, pickle.HIGHEST_PROTOCOL)
         save_ptr.close()
 
 
-    def to_hdf5(self, filename):
+    def to_hdf5(self, filename, chunk_samples=None, compression=None,
+                compression_opts=None, shuffle=False):
         ''' Save the Observation object,
             in a portable HDF5 format
 
             obs = observation.Observation(t_stmp, config, savedata=ant_data)
             obs.to_hdf5(filename)
 
+            By default the packed data are stored contiguously (layout 1) so
+            that they can be memory-mapped. If chunk_samples or compression are
+            given, the data are chunked per antenna along the sample axis
+            (layout 2) so that ranges of samples can be read efficiently.
+
+            - chunk_samples the number of samples per chunk (default 2**20)
+            - compression an optional lossless filter ('lzf' or 'gzip')
+            - compression_opts the options for the filter (e.g. the gzip level)
+            - shuffle use the HDF5 byte shuffle filter
         '''
+        packed = self.get_save_packed()
+        if self.savedata is None:
+            n_samples = self.get_num_samples()
+        else:
+            n_samples = len(self.savedata[0])
+
         with h5py.File(filename, "w") as h5f:
             dt = h5py.special_dtype(vlen=bytes)
 
@@ -96,59 +201,299 @@ class Observation:
 
             ts_dset = h5f.create_dataset('timestamp', (1,), dtype=dt)
             ts_dset[0] = self.timestamp.isoformat()
-
-            if self.savedata is None:
-                #self.savedata = np.array((self.data+1)/2,dtype=np.uint8)
-                self.savedata = np.array(self.data, dtype=np.uint8)
-
-            t = []
-            for ant in self.savedata:
-                t.append(np.packbits(ant))
-
-            h5f.create_dataset('data', data=t)
+            h5f.create_dataset('timestamp_ns', data=[utc.to_epoch_ns(self.timestamp)])
+
+            if chunk_samples is None and compression is None and not shuffle:
+                h5f.attrs['layout_version'] = LAYOUT_CONTIGUOUS
+                dset = h5f.create_dataset('data', data=packed)
+            else:
+                if chunk_samples is None:
+                    chunk_samples = 2**20
+                chunk_bytes = max(1, min(packed.shape[1], chunk_samples // 8))
+                h5f.attrs['layout_version'] = LAYOUT_CHUNKED
+                dset = h5f.create_dataset('data', data=packed, chunks=(1, chunk_bytes),
+                                          compression=compression,
+                                          compression_opts=compression_opts,
+                                          shuffle=shuffle)
+            dset.attrs['n_samples'] = n_samples
 
     @classmethod
-    def from_hdf5(self, filename):
+    def from_hdf5(self, filename, sample_range=None, antennas=None):
         ''' Load the Observation object,
             in a portable HDF5 format
+
+            - sample_range an optional (start, stop) range of samples to load
+            - antennas an optional list of antennas to load. Antenna k of the
+              returned Observation is antennas[k], and the num_antenna of its
+              config is set to len(antennas).
         '''
         with h5py.File(filename, "r") as h5f:
-            config_json = np.bytes_(h5f['config'][0])
-            config = settings.from_json(config_json)
-            timestamp = utc.from_string(h5f['timestamp'][0])
-
-            hdf_data = h5f['data'][:]
-            unipolar_data = []
-            for i in hdf_data:
-                unpacked_ints = np.asarray(np.unpackbits(i), dtype=np.uint8)
-                unipolar_data.append(unpacked_ints)
-                # this is an array of unipolar 0,1 radio signals.
-
-        ret = Observation(timestamp=timestamp, config=config, data=unipolar_data)
+            config, timestamp = hdf5_header(h5f)
+            hdf_data, n_samples = hdf5_packed_data(h5f, sample_range, antennas)
+
+        # this is an array of unipolar 0,1 radio signals.
+        unipolar_data = np.unpackbits(hdf_data, axis=1, count=n_samples)
+        if antennas is not None:
+            config.Dict['num_antenna'] = len(antennas)
+
+        ret = Observation(timestamp=timestamp, config=config, data=unipolar_data,
+                          packed_data=hdf_data)
         return ret
 
-def Observation_Load(filename):
-    _, file_extension = os.path.splitext(filename)
+class PackedObservation(Observation):
+    '''
+    An Observation that keeps its data as one contiguous (n_ant, n_bytes) array of
+    np.packbits bytes, memory-mapped from disk when the file layout allows it.
 
-    if (file_extension == '.pkl'):
-        try:
-            load_data = gzip.open(filename, 'rb')
-            d = pickle.load(load_data)
-        except:
-            print('not gzipped')
-            load_data = open(filename, 'rb')
-            d = pickle.load(load_data)
-        finally:
-            load_data.close()
+    Antennas (or ranges of samples) are unpacked only when they are asked for,
+    means are computed from popcounts, and the packed data can be correlated
+    directly (the "packed" Correlator mode, or the StreamingCorrelator).
+    '''
+
+    def __init__(self, timestamp, config, packed_data, n_samples=None):
+        self.timestamp = timestamp
+        self.config = config
+        self.savedata = None
+        self.packed_data = packed_data
+        if n_samples is None:
+            n_samples = packed_data.shape[1] * 8
+        self.n_samples = n_samples
+        self._data = None
+
+    @property
+    def data(self):
+        '''The full unpacked (n_ant, n_samples) data. This is unpacked (once) on first use.'''
+        if self._data is None:
+            self._data = np.unpackbits(self.packed_data, axis=1, count=self.n_samples)
+        return self._data
+
+    def get_num_samples(self):
+        return self.n_samples
+
+    def get_packed_data(self):
+        return self.packed_data
+
+    def get_unipolar(self, ant_num, start=0, stop=None):
+        '''Return the unipolar (0, 1) samples [start, stop) of one antenna, unpacking only those bytes'''
+        if ant_num >= self.config.get_num_antenna():
+            raise ValueError("Antenna %d doesn't exist" % ant_num)
+        if stop is None or stop > self.n_samples:
+            stop = self.n_samples
+        byte_start = start // 8
+        byte_stop = (stop + 7) // 8
+        bits = np.unpackbits(np.asarray(self.packed_data[ant_num, byte_start:byte_stop]))
+        return bits[start - byte_start*8:stop - byte_start*8]
+
+    def get_antenna(self, ant_num, start=0, stop=None):
+        return self.get_unipolar(ant_num, start, stop)*2-1. # Return to bipolar binary
 
-        unipolar_data = []
-        for i in d['data']:
-            unpacked_ints = np.asarray(np.unpackbits(i), dtype=np.uint8)
-            unipolar_data.append(unpacked_ints)
-            # this is an array of unipolar 0,1 radio signals.
+    def get_means(self):
+        '''Calculate and return means of antenna data from the popcount of each antenna'''
+        packed = np.asarray(self.packed_data[:self.config.get_num_antenna()])
+        n_full, n_tail = divmod(self.n_samples, 8)
+        ones = np.bitwise_count(packed[:, :n_full]).sum(axis=1, dtype=np.int64)
+        if n_tail:
+            # Only the first n_tail (most significant) bits of the last byte are samples
+            mask = np.uint8((0xFF << (8 - n_tail)) & 0xFF)
+            ones += np.bitwise_count(packed[:, n_full] & mask)
+        return ones/float(self.n_samples)*2.-1
 
-        return Observation(timestamp=d['timestamp'], config=settings.from_dict(d['config']), data=unipolar_data)
-    if (file_extension == '.hdf'):
-        return Observation.from_hdf5(filename)
+    @classmethod
+    def from_hdf5(cls, filename, mmap=True, sample_range=None, antennas=None):
+        ''' Load the Observation object from a portable HDF5 format. The packed
+            data are memory-mapped if mmap is True and the dataset is stored
+            contiguously without compression, otherwise they are read into memory.
 
-    raise RuntimeError(f"Unknown file extension {file_extension}")
+            sample_range and antennas select part of the data, as for
+            Observation.from_hdf5(). The selection is read into memory.
+        '''
+        with h5py.File(filename, "r") as h5f:
+            config, timestamp = hdf5_header(h5f)
+            layout = hdf5_layout(h5f)
+            dset = h5f['data']
+            n_samples = hdf5_num_samples(dset)
+            offset = dset.id.get_offset()
+            if sample_range is not None or antennas is not None:
+                packed, n_samples = hdf5_packed_data(h5f, sample_range, antennas)
+                if antennas is not None:
+                    config.Dict['num_antenna'] = len(antennas)
+            elif (mmap and layout == LAYOUT_CONTIGUOUS and offset is not None and
+                  dset.chunks is None and dset.dtype == np.uint8):
+                packed = np.memmap(filename, dtype=np.uint8, mode='r',
+                                   offset=offset, shape=dset.shape)
+            else:
+                packed = np.asarray(dset[:], dtype=np.uint8)
+
+        return cls(timestamp=timestamp, config=config, packed_data=packed, n_samples=n_samples)
+
+
+HDF5_MAGIC = b'\x89HDF\r\n\x1a\n'
+GZIP_MAGIC = b'\x1f\x8b'
+PICKLE_MAGIC = b'\x80'
+PICKLE_EXTENSIONS = ('.pkl', '.pickle')
+
+
+def is_pickle(head, filename):
+    '''
+    Whether (possibly decompressed) contents starting with head are to be
+    unpickled. Pickles of protocol 2 and above start with PICKLE_MAGIC, but those
+    of protocols 0 and 1 have no signature, so they are only read from files
+    with a pickle extension. Unpickling runs arbitrary code, so nothing else is.
+    '''
+    return head.startswith(PICKLE_MAGIC) or os.path.splitext(filename)[1].lower() in PICKLE_EXTENSIONS
+
+
+def sniff_format(head, filename):
+    '''
+    Return the format ('hdf5', 'gzip' or 'pickle') of a raw file from its first
+    bytes (and its name, see is_pickle). Raise a ValueError for anything else.
+    '''
+    if head.startswith(HDF5_MAGIC):
+        return 'hdf5'
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if is_pickle(head, filename):
+        return 'pickle'
+    raise ValueError("unknown observation format")
+
+
+def file_checksum(filename, algorithm='sha256', block_size=2**20):
+    '''Return the hex digest of a file'''
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def expected_checksum(filename, checksum):
+    '''
+    Return the expected sha256 hex digest of a file. checksum is either the digest
+    itself, or True to read it from a sidecar file (filename + '.sha256', in the
+    format written by sha256sum)
+    '''
+    if checksum is True:
+        with open(filename + '.sha256', 'r') as f:
+            checksum = f.read().split()[0]
+    return checksum.lower()
+
+
+def verify_checksum(filename, checksum, raw=None):
+    '''Raise a ValueError if the sha256 checksum of the file (or its raw bytes) does not match'''
+    expected = expected_checksum(filename, checksum)
+    if raw is None:
+        actual = file_checksum(filename)
+    else:
+        actual = hashlib.sha256(raw).hexdigest()
+    if actual != expected:
+        raise ValueError(f"Checksum mismatch for {filename}: {actual} != {expected}")
+
+
+class RawObservation:
+    '''
+    The packed contents of a raw observation file, as read from disk (and
+    decompressed) but not yet unpacked.
+    '''
+    def __init__(self, filename, timestamp, config, packed_data, n_samples):
+        self.filename = filename
+        self.timestamp = timestamp
+        self.config = config
+        self.packed_data = packed_data
+        self.n_samples = n_samples
+
+    def to_observation(self, packed=False):
+        if packed:
+            return PackedObservation(timestamp=self.timestamp, config=self.config,
+                                     packed_data=self.packed_data, n_samples=self.n_samples)
+        # this is an array of unipolar 0,1 radio signals.
+        unipolar_data = np.unpackbits(self.packed_data, axis=1, count=self.n_samples)
+        return Observation(timestamp=self.timestamp, config=self.config,
+                           data=unipolar_data, packed_data=self.packed_data)
+
+
+def read_raw(filename, checksum=None):
+    '''
+    Read a raw observation file, detecting its format from its magic bytes rather
+    than the file extension. Gzipped and plain pickles are each read in one pass.
+
+    - checksum an optional sha256 hex digest (or True to use the filename.sha256
+      sidecar) to verify the file against.
+    '''
+    with open(filename, 'rb') as f:
+        head = f.read(len(HDF5_MAGIC))
+    fmt = sniff_format(head, filename)
+
+    if fmt == 'hdf5':
+        if checksum is not None:
+            verify_checksum(filename, checksum)
+        with h5py.File(filename, "r") as h5f:
+            config, timestamp = hdf5_header(h5f)
+            packed, n_samples = hdf5_packed_data(h5f)
+        return RawObservation(filename, timestamp, config, packed, n_samples)
+
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    if checksum is not None:
+        verify_checksum(filename, checksum, raw)
+    if fmt == 'gzip':
+        raw = gzip.decompress(raw)
+        if not is_pickle(raw, filename):
+            raise ValueError("unknown observation format")
+    d = pickle.loads(raw, encoding='latin1')
+
+    packed = np.array(d['data'], dtype=np.uint8)
+    return RawObservation(filename, d['timestamp'], settings.from_dict(d['config']),
+                          packed, packed.shape[1] * 8)
+
+
+def Observation_Load(filename, checksum=None, packed=False):
+    '''
+    Load a raw observation file (HDF5, or a plain or gzipped pickle).
+
+    - checksum an optional sha256 hex digest (or True to use the filename.sha256 sidecar)
+    - packed return a PackedObservation (memory-mapped if the file allows it)
+    '''
+    if packed and checksum is None:
+        with open(filename, 'rb') as f:
+            if sniff_format(f.read(len(HDF5_MAGIC)), filename) == 'hdf5':
+                return PackedObservation.from_hdf5(filename)
+    return read_raw(filename, checksum).to_observation(packed)
+
+
+def load_directory(path, pattern=None, checksum=None, packed=False, max_queue=4, workers=2):
+    '''
+    Load all the raw observation files in a directory, in file name order.
+
+    Files are read, decompressed and checked by a pool of background threads while
+    the caller unpacks and uses earlier ones. At most max_queue files are held in
+    the queue at once.
+
+    - pattern a glob pattern for the files (default all .hdf and .pkl files)
+    - checksum True to verify each file against its .sha256 sidecar file
+
+    This is a generator of Observation (or PackedObservation) objects.
+    '''
+    if pattern is None:
+        files = [f for f in glob.glob(os.path.join(path, '*'))
+                 if os.path.splitext(f)[1] in ['.hdf', '.pkl']]
+    else:
+        files = glob.glob(os.path.join(path, pattern))
+    files = iter(sorted(files))
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def fill():
+            while len(pending) < max_queue:
+                fname = next(files, None)
+                if fname is None:
+                    break
+                pending.append(pool.submit(read_raw, fname, checksum))
+        try:
+            fill()
+            while len(pending) > 0:
+                raw = pending.popleft().result()
+                fill()
+                yield raw.to_observation(packed)
+        finally:
+            for fut in pending:
+                fut.cancel()
@@ -1,9 +1,15 @@
+import datetime
+import gzip
+import os
+import pickle
+import tempfile
 import unittest
 
+import h5py
 import numpy as np
 
-from tart.operation import settings
-from tart.operation.observation import Observation
+from tart.operation import observation, settings
+from tart.operation.observation import Observation, PackedObservation
 from tart.util import utc
 
 
@@ -27,6 +33,173 @@ class TestObservation(unittest.TestCase):
         self.assertTrue((self.obs.get_antenna(1) == nobs.get_antenna(1)).all())
         self.assertEqual(self.obs.get_julian_date(), nobs.get_julian_date())
         self.assertTrue((self.data == nobs.data).all())
+        self.assertEqual(nobs.timestamp, self.obs.timestamp)
+        with h5py.File('data.hdf', 'r') as h5f:
+            self.assertEqual(h5f['timestamp_ns'][0], utc.to_epoch_ns(self.obs.timestamp))
+
+    def test_get_means(self):
+        expected = np.array([np.mean(d)*2-1 for d in self.data])
+        self.assertTrue(np.allclose(self.obs.get_means(), expected))
+
+    def test_packed_means_padding(self):
+        # 3 samples in the last byte. Its padding bits are set, and must not be counted.
+        n = self.test_len - 5
+        packed = np.packbits(np.array(self.data, dtype=np.uint8)[:, :n], axis=1)
+        packed[:, -1] |= 0x1F
+        pobs = PackedObservation(self.obs.timestamp, self.config, packed, n_samples=n)
+        expected = np.array([np.mean(d[:n])*2-1 for d in self.data])
+        self.assertTrue(np.allclose(pobs.get_means(), expected))
+
+    def test_packed_observation(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data_packed.hdf')
+            self.obs.to_hdf5(path)
+
+            pobs = PackedObservation.from_hdf5(path)
+            self.assertIsInstance(pobs.get_packed_data(), np.memmap)
+            self.assertEqual(pobs.get_num_samples(), self.test_len)
+            self.assertEqual(pobs.timestamp, self.obs.timestamp)
+
+            self.assertTrue((pobs.get_antenna(1) == self.obs.get_antenna(1)).all())
+            self.assertTrue((pobs.get_unipolar(2, 13, 77) == self.data[2][13:77]).all())
+            self.assertTrue(np.allclose(pobs.get_means(), self.obs.get_means()))
+            self.assertTrue((pobs.data == np.array(self.data)).all())
+
+            path2 = os.path.join(tmp, 'data_packed2.hdf')
+            pobs.to_hdf5(path2)
+            nobs = Observation.from_hdf5(path2)
+            self.assertTrue((nobs.data == np.array(self.data)).all())
+
+            nobs = PackedObservation.from_hdf5(path, mmap=False)
+            self.assertNotIsInstance(nobs.get_packed_data(), np.memmap)
+
+    def test_hdf5_chunked(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data_chunked.hdf')
+            self.obs.to_hdf5(path, chunk_samples=64, compression='lzf', shuffle=True)
+            with h5py.File(path, 'r') as h5f:
+                self.assertEqual(observation.hdf5_layout(h5f), observation.LAYOUT_CHUNKED)
+                self.assertEqual(h5f['data'].chunks, (1, 8))
+                self.assertEqual(h5f['data'].compression, 'lzf')
+
+            nobs = Observation.from_hdf5(path)
+            self.assertTrue((np.array(self.data) == nobs.data).all())
+
+            nobs = Observation.from_hdf5(path, sample_range=(13, 131), antennas=[5, 2])
+            self.assertEqual(nobs.config.get_num_antenna(), 2)
+            self.assertEqual(nobs.get_num_samples(), 118)
+            self.assertTrue((nobs.data[0] == self.data[5][13:131]).all())
+            self.assertTrue((nobs.data[1] == self.data[2][13:131]).all())
+            self.assertTrue((np.unpackbits(nobs.get_packed_data(), axis=1)[:, :118] == nobs.data).all())
+
+            pobs = PackedObservation.from_hdf5(path)
+            self.assertNotIsInstance(pobs.get_packed_data(), np.memmap)
+            self.assertTrue((pobs.get_antenna(3) == self.obs.get_antenna(3)).all())
+
+    def test_hdf5_legacy_layout(self):
+        """ Files written before the layout version was stored must still load """
+        packed = np.array([np.packbits(d) for d in self.data])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data_legacy.hdf')
+            with h5py.File(path, 'w') as h5f:
+                dt = h5py.special_dtype(vlen=bytes)
+                conf_dset = h5f.create_dataset('config', (1,), dtype=dt)
+                conf_dset[0] = self.config.to_json()
+                ts_dset = h5f.create_dataset('timestamp', (1,), dtype=dt)
+                ts_dset[0] = self.obs.timestamp.isoformat()
+                h5f.create_dataset('data', data=packed)
+
+            nobs = Observation.from_hdf5(path)
+            self.assertTrue((np.array(self.data) == nobs.data).all())
+            self.assertEqual(nobs.timestamp, self.obs.timestamp)
+            nobs = Observation.from_hdf5(path, sample_range=(8, 24))
+            self.assertTrue((nobs.data[0] == self.data[0][8:24]).all())
+
+            # A legacy file is contiguous, so it is memory-mapped
+            pobs = PackedObservation.from_hdf5(path)
+            self.assertIsInstance(pobs.get_packed_data(), np.memmap)
+            self.assertTrue((pobs.data == np.array(self.data)).all())
+
+            # A layout from a later version of the code is refused
+            with h5py.File(path, 'a') as h5f:
+                h5f.attrs['layout_version'] = observation.LAYOUT_CHUNKED + 1
+            self.assertRaises(ValueError, Observation.from_hdf5, path)
+            self.assertRaises(ValueError, PackedObservation.from_hdf5, path)
+
+    def test_load_sniffs_format(self):
+        with tempfile.TemporaryDirectory() as d:
+            # The format is detected from the contents, not the extension
+            for fname, save in [('obs_pkl.raw', self.obs.save), ('obs_hdf.raw', self.obs.to_hdf5)]:
+                path = os.path.join(d, fname)
+                save(path)
+                nobs = observation.Observation_Load(path)
+                self.assertTrue((np.array(self.data) == nobs.data).all())
+                self.assertEqual(nobs.timestamp, self.obs.timestamp)
+
+    def test_load_old_pickle_protocols(self):
+        ''' Protocol 0 and 1 pickles have no magic bytes, but still load '''
+        d = {'config': self.config.Dict, 'timestamp': self.obs.timestamp,
+             'data': list(self.obs.get_save_packed())}
+        with tempfile.TemporaryDirectory() as tmp:
+            for protocol in [0, 1]:
+                path = os.path.join(tmp, f'obs_{protocol}.pkl')
+                with open(path, 'wb') as f:
+                    pickle.dump(d, f, protocol)
+                nobs = observation.Observation_Load(path)
+                self.assertTrue((np.array(self.data) == nobs.data).all())
+
+    def test_load_unknown_format(self):
+        ''' Files that are neither HDF5 nor recognisably pickles are not unpickled '''
+        d = {'config': self.config.Dict, 'timestamp': self.obs.timestamp,
+             'data': list(self.obs.get_save_packed())}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'obs.raw')
+            with open(path, 'wb') as f:
+                pickle.dump(d, f, 0)
+            with self.assertRaisesRegex(ValueError, "unknown observation format"):
+                observation.Observation_Load(path)
+
+            path = os.path.join(tmp, 'notes.txt.gz')
+            with gzip.open(path, 'wb') as f:
+                f.write(b'not an observation')
+            with self.assertRaisesRegex(ValueError, "unknown observation format"):
+                observation.Observation_Load(path)
+
+    def test_load_legacy_pickle(self):
+        nobs = observation.Observation_Load('tart/test/test_data/01_59_03.059450_data.pkl')
+        self.assertEqual(nobs.data.shape, (5, 2**16))
+
+    def test_load_checksum(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'obs.hdf')
+            self.obs.to_hdf5(path)
+            digest = observation.file_checksum(path)
+            observation.Observation_Load(path, checksum=digest)
+            self.assertRaises(ValueError, observation.Observation_Load, path, checksum='0' * 64)
+
+            with open(path + '.sha256', 'w') as f:
+                f.write(f"{digest}  obs.hdf\n")
+            observation.Observation_Load(path, checksum=True)
+
+    def test_load_directory(self):
+        with tempfile.TemporaryDirectory() as d:
+            for k in range(5):
+                obs = Observation(timestamp=self.obs.timestamp + datetime.timedelta(seconds=k),
+                                  config=self.config, data=self.data)
+                if k % 2:
+                    obs.save(os.path.join(d, f'obs_{k}.pkl'))
+                else:
+                    obs.to_hdf5(os.path.join(d, f'obs_{k}.hdf'))
+
+            loaded = list(observation.load_directory(d, max_queue=2))
+            self.assertEqual(len(loaded), 5)
+            for k, nobs in enumerate(loaded):
+                self.assertEqual(nobs.timestamp, self.obs.timestamp + datetime.timedelta(seconds=k))
+                self.assertTrue((np.array(self.data) == nobs.data).all())
+
+            loaded = list(observation.load_directory(d, pattern='*.hdf', packed=True))
+            self.assertEqual(len(loaded), 3)
+            self.assertIsInstance(loaded[0], PackedObservation)
 
     def test_get_antenna_out_of_range(self):
         class FakeConfig:
@@ -160,6 +160,27 @@ def get_geo_delay_horizontal(a0, a1, src):
     return d1 - d0
 
 
+def get_geo_delays_horizontal(enu, src):
+    """
+    Return the geometric delays (t_antenna - t_origin) of an (n_ant, 3)
+    array of ENU antenna positions for a horizontal source. This is the
+    vectorised equivalent of Antenna.get_geo_delay_horizontal().
+    """
+    el_0, az_0, r_0 = src.elevation, src.azimuth, src.r
+    if r_0 > 1e4:
+        r_0 = 1.0e4  # Clamp locally; do not mutate the source object
+
+    object_vector = np.array([az_0.sin() * el_0.cos(),
+                              az_0.cos() * el_0.cos(),
+                              el_0.sin()])
+
+    object_vector_ant_pov = r_0 * object_vector - np.asarray(enu, dtype=np.float64)
+
+    r = np.linalg.norm(object_vector_ant_pov, axis=-1)
+    path_diff = r - r_0
+    return path_diff / constants.V_LIGHT
+
+
 def get_UVW(a0, a1, utc_time, ra, dec):
     uvw0 = a0.calcUVW(utc_time, ra, dec)
     uvw1 = a1.calcUVW(utc_time, ra, dec)
@@ -1,9 +1,127 @@
 
+import functools
+import os
 import pickle
 import time
 
 import numpy as np
-import pyfftw
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+WISDOM_FILE = "wisdom_hilbert.wis"
+CACHE_MAX_SAMPLES = 2**20   # Larger transformers (and their buffers) are not kept
+
+
+def get_cache_dir(cache_dir=None):
+    '''
+    Return the directory used to cache FFTW wisdom. This is cache_dir if given,
+    otherwise the TART_CACHE_DIR environment variable, otherwise ~/.cache/tart
+    '''
+    if cache_dir is None:
+        cache_dir = os.environ.get("TART_CACHE_DIR",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "tart"))
+    return cache_dir
+
+
+def load_wisdom(cache_dir=None):
+    '''Import any FFTW wisdom from the cache. Returns True if wisdom was found'''
+    try:
+        with open(os.path.join(get_cache_dir(cache_dir), WISDOM_FILE), "rb") as f:
+            pyfftw.import_wisdom(pickle.load(f))
+        return True
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return False
+
+
+def save_wisdom(cache_dir=None):
+    '''Save the accumulated FFTW wisdom to the cache'''
+    cache_dir = get_cache_dir(cache_dir)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, WISDOM_FILE), "wb") as f:
+            pickle.dump(pyfftw.export_wisdom(), f)
+    except OSError:
+        print(f"could not save wisdom to {cache_dir}")
+
+
+class HilbertTransformer:
+    '''
+    A Hilbert transformer for a fixed (..., n_samples) shape. The transform is
+    applied along the last axis, so all antennas are transformed by one
+    multi-dimensional real FFT.
+
+    The FFT plans are made once, when the transformer is created, using pyfftw
+    (with its wisdom kept in the cache directory, see get_cache_dir()) if it
+    is installed, otherwise scipy.fft is used.
+
+    The result has the sign convention of scipy.fftpack.hilbert, that is
+    H{cos} = -sin.
+    '''
+
+    def __init__(self, shape, dtype=np.float64, threads=None, cache_dir=None,
+                 planner_effort="FFTW_ESTIMATE"):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.n = self.shape[-1]
+        self.threads = threads if threads is not None else (os.cpu_count() or 1)
+
+        self.fft_machine = None
+        if pyfftw is not None:
+            have_wisdom = load_wisdom(cache_dir)
+            fft_in = pyfftw.empty_aligned(self.shape, dtype=self.dtype)
+            self.fft_machine = pyfftw.builders.rfft(
+                fft_in, axis=-1, threads=self.threads, planner_effort=planner_effort)
+            ifft_in = pyfftw.empty_aligned(self.fft_machine.output_shape,
+                                           dtype=self.fft_machine.output_dtype)
+            self.ifft_machine = pyfftw.builders.irfft(
+                ifft_in, n=self.n, axis=-1, threads=self.threads, planner_effort=planner_effort)
+            if not have_wisdom:
+                save_wisdom(cache_dir)
+
+    def __call__(self, x):
+        x = np.asarray(x)
+        if x.shape != self.shape:
+            raise ValueError(f"Expected data of shape {self.shape}, not {x.shape}")
+
+        if self.fft_machine is not None:
+            S = self.fft_machine(x)
+        else:
+            from scipy import fft
+            S = fft.rfft(x.astype(self.dtype, copy=False), axis=-1, workers=self.threads)
+
+        S *= 1j
+        S[..., 0] = 0.0
+        if self.n % 2 == 0:
+            S[..., -1] = 0.0  # The Nyquist component
+
+        if self.fft_machine is not None:
+            return self.ifft_machine(S).copy()
+        return fft.irfft(S, n=self.n, axis=-1, workers=self.threads)
+
+
+@functools.lru_cache(maxsize=2)
+def _get_cached_transformer(shape, dtype):
+    return HilbertTransformer(shape, dtype=dtype)
+
+
+def get_hilbert_transformer(shape, dtype=np.float64):
+    '''
+    Return a HilbertTransformer for this shape and dtype. Transformers of up
+    to CACHE_MAX_SAMPLES samples are cached. Larger ones hold large FFT buffers,
+    so they are made afresh (with the FFTW wisdom, planning is cheap).
+    '''
+    shape = tuple(shape)
+    if np.prod(shape) <= CACHE_MAX_SAMPLES:
+        return _get_cached_transformer(shape, np.dtype(dtype))
+    return HilbertTransformer(shape, dtype=dtype)
+
+
+def clear_hilbert_cache():
+    '''Release the cached HilbertTransformers (and their FFT buffers)'''
+    _get_cached_transformer.cache_clear()
 
 
 def hilbert(s, debug=False):
@@ -70,49 +188,13 @@ def hilbert_fftw(s, debug=False, dtype='complex64'):
     Hilbert transform computed with an FIR filter.
     '''
 
-    n = len(s)
-    pyfftw.interfaces.cache.enable()
-    pyfftw.interfaces.cache.set_keepalive_time(50.0)
-    align = pyfftw.simd_alignment
-
-    write_wisdom = False
-    try:
-        wisdom = pickle.load(open("wisdom_hilbert.wis", "rb"))
-        pyfftw.import_wisdom(wisdom)
-    except:
-        write_wisdom = True
-        print('no wisdom file')
-
-    fft_in = pyfftw.empty_aligned(n, dtype=dtype, n=align)
-    fft_out = pyfftw.empty_aligned(n, dtype=dtype, n=align)
-    ifft_in = pyfftw.empty_aligned(n, dtype=dtype, n=align)
-    ifft_out = pyfftw.empty_aligned(n, dtype=dtype, n=align)
-    fft_machine = pyfftw.FFTW(fft_in, fft_out, direction='FFTW_FORWARD', flags=('FFTW_ESTIMATE',), threads=8)
-    ifft_machine = pyfftw.FFTW(ifft_in, ifft_out, direction='FFTW_BACKWARD', flags=('FFTW_ESTIMATE',), threads=8)
-
-    if write_wisdom:
-        wisdom = pyfftw.export_wisdom()
-        pickle.dump(wisdom, open("wisdom_hilbert.wis", "wb"))
-
     s_0 = time.time()
-    fft_in[:] = s
-    S = fft_machine()
-    if debug:
-        print('fft', time.time()-s_0)
-
-    s_1 = time.time()
-    h = np.zeros(n)
-    h[0] = 1.
-    h[n // 2] = 1.
-    h[1:n // 2] = 2.
+    dtype = np.float32 if np.dtype(dtype) == np.complex64 else np.float64
+    transformer = get_hilbert_transformer((len(s),), dtype=dtype)
+    ret = transformer(np.asarray(s, dtype=dtype))
     if debug:
-        print('setup', time.time()-s_1)
-    s_2 = time.time()
-    ifft_in[:] = h*S
-    ret = ifft_machine()
-    if debug:
-        print('ifft', time.time()-s_2)
-    return -ret[:n].imag
+        print('hilbert', time.time()-s_0)
+    return ret
 
 
 if __name__ == '__main__':
@@ -1,8 +1,12 @@
+import os
+import tempfile
 import unittest
 
 import numpy as np
+import scipy.fftpack
 
-from tart.util.hilbert import hilbert
+from tart.util import hilbert as hilbert_module
+from tart.util.hilbert import HilbertTransformer, WISDOM_FILE, hilbert, hilbert_fftw
 
 
 class TestHilbert(unittest.TestCase):
@@ -24,3 +28,45 @@ class TestHilbert(unittest.TestCase):
         self.assertEqual(hx.shape, x.shape)
         # The Hilbert transform of a constant is zero.
         self.assertTrue(np.allclose(hx, 0.0, atol=1e-6))
+
+
+class TestHilbertTransformer(unittest.TestCase):
+    def test_matches_fftpack(self):
+        """All rows are transformed at once, with the scipy.fftpack sign convention."""
+        for n in [1024, 1001]:
+            x = np.random.normal(0.0, 1.0, (4, n))
+            h = HilbertTransformer(x.shape)
+            expected = np.array([scipy.fftpack.hilbert(row) for row in x])
+            self.assertTrue(np.allclose(h(x), expected))
+            # The plans are reused
+            self.assertTrue(np.allclose(h(2 * x), 2 * expected))
+
+    def test_wrong_shape(self):
+        h = HilbertTransformer((2, 64))
+        self.assertRaises(ValueError, h, np.zeros((3, 64)))
+
+    def test_hilbert_fftw(self):
+        x = np.random.normal(0.0, 1.0, 512)
+        self.assertTrue(np.allclose(hilbert_fftw(x, dtype="complex128"),
+                                    scipy.fftpack.hilbert(x)))
+
+    def test_fftpack_sign(self):
+        n = 256
+        t = np.arange(n) / float(n)
+        x = np.cos(2.0 * np.pi * 4 * t)
+        self.assertTrue(np.allclose(HilbertTransformer(x.shape)(x), -np.sin(2.0 * np.pi * 4 * t)))
+
+    def test_transformer_cache(self):
+        h = hilbert_module.get_hilbert_transformer((2, 64))
+        self.assertIs(h, hilbert_module.get_hilbert_transformer((2, 64)))
+        big = (1, hilbert_module.CACHE_MAX_SAMPLES + 2)
+        self.assertIsNot(hilbert_module.get_hilbert_transformer(big),
+                         hilbert_module.get_hilbert_transformer(big))
+        hilbert_module.clear_hilbert_cache()
+        self.assertIsNot(h, hilbert_module.get_hilbert_transformer((2, 64)))
+
+    @unittest.skipIf(hilbert_module.pyfftw is None, "pyfftw is not installed")
+    def test_wisdom_cache_dir(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            HilbertTransformer((2, 128), cache_dir=cache_dir)
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, WISDOM_FILE)))
@@ -1,6 +1,7 @@
 import datetime
 import unittest
 
+import numpy as np
 from astropy import time
 
 from tart.util import utc
@@ -45,3 +46,33 @@ class TestUTC(unittest.TestCase):
 
         self.compare(timestamp, now)
         self.assertEqual(timestamp.isoformat(), now.isoformat())
+
+    def test_epoch_ns(self):
+        utcd = datetime.datetime(2019, 2, 22, 5, 11, 41, 765212, tzinfo=utc.UTC)
+        ns = utc.to_epoch_ns(utcd)
+        self.assertEqual(ns, 1550812301765212000)
+        self.assertEqual(utc.from_epoch_ns(ns), utcd)
+
+        ts = [utcd + datetime.timedelta(seconds=k) for k in range(5)]
+        ns = utc.to_epoch_ns(ts)
+        self.assertEqual(ns.dtype, np.int64)
+        self.assertTrue((np.diff(ns) == 1000000000).all())
+        self.assertEqual(utc.from_epoch_ns(ns), ts)
+
+        with self.assertRaises(RuntimeError):
+            utc.to_epoch_ns(datetime.datetime(2019, 2, 22))
+
+    def test_from_strings(self):
+        ts = [utc.now() + datetime.timedelta(seconds=k / 3.0) for k in range(10)]
+        ts.append(datetime.datetime(2019, 2, 22, 5, 11, 41, tzinfo=utc.UTC))
+        strings = [utc.to_string(t) for t in ts]
+        self.assertEqual(utc.from_strings(strings), ts)
+        self.assertEqual(utc.from_strings([s.encode() for s in strings]), ts)
+        self.assertEqual(utc.from_string(strings[3].encode()), ts[3])
+
+        # Other formats fall back to the general parser
+        mixed = ["2019-02-22 05:11:41Z", "2019-02-22T05:11:41.5+00:00"]
+        ret = utc.from_strings(mixed)
+        self.assertEqual(ret[0], datetime.datetime(2019, 2, 22, 5, 11, 41, tzinfo=utc.UTC))
+        self.assertEqual(ret[1].microsecond, 500000)
+        self.assertEqual(utc.from_string("Fri, 22 Feb 2019 05:11:41 +0000"), ret[0])
@@ -22,12 +22,8 @@ def vis_json_timestamp(vis_json):
 def vis_object_from_json(vis_json, config):
     ts = vis_json_timestamp(vis_json)
     ret = visibility.Visibility.from_config(config, ts)
-    v_order = []
-    bl_order = []
-    for v in vis_json["data"]:
-        v_order.append(complex(v["re"], v["im"]))
-        bl_order.append([v["i"], v["j"]])
-    ret.set_visibilities(v_order, bl_order)
+    v, baselines = visibility.json_decode(vis_json["data"])
+    ret.set_visibilities(v, baselines)
     return ret
 
 
@@ -48,8 +44,8 @@ def rotate_vis(rot_degrees, cv, reference_positions):
     return imaging.rotate_vis(rot_degrees, cv, reference_positions)
 
 
-def image_from_calibrated_vis(cv, nw, num_bin):
-    return imaging.image_from_calibrated_vis(cv, nw, num_bin)
+def image_from_calibrated_vis(cv, nw, num_bin, use_rfft=False, workers=None):
+    return imaging.image_from_calibrated_vis(cv, nw, num_bin, use_rfft=use_rfft, workers=workers)
 
 
 def beam_from_calibrated_vis(cv, nw, num_bin):
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Correlate a set of raw observation files into one visibility HDF5 file,
+# using all the cores of the machine.
+#
+import argparse
+import json
+
+from tart.imaging import batch_correlator
+
+
+def load_antenna_positions(filename):
+    """ Load antenna positions as saved by tart_download_antenna_positions (or a plain list) """
+    with open(filename, "r") as json_file:
+        pos = json.load(json_file)
+    if isinstance(pos, dict):
+        pos = pos["antenna_positions"]
+    return pos
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Correlate raw observation files in parallel, and save the visibilities in one HDF5 file.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "files", nargs="+", help="Raw observation files (.hdf or .pkl) or glob patterns."
+    )
+    parser.add_argument(
+        "--out", required=True, help="Output visibility HDF5 file."
+    )
+    parser.add_argument(
+        "--ant-pos", required=True,
+        help="JSON file of antenna positions (as saved by tart_download_antenna_positions).",
+    )
+    parser.add_argument(
+        "--gains", required=False, default=None,
+        help="JSON file of gains to store with the visibilities (as saved by tart_download_gains).",
+    )
+    parser.add_argument(
+        "--mode", default="roll",
+        help="Correlator mode (roll, packed, fftw_hilbert, fftw_hilbert_sign).",
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None, help="Number of worker processes (default: all cores)."
+    )
+    parser.add_argument(
+        "--load-threads", type=int, default=4, help="Number of threads reading the raw files."
+    )
+    parser.add_argument(
+        "--no-van-vleck", action="store_true", help="Do not apply the Van Vleck correction."
+    )
+
+    ARGS = parser.parse_args()
+
+    ant_pos = load_antenna_positions(ARGS.ant_pos)
+    cal_gain, cal_ph = None, None
+    if ARGS.gains is not None:
+        with open(ARGS.gains, "r") as json_file:
+            gains = json.load(json_file)
+        cal_gain = gains["gain"]
+        cal_ph = gains["phase_offset"]
+
+    stats_list = batch_correlator.correlate_to_hdf5(
+        ARGS.files, ARGS.out, ant_pos=ant_pos, cal_gain=cal_gain, cal_ph=cal_ph,
+        mode=ARGS.mode, van_vleck_corr=not ARGS.no_van_vleck, processes=ARGS.processes,
+        load_threads=ARGS.load_threads,
+    )
+
+    total_samples = 0
+    total_time = 0.0
+    for s in stats_list:
+        print("{}: {} load {:.2f}s correlate {:.2f}s ({:.3g} samples/s)".format(
+            s["filename"], s["timestamp"].isoformat(), s["load_time"],
+            s["correlate_time"], s["samples_per_second"]))
+        total_samples += s["n_samples"]
+        total_time += s["correlate_time"]
+    if total_time > 0:
+        print("Correlated {} files ({:.3g} samples/s per worker) into {}".format(
+            len(stats_list), total_samples / total_time, ARGS.out))
+
+
+if __name__ == "__main__":
+    main()
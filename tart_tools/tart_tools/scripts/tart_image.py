@@ -129,6 +129,17 @@ def main():
     PARSER.add_argument(
         "--dirty", action="store_true", help="Create a direct IFFT dirty image."
     )
+    PARSER.add_argument(
+        "--rfft",
+        action="store_true",
+        help="Make the dirty image with a real FFT of the Hermitian half of the uv-plane (faster for large --nfft).",
+    )
+    PARSER.add_argument(
+        "--fft-workers",
+        type=int,
+        default=None,
+        help="Number of threads used by the real FFT (with --rfft, requires scipy).",
+    )
     PARSER.add_argument(
         "--difmap",
         action="store_true",
@@ -270,7 +281,7 @@ def main():
 
     if ARGS.dirty or ARGS.moresane or ARGS.aipy:
         cal_ift, cal_extent, n_fft, bin_width = api_imaging.image_from_calibrated_vis(
-            cv, nw=n_bin / 4, num_bin=n_bin
+            cv, nw=n_bin / 4, num_bin=n_bin, use_rfft=ARGS.rfft, workers=ARGS.fft_workers
         )
 
         ## Scale to both abs and MAD
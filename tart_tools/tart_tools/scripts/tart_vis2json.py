@@ -10,18 +10,13 @@ import json
 from tart.imaging import visibility
 from tart.util import utc
 
-def create_direct_vis_dict(vis):
-    """ This function is provided with a visibility object. It returns a dictionary identical to the json response. """
+def create_direct_vis_dict(vis, layout=visibility.JSON_ROWS):
+    """ This function is provided with a visibility object. It returns a dictionary identical to the json response.
+        The layout of the visibility data is one of the visibility.json_encode() layouts. """
     vis_dicts = []
     for visobj in vis["vis_list"]:
-        vis_list = []
         timestamp = utc.to_string(visobj.timestamp)
-        for b, v in zip(visobj.baselines, visobj.v):
-            i, j = b
-            vis_el = {"i": i, "j": j, "re": v.real, "im": v.imag}
-            vis_list.append(vis_el)
-        vis_dicts.append({"data": [({"data": vis_list, "timestamp": timestamp},
-                                    [])],
+        vis_dicts.append({"data": [(visobj.to_json(layout), [])],
                           "timestamp": timestamp})
     return vis_dicts
 
@@ -33,6 +28,11 @@ def main():
     PARSER.add_argument(
         "--vis", required=False, nargs="*", default="", help="Visibilities data file."
     )
+    PARSER.add_argument(
+        "--layout", required=False, default=visibility.JSON_ROWS,
+        choices=[visibility.JSON_ROWS, visibility.JSON_COLUMNAR, visibility.JSON_BASE64],
+        help="Layout of the visibility data (rows is the per-baseline layout of the API)."
+    )
     ARGS = PARSER.parse_args()
     VIS_LIST = []
     if len(ARGS.vis) != 0:
@@ -45,7 +45,7 @@ def main():
         dico_info["info"]['location'] = {"lat": dico_info["info"]["lat"],
                                          "lon": dico_info["info"]["lon"],
                                          "alt": dico_info["info"]["alt"]}
-        vis_dicts = create_direct_vis_dict(vis)
+        vis_dicts = create_direct_vis_dict(vis, ARGS.layout)
         for vis_dict in vis_dicts:
             vis_dict["info"] = dico_info
             vis_dict["ant_pos"] = vis["ant_pos"].tolist()